@@ -0,0 +1,144 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+# Thời gian tối đa một yêu cầu chờ trong hàng trước khi bị trả BUSY
+DEFAULT_QUEUE_TIMEOUT = 30.0
+# Số lần chờ gần nhất được giữ để tính trung bình / p95
+WAIT_SAMPLES = 1000
+MAX_RETRY_AFTER = 300
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, gate, retry_after):
+        super().__init__(f"{gate} queue is full; retry after {retry_after} s")
+        self.retry_after = retry_after
+
+
+class AdmissionGate:
+    # Giới hạn số việc chạy cùng lúc (limit) và tổng trọng số của chúng (max_weight,
+    # vd. số byte đang truyền). Việc vượt giới hạn xếp hàng theo khoá
+    # thời điểm đến + size / aging: không có aging là FIFO, có aging thì việc nhỏ
+    # được ưu tiên nhưng mỗi giây chờ bù cho `aging` byte kích thước. Việc đứng đầu
+    # chưa vừa thì các việc sau cũng phải chờ, nên việc lớn không bị bỏ đói. Chờ
+    # quá `timeout` giây thì bị từ chối kèm gợi ý retry_after.
+    # Chỉ dùng từ event loop của engine.
+    def __init__(self, name, limit=None, max_weight=None, timeout=DEFAULT_QUEUE_TIMEOUT, aging=None):
+        self.name = name
+        self.limit = limit
+        self.max_weight = max_weight
+        self.timeout = timeout
+        self.aging = aging
+        self.active = 0
+        self.weight = 0
+        self.waiters = []  # heap [khoá, thứ tự, trọng số, future]
+        self._order = itertools.count()
+        self.admitted = 0
+        self.rejected = 0
+        self.waits = deque(maxlen=WAIT_SAMPLES)
+        self.max_wait = 0.0
+
+    def _fits(self, weight):
+        if self.limit is not None and self.active >= self.limit:
+            return False
+        # Một việc nặng hơn cả max_weight vẫn được chạy khi không còn việc nào khác
+        return self.max_weight is None or self.weight == 0 or self.weight + weight <= self.max_weight
+
+    def _take(self, weight):
+        self.active += 1
+        self.weight += weight
+
+    def key(self, size, arrival):
+        return arrival + (size / self.aging if self.aging else 0.0)
+
+    def _wake(self):
+        while self.waiters and self._fits(self.waiters[0][2]):
+            _, _, weight, future = heapq.heappop(self.waiters)
+            if future.done():
+                continue
+            self._take(weight)
+            future.set_result(None)
+
+    def _remove(self, entry):
+        self.waiters.remove(entry)
+        heapq.heapify(self.waiters)
+        entry[3].cancel()
+        self._wake()  # Việc bị bỏ có thể đang chặn đầu hàng
+
+    async def wait_turn(self, weight, size, arrival, timeout):
+        # Xếp hàng tới khi được nhận; hết `timeout` (None: chờ mãi) thì ném TimeoutError
+        entry = [self.key(size, arrival), next(self._order), weight, asyncio.get_running_loop().create_future()]
+        heapq.heappush(self.waiters, entry)
+        self._wake()
+        try:
+            await asyncio.wait_for(asyncio.shield(entry[3]), timeout)
+        except asyncio.TimeoutError:
+            if not entry[3].done():
+                self._remove(entry)
+                raise
+        except asyncio.CancelledError:
+            if entry[3].done() and not entry[3].cancelled():
+                self.release(weight)  # Đã được nhận đúng lúc bị huỷ: trả lại chỗ
+            else:
+                self._remove(entry)
+            raise
+
+    def _record_wait(self, wait):
+        self.waits.append(wait)
+        self.max_wait = max(self.max_wait, wait)
+
+    def retry_after(self):
+        # Gợi ý cho client: hàng càng dài so với số chỗ thì chờ càng lâu
+        slots = self.limit or max(self.active, 1)
+        return min(MAX_RETRY_AFTER, math.ceil(self.timeout * (1 + len(self.waiters) / slots)))
+
+    async def acquire(self, weight=0, size=None):
+        # Trả về số giây đã chờ, hoặc AdmissionRejected nếu hết thời gian chờ.
+        # size dùng để xếp hàng (mặc định bằng weight)
+        if not self.waiters and self._fits(weight):
+            self._take(weight)
+            self.admitted += 1
+            self._record_wait(0.0)
+            return 0.0
+        start = time.perf_counter()
+        try:
+            await self.wait_turn(weight, weight if size is None else size, time.monotonic(), self.timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise AdmissionRejected(self.name, self.retry_after())
+        self.admitted += 1
+        wait = time.perf_counter() - start
+        self._record_wait(wait)
+        return wait
+
+    def release(self, weight=0):
+        self.active -= 1
+        self.weight -= weight
+        self._wake()
+
+    @asynccontextmanager
+    async def slot(self, weight=0):
+        await self.acquire(weight)
+        try:
+            yield
+        finally:
+            self.release(weight)
+
+    def stats(self):
+        waits = sorted(self.waits)
+        return {
+            "active": self.active,
+            "limit": self.limit,
+            "weight": self.weight,
+            "max_weight": self.max_weight,
+            "queued": len(self.waiters),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "wait_avg": sum(waits) / len(waits) if waits else 0.0,
+            "wait_p95": waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.0,
+            "wait_max": self.max_wait,
+        }
@@ -0,0 +1,260 @@
+import hashlib
+import os
+import struct
+import threading
+
+try:
+    import numpy
+except ImportError:  # Chia chunk vẫn chạy được, chỉ chậm hơn
+    numpy = None
+
+from partials import STATE_DIR_NAME, file_etag, name_from_state, state_name
+
+# Chia file theo nội dung (content-defined chunking): điểm cắt là nơi hash của
+# cửa sổ WINDOW_SIZE byte cuối có các bit thấp bằng 0, nên khi chèn/xoá vài byte
+# thì chỉ các chunk quanh chỗ sửa thay đổi, phần còn lại vẫn trùng với bản cũ.
+MIN_CHUNK_SIZE = 16 * 1024
+AVG_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 256 * 1024
+WINDOW_SIZE = 48
+CUT_MASK = AVG_CHUNK_SIZE - 1
+READ_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Một bản ghi trong manifest: độ dài chunk + SHA-256
+CHUNK_RECORD = struct.Struct("!I32s")
+INDEX_SUFFIX = ".idx"
+
+# Bảng giá trị giả ngẫu nhiên cố định cho từng giá trị byte (client và server phải giống nhau)
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], "big") for i in range(256)]
+_GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint32) if numpy is not None else None
+
+
+def _cut_candidates(data):
+    # Vị trí i (cuối cửa sổ) có hash cửa sổ thoả mặt nạ; hash = tổng GEAR của
+    # WINDOW_SIZE byte cuối, mod 2^32
+    # (bỏ qua cửa sổ đầu tiên, luôn nằm trong MIN_CHUNK_SIZE)
+    if len(data) <= WINDOW_SIZE:
+        return []
+    if numpy is not None:
+        sums = numpy.cumsum(_GEAR_ARRAY.take(numpy.frombuffer(data, dtype=numpy.uint8)), dtype=numpy.uint32)
+        window = numpy.subtract(sums[WINDOW_SIZE:], sums[:-WINDOW_SIZE])
+        return (numpy.flatnonzero((window & CUT_MASK) == 0) + WINDOW_SIZE).tolist()
+    candidates = []
+    h = sum(GEAR[b] for b in data[1:WINDOW_SIZE + 1]) & 0xFFFFFFFF
+    for i in range(WINDOW_SIZE, len(data)):
+        if i > WINDOW_SIZE:
+            h = (h + GEAR[data[i]] - GEAR[data[i - WINDOW_SIZE]]) & 0xFFFFFFFF
+        if not h & CUT_MASK:
+            candidates.append(i)
+    return candidates
+
+
+def _cut_points(data, final):
+    # Trả về các điểm cắt (vị trí kết thúc chunk) trong data; nếu chưa phải cuối
+    # file thì phần sau điểm cắt cuối được giữ lại chờ thêm dữ liệu
+    candidates = _cut_candidates(data)
+    cuts = []
+    start = 0
+    index = 0
+    while True:
+        while index < len(candidates) and candidates[index] + 1 - start < MIN_CHUNK_SIZE:
+            index += 1
+        if index < len(candidates) and candidates[index] + 1 - start <= MAX_CHUNK_SIZE:
+            start = candidates[index] + 1
+        elif len(data) - start >= MAX_CHUNK_SIZE:
+            start += MAX_CHUNK_SIZE
+        else:
+            break
+        cuts.append(start)
+    if final and start < len(data):
+        cuts.append(len(data))
+    return cuts
+
+
+def iter_chunks(f, hasher=None):
+    # Đọc file đã mở và sinh (offset, length, sha256 digest) của từng chunk;
+    # hasher (nếu có) nhận toàn bộ nội dung để tính digest cả file trong cùng một lượt đọc
+    pending = bytearray()
+    offset = 0
+    while True:
+        block = f.read(READ_BLOCK_SIZE)
+        if hasher is not None and block:
+            hasher.update(block)
+        pending += block
+        final = not block
+        start = 0
+        view = memoryview(pending)
+        try:
+            for end in _cut_points(pending, final):
+                yield offset, end - start, hashlib.sha256(view[start:end]).digest()
+                offset += end - start
+                start = end
+        finally:
+            view.release()
+        del pending[:start]
+        if final:
+            return
+
+
+def encode_manifest(chunks):
+    return b"".join(CHUNK_RECORD.pack(length, digest) for _, length, digest in chunks)
+
+
+def decode_manifest(data):
+    # Trả về danh sách (offset, length, digest)
+    if len(data) % CHUNK_RECORD.size:
+        raise ValueError("Chunk manifest has a truncated record")
+    chunks = []
+    offset = 0
+    for length, digest in CHUNK_RECORD.iter_unpack(data):
+        chunks.append((offset, length, digest))
+        offset += length
+    return chunks
+
+
+class ChunkIndex:
+    # Chỉ mục chunk phía server: digest -> (tên file, offset, độ dài) trỏ vào các
+    # file hoàn chỉnh trong received_files, nên DOWNLOAD/LIST không đổi gì.
+    # Manifest của từng file lưu ở <state>/chunks/<name>.idx cùng etag; file bị
+    # ghi đè bằng đường khác (etag lệch) sẽ tự bị loại khỏi chỉ mục khi tra cứu.
+    def __init__(self, storage_path):
+        self.storage_path = storage_path
+        self.index_dir = os.path.join(storage_path, STATE_DIR_NAME, "chunks")
+        self.chunks = {}
+        self.files = {}
+        self.lock = threading.Lock()
+        os.makedirs(self.index_dir, exist_ok=True)
+
+    def _index_path(self, name):
+        return os.path.join(self.index_dir, state_name(name) + INDEX_SUFFIX)
+
+    def _current_etag(self, name):
+        try:
+            return file_etag(os.stat(os.path.join(self.storage_path, name)))
+        except OSError:
+            return None
+
+    def load(self):
+        # Nạp các manifest còn khớp với file hiện tại, trả về số file đã nạp
+        for entry in os.scandir(self.index_dir):
+            if not entry.name.endswith(INDEX_SUFFIX):
+                continue
+            name = name_from_state(entry.name[:-len(INDEX_SUFFIX)])
+            try:
+                with open(entry.path, "rb") as f:
+                    etag = f.readline().decode("ascii").strip()
+                    chunks = decode_manifest(f.read())
+            except (OSError, ValueError, UnicodeDecodeError):
+                chunks, etag = None, None
+            if chunks is None or etag != self._current_etag(name):
+                self._remove_index_file(name)
+                continue
+            self._add(name, etag, chunks)
+        return len(self.files)
+
+    def _add(self, name, etag, chunks):
+        with self.lock:
+            self._forget(name)
+            self.files[name] = (etag, chunks)
+            for offset, length, digest in chunks:
+                self.chunks.setdefault(digest, (name, offset, length))
+
+    def _forget(self, name):
+        # Các digest đang trỏ vào file này được chuyển sang file khác có cùng chunk (nếu có)
+        _, chunks = self.files.pop(name, (None, ()))
+        orphaned = set()
+        for _, _, digest in chunks:
+            location = self.chunks.get(digest)
+            if location is not None and location[0] == name:
+                del self.chunks[digest]
+                orphaned.add(digest)
+        if not orphaned:
+            return
+        for other, (_, other_chunks) in self.files.items():
+            for offset, length, digest in other_chunks:
+                if digest in orphaned:
+                    self.chunks[digest] = (other, offset, length)
+                    orphaned.discard(digest)
+            if not orphaned:
+                return
+
+    def _remove_index_file(self, name):
+        try:
+            os.remove(self._index_path(name))
+        except FileNotFoundError:
+            pass
+
+    def add_file(self, name, chunks):
+        # Ghi manifest của một file vừa lưu xong vào đĩa rồi đưa vào chỉ mục
+        etag = self._current_etag(name)
+        if etag is None:
+            return
+        tmp_path = self._index_path(name) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(etag.encode("ascii") + b"\n")
+            f.write(encode_manifest(chunks))
+        os.replace(tmp_path, self._index_path(name))
+        self._add(name, etag, chunks)
+
+    def index_file(self, name):
+        # Chia chunk một file đã có sẵn (vd. upload thường) để lần sau dedup được với nó
+        etag = self._current_etag(name)
+        with self.lock:
+            indexed = self.files.get(name)
+        if etag is None or (indexed is not None and indexed[0] == etag):
+            return False
+        with open(os.path.join(self.storage_path, name), "rb") as f:
+            chunks = list(iter_chunks(f))
+        self.add_file(name, chunks)
+        return True
+
+    def remove_file(self, name):
+        with self.lock:
+            self._forget(name)
+        self._remove_index_file(name)
+
+    def lookup(self, digests):
+        # Trả về vị trí (tên, offset, độ dài) hoặc None cho từng digest. File đã đổi
+        # từ lúc lập chỉ mục bị loại ra rồi tra lại, để chunk của nó chuyển sang
+        # các file khác còn giữ cùng nội dung
+        while True:
+            with self.lock:
+                locations = [self.chunks.get(digest) for digest in digests]
+                indexed = {location[0]: self.files[location[0]][0] for location in locations
+                           if location is not None}
+            # os.stat chạy ngoài khoá, rồi kiểm tra lại: file có thể vừa được lập
+            # chỉ mục lại trong lúc đó
+            stale = [name for name, etag in indexed.items() if self._current_etag(name) != etag]
+            if not stale:
+                return locations
+            for name in stale:
+                with self.lock:
+                    entry = self.files.get(name)
+                    if entry is None or entry[0] != indexed[name]:
+                        continue
+                    self._forget(name)
+                self._remove_index_file(name)
+
+    def copy_chunks(self, f, hasher, chunks):
+        # Chép các chunk đã có từ file nguồn vào f, kiểm tra lại SHA-256 của từng
+        # chunk. chunks: danh sách (digest, (tên, offset, độ dài)).
+        # Trả về False nếu nguồn đã thay đổi (file bị ghi đè giữa chừng)
+        sources = {}
+        try:
+            for digest, (name, offset, length) in chunks:
+                source = sources.get(name)
+                if source is None:
+                    source = sources[name] = open(os.path.join(self.storage_path, name), "rb")
+                source.seek(offset)
+                data = source.read(length)
+                if len(data) != length or hashlib.sha256(data).digest() != digest:
+                    self.remove_file(name)
+                    return False
+                hasher.update(data)
+                f.write(data)
+            return True
+        except FileNotFoundError:
+            return False
+        finally:
+            for source in sources.values():
+                source.close()
@@ -1,10 +1,15 @@
-import socket
 import tkinter as tk
 from tkinter import filedialog, messagebox
 import logging
 import os
 import threading
+import time
 from tkinter import ttk  # Thêm để sử dụng Progressbar
+from guibus import GuiEventBus
+from progress import ProgressReporter, describe
+from transfer_client import ConnectionPool
+from striping import AUTO, StripedTransfer
+from sync import PULL, PUSH, DirectorySync
 
 # Cấu hình logging
 logging.basicConfig(
@@ -13,6 +18,17 @@ logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
+UPLOAD_MODES = ("Full file", "New chunks only", "Delta (rsync)")
+COMPRESSION_OPTIONS = ("none", "zlib:1", "zlib:6", "zlib:9", "lzma:1", "lzma:6", "bz2:9")
+# Danh sách file được tải theo trang khi cuộn gần tới cuối
+LIST_PAGE_SIZE = 200
+LIST_SORTS = {"Name": "name", "Size": "size", "Modified": "mtime"}
+SYNC_DIRECTIONS = {"Upload folder": PUSH, "Download folder": PULL}
+# Số kết nối tối đa tới server: mỗi thao tác đang chạy (upload, download, list...)
+# dùng một kết nối riêng nên chạy song song được
+CONNECTION_POOL_SIZE = 4
+
+
 class FileClientApp:
     def __init__(self, master):
         self.master = master
@@ -22,8 +38,13 @@ class FileClientApp:
         self.server_ip = "192.168.5.98"  # Server IP
         self.server_port = 9999       # Server Port
 
-        self.client_socket = None
+        self.pool = None  # ConnectionPool các TransferClient: kết nối và giao thức, không phụ thuộc GUI
         self.selected_file = None  # Biến để lưu tên file được chọn
+        # Trạng thái danh sách phân trang: tên theo thứ tự dòng, cursor trang sau
+        self.listed_names = []
+        self.list_filters = {}
+        self.list_cursor = None
+        self.list_loading = False
 
         # Giao diện người dùng
         self.status_label = tk.Label(master, text="Status: Disconnected", fg="red", font=("Arial", 12))
@@ -38,11 +59,56 @@ class FileClientApp:
         self.upload_button = tk.Button(master, text="Upload File", command=self.upload_file, state=tk.DISABLED, width=20)
         self.upload_button.pack(pady=5)
 
-        self.list_button = tk.Button(master, text="List Files on Server", command=self.list_files, state=tk.DISABLED, width=20)
-        self.list_button.pack(pady=5)
-
-        self.file_listbox = tk.Listbox(master, width=60, height=15, state=tk.DISABLED)
-        self.file_listbox.pack(pady=10)
+        # Nhiều file trong một yêu cầu: hợp cho hàng nghìn file nhỏ
+        self.batch_upload_button = tk.Button(master, text="Upload Many Files", command=self.upload_batch, state=tk.DISABLED, width=20)
+        self.batch_upload_button.pack(pady=5)
+
+        # Đồng bộ cả thư mục với <tên thư mục>/ trên server; mirror xoá file thừa ở phía đích
+        sync_frame = tk.Frame(master)
+        sync_frame.pack(pady=5)
+        self.sync_button = tk.Button(sync_frame, text="Sync Folder", command=self.sync_folder, state=tk.DISABLED, width=20)
+        self.sync_button.pack(side=tk.LEFT)
+        self.sync_direction_var = tk.StringVar(value="Upload folder")
+        tk.OptionMenu(sync_frame, self.sync_direction_var, *SYNC_DIRECTIONS).pack(side=tk.LEFT, padx=(10, 0))
+        self.sync_mirror_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(sync_frame, text="Mirror (delete extra files)", variable=self.sync_mirror_var).pack(side=tk.LEFT)
+
+        # Số kết nối song song cho mỗi file: 1 là upload/download thường (có resume)
+        self.stripes_var = tk.StringVar(value="1")
+        stripes_frame = tk.Frame(master)
+        stripes_frame.pack(pady=5)
+        tk.Label(stripes_frame, text="Parallel streams:").pack(side=tk.LEFT)
+        tk.OptionMenu(stripes_frame, self.stripes_var, "1", "2", "4", "8", AUTO).pack(side=tk.LEFT)
+        # Cách upload khi chỉ dùng một luồng: cả file, chỉ các chunk server chưa có,
+        # hoặc delta so với bản cùng tên đang lưu (hữu ích khi upload lại bản gần giống)
+        self.upload_mode_var = tk.StringVar(value=UPLOAD_MODES[0])
+        tk.Label(stripes_frame, text="Upload mode:").pack(side=tk.LEFT, padx=(10, 0))
+        tk.OptionMenu(stripes_frame, self.upload_mode_var, *UPLOAD_MODES).pack(side=tk.LEFT)
+        # Nén body khi upload cả file / download (server tự tắt nếu dữ liệu không nén được)
+        self.compression_var = tk.StringVar(value="none")
+        tk.Label(stripes_frame, text="Compression:").pack(side=tk.LEFT, padx=(10, 0))
+        tk.OptionMenu(stripes_frame, self.compression_var, *COMPRESSION_OPTIONS).pack(side=tk.LEFT)
+
+        # Lọc theo prefix, hoặc glob nếu có ký tự *, ? hay [ (vd. *.txt)
+        list_frame = tk.Frame(master)
+        list_frame.pack(pady=5)
+        self.list_button = tk.Button(list_frame, text="List Files on Server", command=self.list_files, state=tk.DISABLED, width=20)
+        self.list_button.pack(side=tk.LEFT)
+        tk.Label(list_frame, text="Filter:").pack(side=tk.LEFT, padx=(10, 0))
+        self.list_filter_var = tk.StringVar()
+        tk.Entry(list_frame, textvariable=self.list_filter_var, width=15).pack(side=tk.LEFT)
+        tk.Label(list_frame, text="Sort by:").pack(side=tk.LEFT, padx=(10, 0))
+        self.list_sort_var = tk.StringVar(value="Name")
+        tk.OptionMenu(list_frame, self.list_sort_var, *LIST_SORTS).pack(side=tk.LEFT)
+
+        listbox_frame = tk.Frame(master)
+        listbox_frame.pack(pady=10)
+        self.file_scrollbar = tk.Scrollbar(listbox_frame, orient=tk.VERTICAL)
+        self.file_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.file_listbox = tk.Listbox(listbox_frame, width=60, height=15, state=tk.DISABLED,
+                                       yscrollcommand=self.on_list_scroll)
+        self.file_listbox.pack(side=tk.LEFT)
+        self.file_scrollbar.config(command=self.file_listbox.yview)
         # Bind cả double-click và single-click để đảm bảo chọn file
         self.file_listbox.bind('<Double-1>', self.select_file)
         self.file_listbox.bind('<ButtonRelease-1>', self.select_file)
@@ -53,22 +119,34 @@ class FileClientApp:
         # Thêm Progress Bars
         self.upload_progress = ttk.Progressbar(master, orient='horizontal', length=600, mode='determinate')
         self.upload_progress.pack(pady=5)
+        self.upload_status = tk.Label(master, text="")
+        self.upload_status.pack()
 
         self.download_progress = ttk.Progressbar(master, orient='horizontal', length=600, mode='determinate')
         self.download_progress.pack(pady=5)
+        self.download_status = tk.Label(master, text="")
+        self.download_status.pack()
+        # Nhãn tốc độ / thời gian còn lại dưới mỗi thanh tiến trình
+        self.progress_labels = {self.upload_progress: self.upload_status, self.download_progress: self.download_status}
+
+        # Cập nhật giao diện từ các thread upload/download/list đi qua bus, áp dụng theo nhịp trên thread Tk
+        self.bus = GuiEventBus(master)
 
         # Đăng ký phương thức đóng ứng dụng
         self.master.protocol("WM_DELETE_WINDOW", self.on_closing)
 
     def connect_to_server(self):
-        if self.client_socket:
+        if self.pool:
             messagebox.showinfo("Info", "Already connected to the server.")
             return
         try:
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client_socket.connect((self.server_ip, self.server_port))
+            self.pool = ConnectionPool(self.server_ip, self.server_port, size=CONNECTION_POOL_SIZE)
+            # Mở sẵn một kết nối để báo lỗi ngay nếu không tới được server
+            self.pool.release(self.pool.acquire())
             self.status_label.config(text="Status: Connected", fg="green")
             self.upload_button.config(state=tk.NORMAL)
+            self.batch_upload_button.config(state=tk.NORMAL)
+            self.sync_button.config(state=tk.NORMAL)
             self.list_button.config(state=tk.NORMAL)
             self.disconnect_button.config(state=tk.NORMAL)
             self.connect_button.config(state=tk.DISABLED)
@@ -77,23 +155,26 @@ class FileClientApp:
         except Exception as e:
             logging.error(f"Failed to connect to server: {e}")
             messagebox.showerror("Error", f"Failed to connect to server: {e}")
-            self.client_socket = None
+            self.pool.close()
+            self.pool = None
 
     def disconnect_from_server(self):
-        if self.client_socket:
+        if self.pool:
             try:
-                self.client_socket.close()
-                self.client_socket = None
+                self.pool.close()
+                self.pool = None
                 self.status_label.config(text="Status: Disconnected", fg="red")
                 self.upload_button.config(state=tk.DISABLED)
+                self.batch_upload_button.config(state=tk.DISABLED)
+                self.sync_button.config(state=tk.DISABLED)
                 self.list_button.config(state=tk.DISABLED)
                 self.download_button.config(state=tk.DISABLED)
                 self.file_listbox.config(state=tk.DISABLED)
                 self.disconnect_button.config(state=tk.DISABLED)
                 self.connect_button.config(state=tk.NORMAL)
                 self.selected_file = None  # Reset selected file
-                self.upload_progress['value'] = 0
-                self.download_progress['value'] = 0
+                self.show_progress(self.upload_progress, 0)
+                self.show_progress(self.download_progress, 0)
                 logging.info("Disconnected from server.")
                 messagebox.showinfo("Disconnected", "You have been disconnected from the server.")
             except Exception as e:
@@ -104,95 +185,211 @@ class FileClientApp:
         if not self.is_connected():
             messagebox.showerror("Error", "Not connected to the server.")
             return
-        threading.Thread(target=self._upload_file, daemon=True).start()
+        # Hộp thoại và biến Tk chỉ được dùng trên thread Tk; thread upload nhận giá trị đã đọc
+        file_path = filedialog.askopenfilename()
+        if not file_path:
+            return
+        threading.Thread(target=self._upload_file, daemon=True,
+                         args=(file_path, self.upload_mode_var.get(), self.compression_var.get(),
+                               self.stripes_var.get())).start()
 
-    def _upload_file(self):
+    def _upload_file(self, file_path, upload_mode, compression, stripes):
         try:
-            file_path = filedialog.askopenfilename()
-            if not file_path:
-                return
-
             file_name = os.path.basename(file_path)
             file_size = os.path.getsize(file_path)
 
             logging.info(f"Starting upload for file: {file_name} with size: {file_size} bytes")
 
             # Reset Progress Bar
-            self.upload_progress['value'] = 0
-            self.upload_progress['maximum'] = file_size
-
-            # Gửi lệnh UPLOAD với định dạng đúng (UPLOAD filename filesize)
-            upload_command = f"UPLOAD {file_name} {file_size}\n"  # Thêm '\n' nếu server mong đợi
-            self.client_socket.sendall(upload_command.encode('utf-8'))
-
-            with open(file_path, "rb") as f:
-                total_bytes_sent = 0
-                while True:
-                    chunk = f.read(4096)
-                    if not chunk:
-                        break
-                    self.client_socket.sendall(chunk)
-                    total_bytes_sent += len(chunk)
-                    self.upload_progress['value'] = total_bytes_sent
-                    self.master.update_idletasks()
-
-            logging.info(f"File '{file_name}' uploaded successfully. Total bytes sent: {total_bytes_sent}")
-
-            # Nhận phản hồi từ server
-            response = self.recv_line().strip()
-            logging.info(f"Received response: {response} for file: {file_name}")
+            self.show_progress(self.upload_progress, 0, file_size)
+
+            striped = self.striped_transfer(self.upload_progress, stripes)
+            if striped is not None:
+                reply = striped.upload(file_path)
+            else:
+                with self.pool.connection() as client:
+                    if upload_mode == "New chunks only":
+                        reply = client.upload_chunked(file_path, progress=self.progress_callback(self.upload_progress))
+                    elif upload_mode == "Delta (rsync)":
+                        reply = client.upload_delta(file_path, progress=self.progress_callback(self.upload_progress))
+                    else:
+                        # Upload có thể resume: server báo đã có bao nhiêu byte từ lần trước
+                        reply = client.upload(file_path, progress=self.progress_callback(self.upload_progress),
+                                              compression=compression)
+            response = reply.get("status")
+            logging.info(f"Received response: {reply} for file: {file_name}")
 
             if response == "UPLOAD_SUCCESS":
                 logging.info(f"Server confirmed upload success for file: {file_name}")
-                messagebox.showinfo("Success", f"File '{file_name}' uploaded successfully.")
+                if reply.get("dedup_ratio"):
+                    self.bus.post(messagebox.showinfo, "Success", f"File '{file_name}' uploaded successfully ({reply['transferred']} bytes sent, dedup ratio {reply['dedup_ratio']:.1f}).")
+                elif "matched" in reply:
+                    self.bus.post(messagebox.showinfo, "Success", f"File '{file_name}' uploaded successfully ({reply['transferred']} bytes sent, {reply['matched']} bytes reused).")
+                elif reply.get("resumed_from"):
+                    self.bus.post(messagebox.showinfo, "Success", f"File '{file_name}' uploaded successfully (resumed from byte {reply['resumed_from']}).")
+                else:
+                    self.bus.post(messagebox.showinfo, "Success", f"File '{file_name}' uploaded successfully.")
             else:
-                logging.warning(f"Server response: {response} for file: {file_name}")
-                messagebox.showerror("Error", f"Failed to upload file. Server response: {response}")
-
-            # Kiểm tra xem tất cả byte đã được gửi thành công
-            if total_bytes_sent != file_size:
-                logging.warning(f"Mismatch in file size. Sent: {total_bytes_sent}, Expected: {file_size}")
-                messagebox.showwarning("Warning", "Mismatch in file size. Upload may be incomplete.")
+                logging.warning(f"Server response: {reply} for file: {file_name}")
+                self.bus.post(messagebox.showerror, "Error", f"Failed to upload file. Server response: {reply.get('message', response)}")
 
             # Reset Progress Bar sau khi hoàn thành
-            self.upload_progress['value'] = 0
+            self.show_progress(self.upload_progress, 0)
 
         except Exception as e:
             logging.error(f"Error uploading file: {e}")
-            messagebox.showerror("Error", f"Failed to upload file: {e}")
-            self.upload_progress['value'] = 0
+            self.bus.post(messagebox.showerror, "Error", f"Failed to upload file: {e}. Upload again to resume.")
+            self.show_progress(self.upload_progress, 0)
 
-    def list_files(self):
+    def upload_batch(self):
         if not self.is_connected():
             messagebox.showerror("Error", "Not connected to the server.")
             return
-        threading.Thread(target=self._list_files, daemon=True).start()
+        file_paths = filedialog.askopenfilenames()
+        if not file_paths:
+            return
+        threading.Thread(target=self._upload_batch, args=(file_paths,), daemon=True).start()
 
-    def _list_files(self):
+    def _upload_batch(self, file_paths):
         try:
-            self.client_socket.sendall(b"LIST\n")  # Thêm '\n' nếu server mong đợi
-            logging.info("Requesting file list from server")
-            file_list = self.client_socket.recv(4096).decode("utf-8")
-            files = [f.strip() for f in file_list.split("|") if f.strip()]  # Loại bỏ chuỗi rỗng và khoảng trắng
-
-            self.file_listbox.config(state=tk.NORMAL)
-            self.file_listbox.delete(0, tk.END)
-            for file in files:
-                self.file_listbox.insert(tk.END, file)
-            self.file_listbox.config(state=tk.NORMAL)  # Cho phép tương tác
-
-            self.selected_file = None  # Reset khi danh sách file được cập nhật
-
-            if files:
-                logging.info(f"Received file list: {files}")
-                self.download_button.config(state=tk.DISABLED)  # Chưa có file nào được chọn
+            logging.info(f"Starting batch upload of {len(file_paths)} file(s)")
+            self.show_progress(self.upload_progress, 0)
+            with self.pool.connection() as client:
+                reply = client.upload_batch(file_paths, progress=self.progress_callback(self.upload_progress))
+            logging.info(f"Received response: { {k: v for k, v in reply.items() if k != 'results'} }")
+
+            if reply.get("status") == "BATCH_DONE":
+                rejected = [f"{name}: {status}" for name, status, _ in reply["results"] if status != "STORED"]
+                for line in rejected:
+                    logging.warning(f"Batch upload rejected {line}")
+                if rejected:
+                    self.bus.post(messagebox.showwarning, "Partial Success", f"{reply['stored']} of {reply['count']} file(s) uploaded. "
+                                  f"Rejected: {', '.join(rejected[:10])}" + (" ..." if len(rejected) > 10 else ""))
+                else:
+                    self.bus.post(messagebox.showinfo, "Success", f"{reply['stored']} file(s) uploaded successfully.")
+            else:
+                logging.warning(f"Server response: {reply}")
+                self.bus.post(messagebox.showerror, "Error", f"Failed to upload files. Server response: {reply.get('message', reply.get('status'))}")
+            self.show_progress(self.upload_progress, 0)
+        except Exception as e:
+            logging.error(f"Error during batch upload: {e}")
+            self.bus.post(messagebox.showerror, "Error", f"Failed to upload files: {e}")
+
+    def sync_folder(self):
+        if not self.is_connected():
+            messagebox.showerror("Error", "Not connected to the server.")
+            return
+        local_dir = filedialog.askdirectory()
+        if not local_dir:
+            return
+        threading.Thread(target=self._sync_folder, daemon=True,
+                         args=(local_dir, SYNC_DIRECTIONS[self.sync_direction_var.get()],
+                               self.sync_mirror_var.get())).start()
+
+    def _sync_folder(self, local_dir, direction, mirror):
+        try:
+            remote_prefix = os.path.basename(os.path.normpath(local_dir))
+            progress_bar = self.upload_progress if direction == PUSH else self.download_progress
+            self.show_progress(progress_bar, 0)
+            sync = DirectorySync(self.server_ip, self.server_port, mirror=mirror,
+                                 progress=self.progress_callback(progress_bar))
+            logging.info(f"Starting {direction} sync of '{local_dir}' with '{remote_prefix}/'")
+            if direction == PUSH:
+                report = sync.push(local_dir, remote_prefix)
+            else:
+                report = sync.pull(local_dir, remote_prefix)
+            logging.info(f"Sync report: {report}")
+            summary = (f"{report['transferred']} of {report['files']} file(s) transferred ({report['bytes']} bytes), "
+                       f"{report['deleted']} deleted.\nManifest diff: {report['manifest_seconds']:.2f} s, "
+                       f"transfer: {report['transfer_seconds']:.2f} s.")
+            if report["status"] == "SYNC_DONE":
+                self.bus.post(messagebox.showinfo, "Sync Complete", summary)
+            else:
+                self.bus.post(messagebox.showwarning, "Sync Incomplete", f"{summary}\n{len(report['failures'])} operation(s) failed; see the log.")
+            self.show_progress(progress_bar, 0)
+        except Exception as e:
+            logging.error(f"Error during folder sync: {e}")
+            self.bus.post(messagebox.showerror, "Error", f"Failed to sync folder: {e}")
+
+    def list_files(self):
+        if not self.is_connected():
+            messagebox.showerror("Error", "Not connected to the server.")
+            return
+        text = self.list_filter_var.get().strip()
+        if any(c in text for c in "*?["):
+            filters = {"pattern": text}
+        else:
+            filters = {"prefix": text} if text else {}
+        filters["sort"] = LIST_SORTS[self.list_sort_var.get()]
+        filters["reverse"] = filters["sort"] != "name"  # Lớn nhất/mới nhất trước
+        self.list_loading = True
+        threading.Thread(target=self._list_files, args=(filters,), daemon=True).start()
+
+    def _list_files(self, filters):
+        try:
+            logging.info(f"Requesting file list from server: {filters}")
+            with self.pool.connection() as client:
+                entries, cursor, total = client.list_page(limit=LIST_PAGE_SIZE, **filters)
+            if entries:
+                logging.info(f"Received first {len(entries)} of {total} file(s)")
             else:
                 logging.info("No files found on the server.")
-                self.download_button.config(state=tk.DISABLED)
-                messagebox.showinfo("Info", "No files found on the server.")
+            self.bus.post(self.show_file_list, filters, entries, cursor)
+        except Exception as e:
+            logging.error(f"Error listing files: {e}")
+            self.bus.post(self.show_list_error, e)
+
+    def show_file_list(self, filters, entries, cursor):
+        self.file_listbox.config(state=tk.NORMAL)  # Cho phép tương tác
+        self.file_listbox.delete(0, tk.END)
+        self.listed_names = []
+        self.list_filters = filters
+        self.list_cursor = cursor
+        self.append_list_entries(entries)
+        self.list_loading = False
+
+        self.selected_file = None  # Reset khi danh sách file được cập nhật
+        self.download_button.config(state=tk.DISABLED)  # Chưa có file nào được chọn
+        if not entries:
+            messagebox.showinfo("Info", "No files found on the server.")
+
+    def show_list_error(self, error):
+        self.list_loading = False
+        messagebox.showerror("Error", f"Failed to list files: {error}")
+
+    def append_list_entries(self, entries):
+        rows = []
+        for name, size, mtime_ns in entries:
+            self.listed_names.append(name)
+            modified = time.strftime("%Y-%m-%d %H:%M", time.localtime(mtime_ns / 1e9))
+            rows.append(f"{name}    ({size:,} bytes, {modified})")
+        if rows:
+            self.file_listbox.insert(tk.END, *rows)
+
+    def on_list_scroll(self, first, last):
+        # Cuộn tới gần cuối danh sách đã tải thì mới yêu cầu trang kế tiếp
+        self.file_scrollbar.set(first, last)
+        if float(last) >= 0.9 and self.list_cursor is not None and not self.list_loading and self.is_connected():
+            self.list_loading = True
+            threading.Thread(target=self._load_next_page, args=(self.list_cursor, self.list_filters),
+                             daemon=True).start()
+
+    def _load_next_page(self, cursor, filters):
+        try:
+            with self.pool.connection() as client:
+                entries, cursor, _ = client.list_page(limit=LIST_PAGE_SIZE, cursor=cursor, **filters)
+            logging.info(f"Loaded {len(entries)} more file(s)")
         except Exception as e:
             logging.error(f"Error listing files: {e}")
-            messagebox.showerror("Error", f"Failed to list files: {e}")
+            entries, cursor = [], None
+        self.bus.post(self.show_next_page, filters, entries, cursor)
+
+    def show_next_page(self, filters, entries, cursor):
+        if filters is not self.list_filters:
+            return  # Danh sách đã được tải lại trong lúc chờ trang này
+        self.append_list_entries(entries)
+        self.list_cursor = cursor
+        self.list_loading = False
 
     def select_file(self, event):
         logging.info("select_file method called.")
@@ -200,7 +397,7 @@ class FileClientApp:
         if not selection:
             logging.info("No selection made.")
             return
-        selected_file = self.file_listbox.get(selection[0])
+        selected_file = self.listed_names[selection[0]]
         self.selected_file = selected_file  # Lưu tên file được chọn
         logging.info(f"File selected: {selected_file}")
         # messagebox.showinfo("File Selected", f"Selected File: {selected_file}")
@@ -216,98 +413,98 @@ class FileClientApp:
             messagebox.showerror("Error", "No file selected.")
             logging.warning("Download attempted without selecting a file.")
             return
-        threading.Thread(target=self._download_file, daemon=True).start()
+        file_name = self.selected_file
+        # Chọn nơi lưu trước: nếu đã có <file>.part từ lần tải dở, tải tiếp từ đó
+        save_path = filedialog.asksaveasfilename(
+            defaultextension="", initialfile=file_name
+        )
+        if not save_path:
+            logging.warning(f"Download cancelled for file: {file_name}")
+            return
+        threading.Thread(target=self._download_file, daemon=True,
+                         args=(file_name, save_path, self.compression_var.get(), self.stripes_var.get())).start()
 
-    def _download_file(self):
+    def _download_file(self, file_name, save_path, compression, stripes):
         try:
-            file_name = self.selected_file
             logging.info(f"Requesting download for file: {file_name}")
-            self.client_socket.sendall(f"DOWNLOAD {file_name}\n".encode())  # Thêm '\n' nếu server mong đợi
-
-            # Đọc phản hồi dòng từ server
-            response = self.recv_line().strip()
-            logging.info(f"Received response: {response}")
-
-            if response.startswith("FILE_FOUND"):
-                parts = response.split()
-                if len(parts) != 2:
-                    logging.error(f"Invalid FILE_FOUND response format: {response}")
-                    messagebox.showerror("Error", "Invalid response from server.")
-                    return
-                _, filesize_str = parts
-                try:
-                    filesize = int(filesize_str)
-                except ValueError:
-                    logging.error(f"Invalid filesize in response: {filesize_str}")
-                    messagebox.showerror("Error", "Invalid filesize received from server.")
-                    return
-
-                save_path = filedialog.asksaveasfilename(
-                    defaultextension="", initialfile=file_name
-                )
-                if not save_path:
-                    logging.warning(f"Download cancelled for file: {file_name}")
-                    return
-
-                # Thiết lập Progress Bar
-                self.download_progress['value'] = 0
-                self.download_progress['maximum'] = filesize
-
-                total_bytes = 0
-                with open(save_path, "wb") as f:
-                    while total_bytes < filesize:
-                        data = self.client_socket.recv(min(4096, filesize - total_bytes))
-                        if not data:
-                            break
-                        f.write(data)
-                        total_bytes += len(data)
-                        self.download_progress['value'] = total_bytes
-                        self.master.update_idletasks()
-
-                if total_bytes == filesize:
-                    logging.info(f"File '{file_name}' downloaded successfully. Total bytes: {total_bytes}")
-                    messagebox.showinfo("Success", f"File '{file_name}' downloaded successfully.")
+            self.show_progress(self.download_progress, 0)
+            striped = self.striped_transfer(self.download_progress, stripes)
+            if striped is not None:
+                result = striped.download(file_name, save_path)
+            else:
+                with self.pool.connection() as client:
+                    result = client.download(file_name, save_path, progress=self.progress_callback(self.download_progress),
+                                             compression=compression)
+            response = result.get("status")
+            logging.info(f"Received response: {result}")
+
+            if response == "DOWNLOAD_SUCCESS":
+                logging.info(f"File '{file_name}' downloaded successfully. Total bytes: {result['received']}"
+                             + (f", sha256 {result['sha256']} verified" if result.get("verified") else ""))
+                if result.get("resumed_from"):
+                    self.bus.post(messagebox.showinfo, "Success", f"File '{file_name}' downloaded successfully (resumed from byte {result['resumed_from']}).")
                 else:
-                    logging.warning(f"Incomplete download for file '{file_name}'. Expected {filesize}, got {total_bytes}.")
-                    messagebox.showerror("Error", f"Incomplete download for file '{file_name}'.")
-
-                # Reset Progress Bar sau khi hoàn thành
-                self.download_progress['value'] = 0
-
+                    self.bus.post(messagebox.showinfo, "Success", f"File '{file_name}' downloaded successfully.")
+            elif response == "DOWNLOAD_CORRUPT":
+                logging.error(f"Checksum mismatch for file '{file_name}': expected sha256 {result.get('sha256')}.")
+                self.bus.post(messagebox.showerror, "Error", f"File '{file_name}' failed checksum verification and was discarded. Download again.")
+            elif response == "DOWNLOAD_INCOMPLETE":
+                logging.warning(f"Incomplete download for file '{file_name}'. Expected {result['filesize']}, got {result['received']}.")
+                self.bus.post(messagebox.showerror, "Error", f"Incomplete download for file '{file_name}'. Download again to resume.")
+            elif response == "BUSY":
+                logging.warning(f"Server busy, download of '{file_name}' rejected: {result}")
+                self.bus.post(messagebox.showerror, "Server Busy", result.get("message", "Server is busy. Try again later."))
             elif response == "FILE_NOT_FOUND":
                 logging.error(f"File '{file_name}' not found on server.")
-                messagebox.showerror("Error", f"File '{file_name}' not found on server.")
+                self.bus.post(messagebox.showerror, "Error", f"File '{file_name}' not found on server.")
             else:
-                logging.error(f"Unexpected response during download: {response}")
-                messagebox.showerror("Error", "Unexpected error during download.")
+                logging.error(f"Unexpected response during download: {result}")
+                self.bus.post(messagebox.showerror, "Error", "Unexpected error during download.")
+
+            # Reset Progress Bar sau khi hoàn thành
+            self.show_progress(self.download_progress, 0)
         except Exception as e:
             logging.error(f"Error during download: {e}")
-            messagebox.showerror("Error", f"Failed to download file: {e}")
+            self.bus.post(messagebox.showerror, "Error", f"Failed to download file: {e}. Download again to resume.")
 
         # Reset selected_file sau khi download
+        self.bus.post(self.clear_selection)
+
+    def clear_selection(self):
         self.selected_file = None
         self.download_button.config(state=tk.DISABLED)
 
-    def recv_line(self):
-        line = ""
-        while True:
-            try:
-                char = self.client_socket.recv(1).decode('utf-8')
-                if not char:
-                    break
-                if char == '\n':
-                    break
-                line += char
-            except Exception as e:
-                logging.error(f"Error receiving line: {e}")
-                break
-        return line
+    def show_progress(self, progress_bar, done, total=None, status=""):
+        # Gọi được từ thread bất kỳ: chỉ giá trị cuối cùng trong mỗi nhịp của bus được vẽ
+        self.bus.post_latest(progress_bar, self.set_progress, progress_bar, done, total, status)
+
+    def set_progress(self, progress_bar, done, total, status):
+        if total is not None:
+            progress_bar['maximum'] = total
+        progress_bar['value'] = done
+        self.progress_labels[progress_bar].config(text=status)
+
+    def progress_callback(self, progress_bar):
+        # Vòng lặp transfer gọi reporter sau mỗi block; thanh tiến trình chỉ
+        # nhận cập nhật đã được giới hạn tần suất, kèm tốc độ và ETA
+        def update(progress):
+            self.show_progress(progress_bar, progress.done, progress.total, describe(progress))
+        return ProgressReporter(update)
+
+    def striped_transfer(self, progress_bar, stripes):
+        # Nhiều luồng song song: mỗi luồng mở kết nối riêng tới server
+        if stripes == "1":
+            return None
+        return StripedTransfer(self.server_ip, self.server_port,
+                               stripes=AUTO if stripes == AUTO else int(stripes),
+                               progress=self.progress_callback(progress_bar))
 
     def is_connected(self):
-        return self.client_socket is not None
+        return self.pool is not None
 
     def on_closing(self):
         self.disconnect_from_server()
+        self.bus.close()
         self.master.destroy()
 
 
@@ -0,0 +1,97 @@
+import bz2
+import lzma
+import zlib
+
+# Nén từng frame DATA độc lập (một khối buffer mỗi frame): bên nhận giải nén được
+# ngay khi nhận đủ frame, và bên gửi có thể gửi thô bất cứ lúc nào bằng cách bỏ cờ.
+CODECS = {
+    "zlib": (lambda data, level: zlib.compress(data, level), zlib.decompressobj, range(0, 10), 6),
+    "lzma": (lambda data, level: lzma.compress(data, preset=level), lzma.LZMADecompressor, range(0, 10), 1),
+    "bz2": (lambda data, level: bz2.compress(data, level), bz2.BZ2Decompressor, range(1, 10), 9),
+}
+COMPRESSION_CHOICES = ("none",) + tuple(CODECS)
+
+# Số khối đầu được nén thử; nếu tiết kiệm không quá 10% thì tắt nén cho phần còn lại
+SAMPLE_BLOCKS = 4
+MIN_SAVING = 0.10
+# Frame nén không được lớn hơn mức này (buffer tối đa + phần mào đầu của codec)
+MAX_COMPRESSED_FRAME = 17 * 1024 * 1024
+
+
+def parse_compression(spec):
+    # "zlib", "zlib:9", "lzma:1"... -> (codec, level); None hoặc "none" -> None
+    if spec is None or spec == "none":
+        return None
+    if not isinstance(spec, str):
+        raise ValueError(f"Invalid compression: {spec!r}")
+    codec, _, level = spec.partition(":")
+    if codec not in CODECS:
+        raise ValueError(f"Unsupported compression codec: {codec}")
+    _, _, levels, default_level = CODECS[codec]
+    try:
+        level = int(level) if level else default_level
+    except ValueError:
+        raise ValueError(f"Invalid compression level: {level}")
+    if level not in levels:
+        raise ValueError(f"Compression level for {codec} must be between {levels[0]} and {levels[-1]}")
+    return codec, level
+
+
+def format_compression(setting):
+    return None if setting is None else f"{setting[0]}:{setting[1]}"
+
+
+class BlockCompressor:
+    # Nén từng khối; sau SAMPLE_BLOCKS khối mà không tiết kiệm đủ thì chuyển sang
+    # gửi thô (dữ liệu đã nén sẵn: zip, jpg, mp4...)
+    def __init__(self, setting):
+        self.codec, self.level = setting
+        self.compress = CODECS[self.codec][0]
+        self.enabled = True
+        self.sampled = 0
+        self.sample_logical = 0
+        self.sample_wire = 0
+        self.logical_bytes = 0
+        self.wire_bytes = 0
+
+    def encode(self, block):
+        # Trả về (payload, đã nén hay chưa)
+        payload, compressed = block, False
+        if self.enabled and len(block):
+            candidate = self.compress(bytes(block), self.level)
+            if len(candidate) < len(block):
+                payload, compressed = candidate, True
+            if self.sampled < SAMPLE_BLOCKS:
+                self.sampled += 1
+                self.sample_logical += len(block)
+                self.sample_wire += len(payload)
+                if self.sampled == SAMPLE_BLOCKS and self.sample_wire > self.sample_logical * (1 - MIN_SAVING):
+                    self.enabled = False
+        self.logical_bytes += len(block)
+        self.wire_bytes += len(payload)
+        return payload, compressed
+
+
+class BlockDecoder:
+    # Giải nén các frame có cờ nén; đếm byte trên đường truyền và byte thực của file
+    def __init__(self, setting):
+        self.codec = setting[0]
+        self.decompressor_class = CODECS[self.codec][1]
+        self.logical_bytes = 0
+        self.wire_bytes = 0
+
+    def decode(self, payload, limit):
+        # Giải nén một frame, không bao giờ tạo ra quá `limit` byte (chống bom nén)
+        decompressor = self.decompressor_class()
+        data = decompressor.decompress(payload, limit + 1)
+        if len(data) > limit:
+            raise ValueError(f"Compressed frame expands beyond the expected {limit} bytes")
+        if not decompressor.eof:
+            raise ValueError("Truncated compressed frame")
+        self.wire_bytes += len(payload)
+        self.logical_bytes += len(data)
+        return data
+
+    def count_raw(self, length):
+        self.wire_bytes += length
+        self.logical_bytes += length
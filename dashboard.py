@@ -0,0 +1,177 @@
+import csv
+import time
+from collections import deque
+
+import numpy as np
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from matplotlib.figure import Figure
+
+# Số transfer gần nhất được vẽ, và số lần vẽ lại tối đa mỗi giây
+DEFAULT_WINDOW = 500
+DEFAULT_FPS = 4
+# Trục được nới thêm khoảng trống này khi dữ liệu vượt giới hạn, để phần lớn
+# các lần vẽ không phải đổi trục và chỉ cần blit các artist
+AXIS_HEADROOM = 1.25
+
+
+def read_log_tail(log_file, window=DEFAULT_WINDOW):
+    # Các dòng cuối của transfer log: [(thứ tự transfer, kích thước, thời gian, latency ms)]
+    rows = deque(maxlen=window)
+    try:
+        with open(log_file, "r", encoding="utf-8", errors="replace", newline="") as f:
+            for number, row in enumerate(csv.DictReader(f), 1):
+                try:
+                    rows.append((number, int(row["FileSize"]), float(row["Duration"]), float(row["Latency"])))
+                except (KeyError, TypeError, ValueError):
+                    continue
+    except OSError:
+        pass
+    return list(rows)
+
+
+class TransferGraphs:
+    # Ba biểu đồ (tốc độ, kích thước / thời gian, latency) trên một Figure dùng
+    # suốt vòng đời ứng dụng: điểm mới được thêm vào các artist sẵn có, chỉ giữ
+    # `window` điểm gần nhất. Trục chỉ đổi khi dữ liệu vượt ra ngoài; còn lại
+    # chỉ vẽ lại các artist lên nền đã lưu (blit)
+    def __init__(self, figure, window=DEFAULT_WINDOW):
+        self.figure = figure
+        self.window = window
+        self.numbers = deque(maxlen=window)
+        self.speeds = deque(maxlen=window)
+        self.sizes = deque(maxlen=window)
+        self.durations = deque(maxlen=window)
+        self.latencies = deque(maxlen=window)
+        self.count = 0
+        self.background = None
+        self.full_draws = 0
+        self.blits = 0
+
+        self.ax_speed, self.ax_size, self.ax_latency = figure.subplots(1, 3)
+        self.speed_line, = self.ax_speed.plot([], [], marker='o', markersize=3, linestyle='-', color='blue')
+        self.ax_speed.set_title("Transmission speed")
+        self.ax_speed.set_xlabel("Transfer Number")
+        self.ax_speed.set_ylabel("Speed (bytes/second)")
+        self.size_points = self.ax_size.scatter([], [], s=12, color='green')
+        self.ax_size.set_title("File Size vs. Transfer Time")
+        self.ax_size.set_xlabel("File Size (bytes)")
+        self.ax_size.set_ylabel("Transfer Time (seconds)")
+        self.latency_line, = self.ax_latency.plot([], [], marker='o', markersize=3, linestyle='-', color='purple')
+        self.ax_latency.set_title("Latency Over Transfers")
+        self.ax_latency.set_xlabel("Transfer Number")
+        self.ax_latency.set_ylabel("Latency (ms)")
+        self.artists = (self.speed_line, self.size_points, self.latency_line)
+        for ax in (self.ax_speed, self.ax_size, self.ax_latency):
+            ax.grid(True)
+            ax.set_xlim(0, 1)
+            ax.set_ylim(0, 1)
+        for artist in self.artists:
+            artist.set_animated(True)
+        figure.tight_layout()
+
+    def add(self, filesize, duration, latency, number=None):
+        # Trả về False nếu điểm bị bỏ qua (như bản cũ: chỉ vẽ transfer có kích thước và thời gian > 0)
+        self.count = number if number is not None else self.count + 1
+        if filesize <= 0 or duration <= 0:
+            return False
+        self.numbers.append(self.count)
+        self.speeds.append(filesize / duration)
+        self.sizes.append(filesize)
+        self.durations.append(duration)
+        self.latencies.append(latency)
+        return True
+
+    @staticmethod
+    def _fit(ax, axis, high):
+        # Trục từ 0: nới khi dữ liệu vượt giới hạn, thu lại khi dữ liệu chỉ còn
+        # dùng chưa tới 1/AXIS_HEADROOM^2 khoảng. Trả về True nếu đã đổi
+        get_limits, set_limits = getattr(ax, f"get_{axis}lim"), getattr(ax, f"set_{axis}lim")
+        current = get_limits()[1]
+        if current >= high and high * AXIS_HEADROOM ** 2 >= current:
+            return False
+        set_limits(0, high * AXIS_HEADROOM or 1)
+        return True
+
+    def _update_limits(self):
+        if not self.numbers:
+            return False
+        changed = False
+        first, last = self.numbers[0], self.numbers[-1]
+        # Trục thứ tự transfer rộng hơn cửa sổ 1/4, nên chỉ trượt sau mỗi 1/4 cửa sổ điểm mới
+        low, high = self.ax_speed.get_xlim()
+        if first < low or last > high:
+            for ax in (self.ax_speed, self.ax_latency):
+                ax.set_xlim(first, first + self.window * AXIS_HEADROOM)
+            changed = True
+        changed |= self._fit(self.ax_speed, "y", max(self.speeds))
+        changed |= self._fit(self.ax_latency, "y", max(self.latencies))
+        changed |= self._fit(self.ax_size, "x", max(self.sizes))
+        changed |= self._fit(self.ax_size, "y", max(self.durations))
+        return changed
+
+    def render(self, canvas):
+        # Cập nhật dữ liệu của các artist rồi vẽ: đổi trục thì vẽ lại toàn bộ và
+        # lưu nền mới, không thì chỉ blit
+        self.speed_line.set_data(self.numbers, self.speeds)
+        self.latency_line.set_data(self.numbers, self.latencies)
+        self.size_points.set_offsets(np.c_[self.sizes, self.durations])
+        if self._update_limits() or self.background is None:
+            canvas.draw()
+            self.background = canvas.copy_from_bbox(self.figure.bbox)
+            self.full_draws += 1
+        else:
+            canvas.restore_region(self.background)
+            self.blits += 1
+        for artist in self.artists:
+            artist.axes.draw_artist(artist)
+        canvas.blit(self.figure.bbox)
+
+    def invalidate(self):
+        # Kích thước cửa sổ đổi: nền đã lưu không còn đúng
+        self.background = None
+
+
+class TransferDashboard:
+    # Widget Tk chứa TransferGraphs. add_transfer() chỉ ghi nhận điểm mới; việc
+    # vẽ được gom lại, tối đa `fps` lần mỗi giây, trên thread Tk
+    def __init__(self, master, window=DEFAULT_WINDOW, fps=DEFAULT_FPS):
+        self.master = master
+        self.interval_ms = max(int(1000 / fps), 1)
+        self.figure = Figure(figsize=(15, 4))
+        self.graphs = TransferGraphs(self.figure, window)
+        self.canvas = FigureCanvasTkAgg(self.figure, master=master)
+        self.canvas.get_tk_widget().pack(fill="both", expand=True, padx=5, pady=5)
+        self.canvas.mpl_connect("resize_event", lambda event: self.request_redraw(full=True))
+        self.pending = None
+        self.last_render = 0.0
+        self.render_seconds = 0.0
+        self.request_redraw(full=True)
+
+    def load_history(self, log_file):
+        for number, filesize, duration, latency in read_log_tail(log_file, self.graphs.window):
+            self.graphs.add(filesize, duration, latency, number)
+        self.request_redraw()
+
+    def add_transfer(self, filesize, duration, latency):
+        if self.graphs.add(filesize, duration, latency):
+            self.request_redraw()
+
+    def request_redraw(self, full=False):
+        if full:
+            self.graphs.invalidate()
+        if self.pending is None:
+            delay = max(int((self.last_render + self.interval_ms / 1000 - time.monotonic()) * 1000), 0)
+            self.pending = self.master.after(delay, self._render)
+
+    def _render(self):
+        self.pending = None
+        start = time.monotonic()
+        self.graphs.render(self.canvas)
+        self.last_render = time.monotonic()
+        self.render_seconds += self.last_render - start
+
+    def close(self):
+        if self.pending is not None:
+            self.master.after_cancel(self.pending)
+            self.pending = None
+        self.figure.clear()
@@ -0,0 +1,161 @@
+import hashlib
+import math
+import struct
+import zlib
+
+try:
+    import numpy
+except ImportError:  # Vẫn tính được delta, chỉ chậm hơn
+    numpy = None
+
+# Đồng bộ kiểu rsync: server gửi chữ ký từng khối của bản đang lưu (checksum yếu
+# Adler-32 cuộn được + BLAKE2b 16 byte), client dò khớp ở mọi vị trí byte của
+# file mới và chỉ gửi dữ liệu mới (literal) cùng tham chiếu tới các khối đã có.
+MIN_BLOCK_SIZE = 2 * 1024
+MAX_BLOCK_SIZE = 128 * 1024
+ADLER_MOD = 65521
+STRONG_DIGEST_SIZE = 16
+SCAN_SEGMENT_SIZE = 4 * 1024 * 1024
+
+SIGNATURE = struct.Struct("!I16s")
+# Lệnh delta: (loại, a, b); COPY: a = khối đầu, b = số khối liên tiếp;
+# LITERAL: a = offset trong file mới, b = độ dài (dữ liệu đi trong frame DATA riêng)
+DELTA_OP = struct.Struct("!BQQ")
+OP_COPY = 0
+OP_LITERAL = 1
+
+
+def block_size_for(size):
+    # Như rsync: khối cỡ căn bậc hai kích thước file, làm tròn lên bội 1 KiB
+    block = -(-math.isqrt(size) // 1024) * 1024
+    return max(MIN_BLOCK_SIZE, min(block, MAX_BLOCK_SIZE))
+
+
+def weak_checksum(data):
+    return zlib.adler32(data)
+
+
+def strong_checksum(data):
+    return hashlib.blake2b(data, digest_size=STRONG_DIGEST_SIZE).digest()
+
+
+def file_signatures(f, block_size):
+    # Chữ ký các khối đầy đủ của file (khối cuối ngắn hơn được gửi lại như literal)
+    records = []
+    while True:
+        block = f.read(block_size)
+        if len(block) < block_size:
+            return b"".join(records)
+        records.append(SIGNATURE.pack(weak_checksum(block), strong_checksum(block)))
+
+
+def decode_signatures(data):
+    # weak -> {strong: chỉ số khối}
+    if len(data) % SIGNATURE.size:
+        raise ValueError("Signature list has a truncated record")
+    table = {}
+    for index, (weak, strong) in enumerate(SIGNATURE.iter_unpack(data)):
+        table.setdefault(weak, {}).setdefault(strong, index)
+    return table
+
+
+def encode_ops(ops):
+    return b"".join(DELTA_OP.pack(*op) for op in ops)
+
+
+def decode_ops(data):
+    if len(data) % DELTA_OP.size:
+        raise ValueError("Delta has a truncated instruction")
+    return list(DELTA_OP.iter_unpack(data))
+
+
+def _weak_candidates(data, block_size, weaks):
+    # Các vị trí k (tương đối trong data) mà checksum yếu của data[k:k+block_size]
+    # có trong bảng chữ ký
+    count = len(data) - block_size + 1
+    if count <= 0:
+        return []
+    if numpy is not None:
+        x = numpy.frombuffer(data, dtype=numpy.uint8).astype(numpy.int64)
+        sums = numpy.concatenate(([0], numpy.cumsum(x)))
+        weighted = numpy.concatenate(([0], numpy.cumsum(x * numpy.arange(len(x), dtype=numpy.int64))))
+        window = sums[block_size:] - sums[:count]
+        # Lọc trước theo nửa thấp a (rẻ), chỉ tính nửa cao b cho các vị trí còn lại:
+        # b = L + sum (L - i) * x[k + i] = L + (L + k) * tổng - sum j * x[j]
+        sorted_weaks, low_bitmap = weaks
+        a = (1 + window) % ADLER_MOD
+        candidates = numpy.flatnonzero(low_bitmap[a])
+        window = window[candidates]
+        b = (block_size + (block_size + candidates) * window
+             - (weighted[candidates + block_size] - weighted[candidates])) % ADLER_MOD
+        values = (b << 16) | a[candidates]
+        found = sorted_weaks[numpy.minimum(numpy.searchsorted(sorted_weaks, values), len(sorted_weaks) - 1)]
+        return candidates[found == values].tolist()
+    candidates = []
+    a = (1 + sum(data[:block_size])) % ADLER_MOD
+    b = (block_size + sum((block_size - i) * data[i] for i in range(block_size))) % ADLER_MOD
+    for k in range(count):
+        if k:
+            out_byte, in_byte = data[k - 1], data[k + block_size - 1]
+            a = (a - out_byte + in_byte) % ADLER_MOD
+            b = (b - block_size * out_byte + a - 1) % ADLER_MOD
+        if (b << 16) | a in weaks:
+            candidates.append(k)
+    return candidates
+
+
+def compute_delta(f, signatures, block_size, hasher=None):
+    # Quét file mới và trả về danh sách lệnh delta. Chỉ offset/độ dài của literal
+    # được giữ lại, dữ liệu được đọc lại từ file khi gửi.
+    table = decode_signatures(signatures)
+    weaks = table
+    if numpy is not None and table:
+        sorted_weaks = numpy.sort(numpy.fromiter(table, dtype=numpy.int64, count=len(table)))
+        low_bitmap = numpy.zeros(1 << 16, dtype=bool)
+        low_bitmap[sorted_weaks & 0xFFFF] = True
+        weaks = (sorted_weaks, low_bitmap)
+    ops = []
+    base = 0            # offset trong file của data[0]
+    literal_start = 0   # đầu đoạn literal đang mở
+    data = b""
+    eof = False
+
+    def add_copy(index):
+        if literal_start < base + cursor:
+            ops.append((OP_LITERAL, literal_start, base + cursor - literal_start))
+        if ops and ops[-1][0] == OP_COPY and ops[-1][1] + ops[-1][2] == index:
+            ops[-1] = (OP_COPY, ops[-1][1], ops[-1][2] + 1)
+        else:
+            ops.append((OP_COPY, index, 1))
+
+    while not eof:
+        block = f.read(SCAN_SEGMENT_SIZE)
+        eof = len(block) == 0
+        if hasher is not None and block:
+            hasher.update(block)
+        data += block
+        cursor = 0
+        if table:
+            candidates = _weak_candidates(data, block_size, weaks)
+            position = 0
+            while position < len(candidates):
+                k = candidates[position]
+                position += 1
+                if k < cursor:
+                    continue
+                window = data[k:k + block_size]
+                index = table.get(weak_checksum(window), {}).get(strong_checksum(window))
+                if index is None:
+                    continue
+                cursor = k
+                add_copy(index)
+                cursor = k + block_size
+                literal_start = base + cursor
+        # Giữ lại phần chưa quét (ít hơn một khối) cho lần đọc sau
+        keep_from = max(cursor, len(data) - block_size + 1) if not eof else len(data)
+        base += keep_from
+        data = data[keep_from:]
+
+    if literal_start < base:
+        ops.append((OP_LITERAL, literal_start, base - literal_start))
+    return ops
@@ -0,0 +1,225 @@
+import bisect
+import fnmatch
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+
+from partials import STATE_DIR_NAME, file_etag
+
+INDEX_DB_NAME = "index.sqlite3"
+# Một trang LIST duyệt tối đa chừng này mục trong lúc giữ khoá; bộ lọc chọn lọc
+# quá thì trang trả về ít mục hơn kèm cursor để client đi tiếp
+MAX_SCAN_PER_PAGE = 100000
+GLOB_CHARS = "*?["
+
+# Cùng tên trường với os.stat_result nên dùng thẳng được với file_etag()
+FileEntry = namedtuple("FileEntry", "st_size st_mtime_ns sha256")
+
+
+class FileIndex:
+    # Metadata các file đã lưu giữ trong bộ nhớ: tên -> FileEntry, cùng danh sách
+    # tên đã sắp xếp cho LIST, nên LIST/DOWNLOAD không phải quét thư mục.
+    # Bảng SQLite <state>/index.sqlite3 giữ digest qua các lần khởi động; kích thước
+    # và mtime luôn được đối chiếu lại bằng os.scandir khi nạp, vì file có thể bị
+    # thêm/sửa/xoá trong lúc server tắt.
+    def __init__(self, storage_path):
+        self.storage_path = storage_path
+        self.db_path = os.path.join(storage_path, STATE_DIR_NAME, INDEX_DB_NAME)
+        self.entries = {}
+        # Ba thứ tự cho LIST: theo tên, (kích thước, tên) và (mtime, tên)
+        self.names = []
+        self.by_size = []
+        self.by_mtime = []
+        self.lock = threading.Lock()
+        self.db = None
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+
+    def _open(self):
+        # Mọi truy cập đều nằm trong self.lock nên một kết nối dùng chung giữa các thread I/O
+        db = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("CREATE TABLE IF NOT EXISTS files "
+                   "(name TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, sha256 TEXT)")
+        return db
+
+    def load(self):
+        # Dựng lại chỉ mục từ thư mục lưu trữ, giữ digest của các file không đổi.
+        # Trả về số file
+        with self.lock:
+            if self.db is None:
+                self.db = self._open()
+            stored = {row[0]: FileEntry(*row[1:]) for row in self.db.execute("SELECT * FROM files")}
+            entries = {}
+            # Duyệt cả thư mục con (đồng bộ thư mục lưu đường dẫn tương đối "a/b/c")
+            pending = [""]
+            while pending:
+                directory = pending.pop()
+                with os.scandir(os.path.join(self.storage_path, directory)) as it:
+                    for entry in it:
+                        name = directory + entry.name
+                        if name == STATE_DIR_NAME:
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(name + "/")
+                            continue
+                        if not entry.is_file():
+                            continue
+                        st = entry.stat()
+                        old = stored.get(name)
+                        digest = old.sha256 if old is not None and file_etag(old) == file_etag(st) else None
+                        entries[name] = FileEntry(st.st_size, st.st_mtime_ns, digest)
+            # Đồng bộ bảng trong một transaction: bỏ file đã mất, ghi các file mới/đã đổi
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany("DELETE FROM files WHERE name = ?",
+                                    [(name,) for name in stored if name not in entries])
+                self.db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                                    [(name,) + tuple(entry) for name, entry in entries.items()
+                                     if stored.get(name) != entry])
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.entries = entries
+            self.names = sorted(entries)
+            self.by_size = sorted((entry.st_size, name) for name, entry in entries.items())
+            self.by_mtime = sorted((entry.st_mtime_ns, name) for name, entry in entries.items())
+            return len(entries)
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def _unlink(self, name, entry):
+        del self.by_size[bisect.bisect_left(self.by_size, (entry.st_size, name))]
+        del self.by_mtime[bisect.bisect_left(self.by_mtime, (entry.st_mtime_ns, name))]
+
+    def _store(self, name, entry):
+        old = self.entries.get(name)
+        if old is None:
+            bisect.insort(self.names, name)
+        else:
+            self._unlink(name, old)
+        bisect.insort(self.by_size, (entry.st_size, name))
+        bisect.insort(self.by_mtime, (entry.st_mtime_ns, name))
+        self.entries[name] = entry
+        if self.db is not None:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (name,) + tuple(entry))
+
+    def put(self, name, digest=None):
+        # Ghi nhận một file vừa được lưu xong (sau khi đổi tên vào received_files)
+        st = os.stat(os.path.join(self.storage_path, name))
+        entry = FileEntry(st.st_size, st.st_mtime_ns, digest)
+        with self.lock:
+            self._store(name, entry)
+        return entry
+
+    def put_many(self, files):
+        # Như put() cho nhiều file [(tên, digest)], ghi vào SQLite trong một transaction
+        entries = []
+        for name, digest in files:
+            st = os.stat(os.path.join(self.storage_path, name))
+            entries.append((name, FileEntry(st.st_size, st.st_mtime_ns, digest)))
+        with self.lock:
+            if self.db is not None:
+                self.db.execute("BEGIN")
+            try:
+                for name, entry in entries:
+                    self._store(name, entry)
+                if self.db is not None:
+                    self.db.execute("COMMIT")
+            except BaseException:
+                if self.db is not None:
+                    self.db.execute("ROLLBACK")
+                raise
+        return len(entries)
+
+    def set_digest(self, name, digest, st):
+        # Lưu digest tính sau (băm nền); bỏ qua nếu file đã đổi từ lúc bắt đầu băm
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None or file_etag(entry) != file_etag(st):
+                return False
+            self._store(name, entry._replace(sha256=digest))
+            return True
+
+    def remove(self, name):
+        with self.lock:
+            entry = self.entries.pop(name, None)
+            if entry is None:
+                return False
+            del self.names[bisect.bisect_left(self.names, name)]
+            self._unlink(name, entry)
+            if self.db is not None:
+                self.db.execute("DELETE FROM files WHERE name = ?", (name,))
+            return True
+
+    def get(self, name):
+        with self.lock:
+            return self.entries.get(name)
+
+    def digest(self, name, st):
+        # SHA-256 đã biết của file, chỉ khi phiên bản (etag) còn khớp với st
+        with self.lock:
+            entry = self.entries.get(name)
+        if entry is None or file_etag(entry) != file_etag(st):
+            return None
+        return entry.sha256
+
+    def page(self, prefix="", pattern=None, sort="name", reverse=False, limit=1000, cursor=None):
+        # Một trang LIST: trả về ([(tên, FileEntry)], cursor trang sau hoặc None).
+        # cursor là khoá sắp xếp của mục cuối đã duyệt (tên, hoặc [giá trị, tên]),
+        # nên trang sau bắt đầu bằng bisect thay vì đếm lại từ đầu
+        if pattern and sort == "name":
+            # Phần chữ cố định trước ký tự glob đầu tiên thu hẹp được khoảng cần duyệt
+            literal = pattern[:min([pattern.find(c) for c in GLOB_CHARS if c in pattern] or [len(pattern)])]
+            if literal.startswith(prefix):
+                prefix = literal
+            elif not prefix.startswith(literal):
+                return [], None
+        with self.lock:
+            if sort == "name":
+                ordered = self.names
+            else:
+                ordered = self.by_size if sort == "size" else self.by_mtime
+                cursor = tuple(cursor) if cursor is not None else None
+            if not reverse:
+                if cursor is not None:
+                    position = bisect.bisect_right(ordered, cursor)
+                else:
+                    position = bisect.bisect_left(ordered, prefix) if sort == "name" else 0
+            elif cursor is not None:
+                position = bisect.bisect_left(ordered, cursor) - 1
+            else:
+                position = (bisect.bisect_left(ordered, prefix + "\U0010ffff") if sort == "name" and prefix
+                            else len(ordered)) - 1
+            step = -1 if reverse else 1
+            results = []
+            scanned = 0
+            while 0 <= position < len(ordered):
+                key = ordered[position]
+                name = key if sort == "name" else key[1]
+                position += step
+                scanned += 1
+                if not name.startswith(prefix):
+                    if sort == "name":
+                        return results, None  # Đã ra khỏi khoảng tên có prefix
+                elif pattern is None or fnmatch.fnmatchcase(name, pattern):
+                    results.append((name, self.entries[name]))
+                    if len(results) >= limit:
+                        return results, key
+                if scanned >= MAX_SCAN_PER_PAGE:
+                    return results, key
+            return results, None
+
+    def list_names(self):
+        with self.lock:
+            return list(self.names)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
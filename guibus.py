@@ -0,0 +1,80 @@
+import sys
+import threading
+
+# Khoảng thời gian giữa hai lần xử lý hàng đợi trên thread Tk
+DEFAULT_INTERVAL_MS = 50
+CALL = "call"
+BATCH = "batch"
+
+
+class GuiEventBus:
+    # Hàng đợi duy nhất giữa các thread mạng và Tk. Thread bất kỳ gọi post*()
+    # mà không chạm vào Tk và không phải chờ; thread Tk xử lý hàng đợi mỗi
+    # `interval_ms` bằng after(), theo thứ tự gửi:
+    #   post(callback, *args)              chạy đúng một lần mỗi lời gọi
+    #   post_latest(key, callback, *args)  chỉ lần gửi cuối của key trong một nhịp được chạy
+    #                                      (thanh tiến trình, nhãn trạng thái)
+    #   post_batch(key, callback, item)    gom các item của key, callback(list) một lần mỗi nhịp
+    #                                      (dòng log, điểm biểu đồ, thay đổi danh sách file)
+    # post() đóng các nhóm đang gom, nên cập nhật gửi sau nó được chạy sau nó.
+    def __init__(self, master, interval_ms=DEFAULT_INTERVAL_MS):
+        self.master = master
+        self.interval_ms = interval_ms
+        self.lock = threading.Lock()
+        self.queue = []  # [kiểu, callback, tham số hoặc danh sách item]
+        self.pending = {}  # key -> mục post_latest/post_batch chưa bị post() đóng lại
+        self.closed = False
+        self.ticks = 0
+        self.calls = 0
+        self.posted = 0
+        self.timer = master.after(interval_ms, self._drain)
+
+    def _pending(self, key, kind, callback, payload):
+        entry = self.pending.get(key)
+        if entry is None:
+            entry = self.pending[key] = [kind, callback, payload]
+            self.queue.append(entry)
+        return entry
+
+    def post(self, callback, *args):
+        with self.lock:
+            self.queue.append([CALL, callback, args])
+            self.pending.clear()
+            self.posted += 1
+
+    def post_latest(self, key, callback, *args):
+        with self.lock:
+            entry = self._pending(key, CALL, callback, args)
+            entry[1], entry[2] = callback, args
+            self.posted += 1
+
+    def post_batch(self, key, callback, item):
+        with self.lock:
+            self._pending(key, BATCH, callback, [])[2].append(item)
+            self.posted += 1
+
+    def _drain(self):
+        with self.lock:
+            queue, self.queue = self.queue, []
+            self.pending.clear()
+        self.ticks += 1
+        try:
+            for kind, callback, payload in queue:
+                self.calls += 1
+                try:
+                    if kind == BATCH:
+                        callback(payload)
+                    else:
+                        callback(*payload)
+                except Exception:
+                    # Một cập nhật lỗi không được làm dừng các cập nhật sau
+                    self.master.report_callback_exception(*sys.exc_info())
+        finally:
+            if not self.closed:
+                self.timer = self.master.after(self.interval_ms, self._drain)
+
+    def close(self):
+        self.closed = True
+        if self.timer is not None:
+            self.master.after_cancel(self.timer)
+            self.timer = None
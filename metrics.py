@@ -0,0 +1,256 @@
+import bisect
+import csv
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Ngưỡng bucket (giây / byte) của các histogram mặc định
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(16))  # 1 KiB .. 1 TiB
+# Transfer log được ghi theo lô: tối đa LOG_FLUSH_ROWS dòng hoặc sau LOG_FLUSH_INTERVAL giây
+LOG_FLUSH_ROWS = 512
+LOG_FLUSH_INTERVAL = 1.0
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    # Giá trị theo bộ nhãn; mọi thao tác giữ lock chung của registry nên gọi
+    # được từ thread bất kỳ. callback (nếu có) được gọi lúc scrape và trả về
+    # giá trị, hoặc dict {bộ giá trị nhãn: giá trị}
+    kind = "untyped"
+
+    def __init__(self, registry, name, documentation, labels=(), callback=None):
+        self.lock = registry.lock
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.callback = callback
+        self.values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} expects labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def value(self, **labels):
+        with self.lock:
+            return self.values.get(self._key(labels), 0)
+
+    def samples(self):
+        # [(hậu tố tên, giá trị nhãn, nhãn thêm, giá trị)]
+        if self.callback is not None:
+            values = self.callback()
+            if not isinstance(values, dict):
+                values = {(): values}
+        else:
+            with self.lock:
+                values = dict(self.values)
+        return [("", key, (), value) for key, value in sorted(values.items())]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError("Counters can only increase")
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, registry, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(registry, name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                # [số lần rơi vào từng bucket (bucket cuối là +Inf), tổng, số lần]
+                series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def value(self, **labels):
+        # (số lần, tổng) của một bộ nhãn
+        with self.lock:
+            series = self.values.get(self._key(labels))
+            return (series[2], series[1]) if series is not None else (0, 0.0)
+
+    def samples(self):
+        with self.lock:
+            values = {key: (list(series[0]), series[1], series[2]) for key, series in self.values.items()}
+        samples = []
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, hits in zip(self.buckets + (float("inf"),), counts):
+                cumulative += hits
+                samples.append(("_bucket", key, (("le", _format_value(bound)),), cumulative))
+            samples.append(("_sum", key, (), total))
+            samples.append(("_count", key, (), count))
+        return samples
+
+
+class MetricsRegistry:
+    # Tập các counter / gauge / histogram của server, xuất ra định dạng text
+    # của Prometheus
+    def __init__(self, prefix=""):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=(), callback=None):
+        return self._add(Counter(self, self.prefix + name, documentation, labels, callback))
+
+    def gauge(self, name, documentation, labels=(), callback=None):
+        return self._add(Gauge(self, self.prefix + name, documentation, labels, callback))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(self, self.prefix + name, documentation, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            try:
+                samples = metric.samples()
+            except Exception:
+                continue  # Callback lỗi: bỏ metric này, không làm hỏng cả lần scrape
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, key, extra, value in samples:
+                lines.append(f"{metric.name}{suffix}{_format_labels(metric.labels, key, extra)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    # Endpoint HTTP /metrics trên thread riêng, không chạm vào event loop của engine
+    def __init__(self, registry, host="127.0.0.1", port=0):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.host, self.port = self.httpd.server_address[:2]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="metrics-http", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+
+class TransferLogWriter:
+    # Ghi các dòng transfer log CSV trên một thread nền theo lô, nên đường xử lý
+    # yêu cầu chỉ đưa dòng vào hàng đợi. on_flush(số dòng) và on_error(lỗi) được
+    # gọi từ thread ghi
+    def __init__(self, log_file, flush_rows=LOG_FLUSH_ROWS, flush_interval=LOG_FLUSH_INTERVAL,
+                 on_flush=None, on_error=None):
+        self.log_file = log_file
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.on_flush = on_flush
+        self.on_error = on_error
+        self.rows = queue.Queue()
+        self.batches = 0
+        self.thread = threading.Thread(target=self._run, name="transfer-log", daemon=True)
+        self.thread.start()
+
+    def write(self, row):
+        self.rows.put(row)
+
+    def flush(self):
+        # Chờ tới khi mọi dòng đã đưa vào được ghi xuống đĩa
+        self.rows.join()
+
+    def close(self):
+        self.rows.put(None)
+        self.thread.join()
+
+    def _run(self):
+        closing = False
+        while not closing:
+            batch = [self.rows.get()]
+            deadline = time.monotonic() + self.flush_interval
+            try:
+                while len(batch) < self.flush_rows and batch[-1] is not None:
+                    batch.append(self.rows.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                pass
+            fetched = len(batch)
+            if batch[-1] is None:
+                closing = True
+                batch.pop()
+            try:
+                if batch:
+                    with open(self.log_file, "a", encoding="utf-8", newline="") as f:
+                        csv.writer(f, lineterminator="\n").writerows(batch)
+                    self.batches += 1
+                    if self.on_flush is not None:
+                        self.on_flush(len(batch))
+            except OSError as e:
+                if self.on_error is not None:
+                    self.on_error(e)
+            finally:
+                for _ in range(fetched):
+                    self.rows.task_done()
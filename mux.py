@@ -0,0 +1,125 @@
+import asyncio
+from collections import deque
+
+from protocol import FLAG_END, OP_DATA, OP_REPLY, parse_header
+
+# Số frame DATA một yêu cầu được xếp hàng trước khi phải chờ gửi xong
+BULK_WINDOW = 2
+
+
+class MuxWriter:
+    # Luồng ghi duy nhất của một kết nối ghép kênh (phía server). Frame điều khiển
+    # (REPLY, body nhỏ như LIST) luôn được gửi trước; frame DATA của body lớn xếp
+    # chung một hàng FIFO, mỗi yêu cầu chỉ có vài frame trong hàng nên các download
+    # cùng lúc được xen kẽ lần lượt từng frame.
+    def __init__(self, loop, sock):
+        self.loop = loop
+        self.sock = sock
+        self.control = deque()
+        self.bulk = deque()  # (frame, future báo đã gửi)
+        self.wakeup = asyncio.Event()
+        self.idle = asyncio.Event()
+        self.error = None
+        self.task = loop.create_task(self._run())
+
+    def _check(self):
+        if self.error is not None:
+            raise ConnectionError(f"Multiplexed connection failed: {self.error}")
+
+    def send_control(self, frame):
+        self._check()
+        self.control.append(frame)
+        self.idle.clear()
+        self.wakeup.set()
+
+    def send_bulk(self, frame):
+        self._check()
+        future = self.loop.create_future()
+        self.bulk.append((frame, future))
+        self.idle.clear()
+        self.wakeup.set()
+        return future
+
+    async def _run(self):
+        try:
+            while True:
+                if self.control:
+                    await self.loop.sock_sendall(self.sock, self.control.popleft())
+                elif self.bulk:
+                    frame, future = self.bulk.popleft()
+                    await self.loop.sock_sendall(self.sock, frame)
+                    if not future.done():
+                        future.set_result(None)
+                else:
+                    self.idle.set()
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+        except asyncio.CancelledError:
+            self.error = ConnectionError("connection closed")
+            self._fail_pending()
+        except Exception as e:
+            self.error = e
+            self._fail_pending()
+
+    def _fail_pending(self):
+        while self.bulk:
+            _, future = self.bulk.popleft()
+            if not future.done():
+                future.set_exception(ConnectionError(f"Multiplexed connection failed: {self.error}"))
+                future.exception()  # Có thể không ai chờ future này nữa: tránh cảnh báo của asyncio
+        self.control.clear()
+        self.idle.set()
+
+    async def drain(self):
+        # Chờ các frame đã xếp hàng được gửi hết (trước khi đóng kết nối)
+        await self.idle.wait()
+
+    async def close(self):
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        if self.error is None:
+            self.error = ConnectionError("connection closed")
+        self._fail_pending()
+
+
+class MuxStream:
+    # Thay cho socket khi một handler chạy trên kết nối ghép kênh: mọi frame của
+    # yêu cầu đi qua MuxWriter chung. Ghi nhận đã gửi reply / frame cuối của body
+    # chưa, để một yêu cầu lỗi giữa chừng được kết thúc mà không làm hỏng các
+    # yêu cầu khác trên cùng kết nối. Mỗi frame bulk tốn một credit; hết credit thì
+    # chờ client trả thêm (OP_WINDOW), nên client đọc chậm chỉ làm chậm yêu cầu này
+    def __init__(self, writer, request_id, window=None):
+        self.writer = writer
+        self.request_id = request_id
+        self.replied = False
+        self.ended = False
+        self.pending = deque()
+        self.credit = window
+        self.credit_added = asyncio.Event()
+
+    def add_credit(self, frames):
+        if self.credit is not None:
+            self.credit += frames
+            self.credit_added.set()
+
+    async def send(self, frame, bulk=False):
+        header = parse_header(frame)
+        if header.opcode == OP_REPLY:
+            self.replied = True
+        elif header.opcode == OP_DATA:
+            self.ended = bool(header.flags & FLAG_END)
+        if not bulk:
+            self.writer.send_control(frame)
+            return
+        if self.credit is not None:
+            while self.credit <= 0:
+                self.credit_added.clear()
+                await self.credit_added.wait()
+            self.credit -= 1
+        self.pending.append(self.writer.send_bulk(frame))
+        if len(self.pending) > BULK_WINDOW:
+            await self.pending.popleft()
+
+    async def drain(self):
+        while self.pending:
+            await self.pending.popleft()
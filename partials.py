@@ -0,0 +1,207 @@
+import hashlib
+import json
+import os
+import time
+from urllib.parse import unquote
+
+# Thư mục trạng thái ẩn nằm trong thư mục lưu file; LIST không bao giờ trả về nó
+STATE_DIR_NAME = ".transfer"
+PARTIAL_SUFFIX = ".part"
+STRIPE_SUFFIX = ".stripe"
+BATCH_SUFFIX = ".batch"
+META_SUFFIX = ".json"
+DEFAULT_PARTIAL_TTL = 7 * 24 * 3600
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_etag(st):
+    # Định danh phiên bản file phía server cho việc resume download
+    return f"{st.st_size}-{st.st_mtime_ns}"
+
+
+def state_name(name):
+    # Tên file đã lưu có thể là đường dẫn tương đối "a/b/c"; các file trạng thái
+    # (partial, manifest chunk...) nằm phẳng trong một thư mục nên '/' được mã hoá
+    return name.replace("%", "%25").replace("/", "%2F")
+
+
+def name_from_state(encoded):
+    return unquote(encoded)
+
+
+def place_file(source_path, final_path):
+    # Đổi tên nguyên tử vào vị trí cuối cùng, tạo thư mục cha nếu cần
+    os.makedirs(os.path.dirname(final_path), exist_ok=True)
+    os.replace(source_path, final_path)
+
+
+def prune_empty_dirs(storage_path, name):
+    # Xoá các thư mục cha đã rỗng của một file vừa bị xoá, không vượt quá thư mục lưu
+    parent = os.path.dirname(name)
+    while parent:
+        try:
+            os.rmdir(os.path.join(storage_path, parent))
+        except OSError:
+            return  # Còn file khác hoặc đã bị xoá
+        parent = os.path.dirname(parent)
+
+
+def hash_file_prefix(path, length, hasher):
+    # Băm `length` byte đầu của file vào hasher (dùng khi resume)
+    return hash_file_range(path, 0, length, hasher)
+
+
+def hash_file_range(path, offset, length, hasher):
+    remaining = length
+    buf = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buf)
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while remaining:
+            n = f.readinto(view[:min(len(view), remaining)])
+            if not n:
+                raise IOError(f"'{path}' is shorter than {offset + length} bytes")
+            hasher.update(view[:n])
+            remaining -= n
+    return hasher
+
+
+def hash_file(path, hasher):
+    return hash_file_prefix(path, os.path.getsize(path), hasher)
+
+
+def combine_range_digests(digests):
+    # digests: {offset: (length, SHA-256 hex của dải)}. Gộp thành một digest cỡ cố
+    # định theo thứ tự offset, để hai phía so danh sách dải mà không phải gửi cả danh sách
+    combined = hashlib.sha256()
+    for offset, (length, digest) in sorted(digests.items()):
+        combined.update(f"{offset}:{length}:{digest}\n".encode("ascii"))
+    return combined.hexdigest()
+
+
+def preallocate(path, size):
+    # Tạo file đích đủ kích thước trước để các dải byte được ghi đúng vị trí
+    with open(path, "wb") as f:
+        if size and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+                return
+            except OSError:
+                pass  # Hệ thống file không hỗ trợ (tmpfs cũ, NFS...)
+        f.truncate(size)
+
+
+class OffsetWriter:
+    # Đối tượng giống file chỉ ghi trong dải [offset, end) của một file đã cấp phát
+    # trước; dùng os.pwrite nên nhiều kết nối có thể ghi cùng lúc vào một file
+    def __init__(self, path, offset, end):
+        self.fd = os.open(path, os.O_WRONLY | getattr(os, "O_BINARY", 0))
+        self.position = offset
+        self.end = end
+        if not hasattr(os, "pwrite"):
+            os.lseek(self.fd, offset, os.SEEK_SET)
+
+    def write(self, data):
+        if self.position + len(data) > self.end:
+            raise ValueError(f"Write past the end of the assigned range ({self.end})")
+        view = memoryview(data)
+        while view:
+            if hasattr(os, "pwrite"):
+                n = os.pwrite(self.fd, view, self.position)
+            else:
+                n = os.write(self.fd, view)
+            self.position += n
+            view = view[n:]
+        return len(data)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class PartialUploads:
+    # Lưu các upload dở dang: <state>/partial/<name>.part chứa dữ liệu đã nhận,
+    # <name>.json chứa metadata để quyết định có resume được hay không.
+    def __init__(self, storage_path, ttl=DEFAULT_PARTIAL_TTL):
+        self.partial_dir = os.path.join(storage_path, STATE_DIR_NAME, "partial")
+        self.ttl = ttl
+        os.makedirs(self.partial_dir, exist_ok=True)
+
+    def paths(self, name):
+        base = os.path.join(self.partial_dir, state_name(name))
+        return base + PARTIAL_SUFFIX, base + PARTIAL_SUFFIX + META_SUFFIX
+
+    def _read_meta(self, meta_path):
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def prepare(self, name, filesize, source_mtime, resume):
+        # Mở file partial cho một upload; trả về (file, offset, hasher) trong đó
+        # hasher đã băm sẵn phần dữ liệu cũ được giữ lại
+        data_path, meta_path = self.paths(name)
+        meta = {"filename": name, "filesize": filesize, "mtime": source_mtime, "created": time.time()}
+        offset = 0
+        if resume:
+            old = self._read_meta(meta_path)
+            if (old is not None and old.get("filesize") == filesize and old.get("mtime") == source_mtime
+                    and os.path.exists(data_path)):
+                offset = min(os.path.getsize(data_path), filesize)
+                meta["created"] = old.get("created", meta["created"])
+
+        hasher = hashlib.sha256()
+        if offset:
+            hash_file_prefix(data_path, offset, hasher)
+            f = open(data_path, "r+b")
+            f.truncate(offset)
+            f.seek(offset)
+        else:
+            f = open(data_path, "wb")
+        with open(meta_path, "w", encoding="utf-8") as mf:
+            json.dump(meta, mf)
+        return f, offset, hasher
+
+    def finalize(self, name, final_path):
+        # Đổi tên nguyên tử sang vị trí cuối cùng
+        data_path, meta_path = self.paths(name)
+        place_file(data_path, final_path)
+        self._remove(meta_path)
+
+    def discard(self, name):
+        for path in self.paths(name):
+            self._remove(path)
+
+    def stripe_path(self, token):
+        return os.path.join(self.partial_dir, token + STRIPE_SUFFIX)
+
+    def batch_path(self, name):
+        # File tạm của một mục trong batch upload (tên đang ghi được giữ trong active_uploads)
+        return os.path.join(self.partial_dir, state_name(name) + BATCH_SUFFIX)
+
+    def discard_path(self, path):
+        # Xoá một file tạm (bỏ qua nếu đã mất), dùng khi upload bị bỏ dở
+        self._remove(path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def cleanup_expired(self):
+        # Xoá các upload dở dang đã quá hạn, trả về số file đã xoá
+        removed = 0
+        now = time.time()
+        for entry in os.scandir(self.partial_dir):
+            if now - entry.stat().st_mtime <= self.ttl:
+                continue
+            if entry.name.endswith(PARTIAL_SUFFIX):
+                self.discard(name_from_state(entry.name[:-len(PARTIAL_SUFFIX)]))
+                removed += 1
+            elif entry.name.endswith((STRIPE_SUFFIX, BATCH_SUFFIX)):
+                self._remove(entry.path)
+                removed += 1
+        return removed
@@ -0,0 +1,142 @@
+import math
+import threading
+import time
+from collections import namedtuple
+
+# Mặc định: phát cập nhật khi đã qua DEFAULT_INTERVAL giây hoặc tiến thêm
+# DEFAULT_STEP (tỉ lệ của tổng) kể từ lần phát trước, và luôn phát khi xong
+DEFAULT_INTERVAL = 0.1
+DEFAULT_STEP = 0.01
+# Trọng số của tốc độ đo trong khoảng mới nhất khi làm mượt (EWMA)
+RATE_SMOOTHING = 0.5
+
+# rate: byte/giây (đã làm mượt), eta: giây còn lại; None khi chưa đo được
+Progress = namedtuple("Progress", "done total fraction rate eta elapsed finished")
+
+
+def format_bytes(nbytes):
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(nbytes) < 1024:
+            return f"{nbytes:.1f} {unit}" if unit != "B" else f"{int(nbytes)} B"
+        nbytes /= 1024
+    return f"{nbytes:.1f} TB"
+
+
+def format_duration(seconds):
+    if seconds is None or not math.isfinite(seconds):
+        return "--:--"
+    seconds = int(seconds + 0.5)
+    hours, rest = divmod(seconds, 3600)
+    return f"{hours}:{rest // 60:02d}:{rest % 60:02d}" if hours else f"{rest // 60:02d}:{rest % 60:02d}"
+
+
+def describe(progress):
+    # "45% of 1.2 GB, 12.3 MB/s, 00:42 left"
+    parts = []
+    if progress.fraction is not None:
+        parts.append(f"{progress.fraction:.0%} of {format_bytes(progress.total)}")
+    else:
+        parts.append(format_bytes(progress.done))
+    if progress.finished:
+        parts.append(f"done in {format_duration(progress.elapsed)}")
+    elif progress.rate is not None:
+        parts.append(f"{format_bytes(progress.rate)}/s")
+        parts.append(f"{format_duration(progress.eta)} left")
+    return ", ".join(parts)
+
+
+def log_progress(logger, label):
+    # Subscriber cho script không có giao diện: ghi mỗi cập nhật vào log
+    def report(progress):
+        logger.info(f"{label}: {describe(progress)}")
+    return report
+
+
+class ProgressReporter:
+    # Dùng thay cho callback progress(done, total) của vòng lặp transfer: lời
+    # gọi chỉ so sánh với ngưỡng, và chỉ khi đã qua `interval` giây hoặc tiến
+    # thêm `step` * total byte mới tính tốc độ, ETA và gọi các subscriber với
+    # một Progress. Gọi được từ nhiều thread (striping, sync); done nhỏ hơn
+    # giá trị đã thấy bị bỏ qua. Subscriber chạy trên thread gọi, trong lock,
+    # nên phải nhanh (bus.post_latest, logger)
+    def __init__(self, *subscribers, interval=DEFAULT_INTERVAL, step=DEFAULT_STEP, clock=time.monotonic):
+        self.subscribers = list(subscribers)
+        self.interval = interval
+        self.step = step
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.done = 0
+        self.total = None
+        self.started = None
+        self.last_time = None  # thời điểm và done của lần đo tốc độ trước
+        self.last_done = 0
+        self.next_time = 0.0
+        self.next_done = 0
+        self.rate = None
+        self.finished = False
+        self.updates = 0
+        self.emitted = 0
+
+    def subscribe(self, callback):
+        with self.lock:
+            self.subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            if callback in self.subscribers:
+                self.subscribers.remove(callback)
+
+    def __call__(self, done, total=None):
+        now = self.clock()
+        with self.lock:
+            self.updates += 1
+            if total is not None:
+                self.total = total
+            if done > self.done:
+                self.done = done
+            if self.started is None:
+                # Lần gọi đầu làm mốc: transfer resume bắt đầu từ offset đã có
+                self.started = self.last_time = now
+                self.last_done = self.done
+            complete = self.total is not None and self.done >= self.total
+            if self.finished or (not complete and now < self.next_time and self.done < self.next_done):
+                return
+            self._emit(now, complete)
+
+    def finish(self):
+        # Phát cập nhật cuối (finished=True) nếu transfer dừng trước khi đạt total
+        with self.lock:
+            if not self.finished and self.started is not None:
+                self._emit(self.clock(), True)
+
+    def snapshot(self):
+        with self.lock:
+            return self._snapshot(self.clock())
+
+    def _snapshot(self, now):
+        total = self.total
+        fraction = min(self.done / total, 1.0) if total else (1.0 if total == 0 else None)
+        eta = None
+        if self.finished:
+            eta = 0.0
+        elif total is not None and self.rate:
+            eta = max(total - self.done, 0) / self.rate
+        elapsed = now - self.started if self.started is not None else 0.0
+        return Progress(self.done, total, fraction, self.rate, eta, elapsed, self.finished)
+
+    def _emit(self, now, finished):
+        window = now - self.last_time
+        if window >= self.interval or (finished and window > 0):
+            # Tốc độ tức thời trong khoảng gần nhất (ít nhất `interval` giây, để
+            # các block về dồn một lúc không cho tốc độ ảo), làm mượt để ETA không nhảy
+            current = (self.done - self.last_done) / window
+            self.rate = current if self.rate is None else RATE_SMOOTHING * current + (1 - RATE_SMOOTHING) * self.rate
+            self.last_time, self.last_done = now, self.done
+        self.finished = finished
+        self.next_time = now + self.interval
+        self.next_done = self.done + self.step * self.total if self.total else math.inf
+        self.emitted += 1
+        snapshot = self._snapshot(now)
+        for callback in self.subscribers:
+            callback(snapshot)
@@ -0,0 +1,413 @@
+import json
+import struct
+from collections import namedtuple
+
+# Định dạng frame nhị phân dùng chung cho client và server.
+# Header cố định 20 byte:
+#   magic (2s) | version (B) | opcode (B) | flags (B) | padding (3x) | request_id (I) | payload_length (Q)
+MAGIC = b"FT"
+VERSION = 1
+HEADER = struct.Struct("!2sBBB3xIQ")
+HEADER_SIZE = HEADER.size
+
+# Opcode yêu cầu
+OP_UPLOAD = 0x01
+OP_LIST = 0x02
+OP_DOWNLOAD = 0x03
+OP_DELETE = 0x04
+# Gửi sau body của một UPLOAD có thể resume: mang digest của toàn bộ file
+OP_COMMIT = 0x05
+# Upload song song theo dải byte trên nhiều kết nối
+OP_STRIPE_OPEN = 0x06
+OP_STRIPE_PUT = 0x07
+OP_STRIPE_COMMIT = 0x08
+# Upload khử trùng lặp: client gửi danh sách chunk, server chỉ yêu cầu chunk còn thiếu
+OP_CHUNK_UPLOAD = 0x09
+# Upload delta kiểu rsync dựa trên bản đang lưu trên server
+OP_DELTA_UPLOAD = 0x0A
+# Upload nhiều file trong một yêu cầu, server trả lời một lần khi hết batch
+OP_BATCH_UPLOAD = 0x0B
+# Chuyển kết nối sang chế độ ghép kênh: nhiều yêu cầu cùng chạy, phân biệt bằng request id
+OP_MUX = 0x0C
+
+# Opcode dữ liệu / phản hồi
+OP_DATA = 0x10
+OP_REPLY = 0x20
+# Ghép kênh, client -> server: trả credit (số frame DATA) cho một yêu cầu khi đã
+# đọc xong các frame cũ, và huỷ một yêu cầu client không còn đọc nữa
+OP_WINDOW = 0x11
+OP_CANCEL = 0x12
+
+OPCODE_NAMES = {
+    OP_UPLOAD: "UPLOAD",
+    OP_LIST: "LIST",
+    OP_DOWNLOAD: "DOWNLOAD",
+    OP_DELETE: "DELETE",
+    OP_COMMIT: "COMMIT",
+    OP_STRIPE_OPEN: "STRIPE_OPEN",
+    OP_STRIPE_PUT: "STRIPE_PUT",
+    OP_STRIPE_COMMIT: "STRIPE_COMMIT",
+    OP_CHUNK_UPLOAD: "CHUNK_UPLOAD",
+    OP_DELTA_UPLOAD: "DELTA_UPLOAD",
+    OP_BATCH_UPLOAD: "BATCH_UPLOAD",
+    OP_MUX: "MUX",
+    OP_DATA: "DATA",
+    OP_REPLY: "REPLY",
+    OP_WINDOW: "WINDOW",
+    OP_CANCEL: "CANCEL",
+}
+
+# Cờ: frame DATA cuối cùng của một body
+FLAG_END = 0x01
+# Cờ: payload của frame DATA là một khối nén độc lập (codec đã thoả thuận trong handshake)
+FLAG_COMPRESSED = 0x02
+
+# Payload điều khiển (JSON) không được vượt quá giới hạn này
+MAX_CONTROL_PAYLOAD = 64 * 1024
+
+# Kích thước buffer nhận body (recv_into), có thể cấu hình trong khoảng này
+DEFAULT_BUFFER_SIZE = 256 * 1024
+MIN_BUFFER_SIZE = 64 * 1024
+MAX_BUFFER_SIZE = 16 * 1024 * 1024
+
+# LIST: mỗi trang trả về tối đa MAX_LIST_PAGE mục, gửi trong body DATA; một mục là
+# độ dài tên (H) | kích thước (Q) | mtime ns (q) rồi tới tên UTF-8, và SHA-256
+# (32 byte) ngay sau tên nếu yêu cầu có "digests" (dùng cho manifest đồng bộ)
+DEFAULT_LIST_PAGE = 1000
+MAX_LIST_PAGE = 10000
+LIST_ENTRY = struct.Struct("!HQq")
+LIST_SORT_KEYS = ("name", "size", "mtime")
+
+# BATCH_UPLOAD: mỗi file là một frame DATA gồm độ dài tên (H) | kích thước (Q), tên
+# UTF-8 rồi nội dung; frame DATA rỗng có FLAG_END kết thúc batch. Body của reply
+# chứa kết quả từng file theo đúng thứ tự: độ dài tên | mã trạng thái | SHA-256 | tên
+BATCH_ENTRY = struct.Struct("!HQ")
+BATCH_RESULT = struct.Struct("!HB32s")
+BATCH_STATUS_NAMES = ("STORED", "INVALID_NAME", "BUSY", "FAILED")
+BATCH_STORED, BATCH_INVALID_NAME, BATCH_BUSY, BATCH_FAILED = range(len(BATCH_STATUS_NAMES))
+
+# Ghép kênh: body lớn được cắt thành frame DATA tối đa MUX_FRAME_SIZE byte để
+# xen kẽ với các yêu cầu khác; mỗi kết nối chạy tối đa MUX_MAX_STREAMS yêu cầu cùng lúc.
+# Chỉ LIST, DOWNLOAD và DELETE (các yêu cầu không có body gửi lên) chạy được khi ghép kênh
+MUX_FRAME_SIZE = 64 * 1024
+MUX_MAX_STREAMS = 64
+# Kiểm soát luồng theo từng yêu cầu: server gửi tối đa MUX_WINDOW_FRAMES frame DATA
+# bulk chưa được client trả credit (payload của OP_WINDOW là số frame, MUX_CREDIT),
+# nên một yêu cầu đọc chậm chỉ làm chậm chính nó
+MUX_WINDOW_FRAMES = 32
+MUX_CREDIT = struct.Struct("!I")
+
+FrameHeader = namedtuple("FrameHeader", "opcode flags request_id length")
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def pack_header(opcode, request_id, length, flags=0):
+    return HEADER.pack(MAGIC, VERSION, opcode, flags, request_id, length)
+
+
+def encode_frame(opcode, request_id, payload=b"", flags=0):
+    return pack_header(opcode, request_id, len(payload), flags) + payload
+
+
+def encode_message(opcode, request_id, **fields):
+    payload = json.dumps(fields, separators=(",", ":")).encode("utf-8")
+    if len(payload) > MAX_CONTROL_PAYLOAD:
+        raise ProtocolError(f"Control payload too large: {len(payload)} bytes")
+    return encode_frame(opcode, request_id, payload)
+
+
+def decode_message(payload):
+    try:
+        message = json.loads(bytes(payload).decode("utf-8"))
+    except (UnicodeDecodeError, ValueError) as e:
+        raise ProtocolError(f"Invalid control payload: {e}")
+    if not isinstance(message, dict):
+        raise ProtocolError("Control payload must be a JSON object")
+    return message
+
+
+def parse_header(buffer, offset=0):
+    magic, version, opcode, flags, request_id, length = HEADER.unpack_from(buffer, offset)
+    if magic != MAGIC:
+        raise ProtocolError(f"Bad frame magic: {magic!r}")
+    if version != VERSION:
+        raise ProtocolError(f"Unsupported protocol version: {version}")
+    if opcode != OP_DATA and length > MAX_CONTROL_PAYLOAD:
+        raise ProtocolError(f"Control payload too large: {length} bytes")
+    return FrameHeader(opcode, flags, request_id, length)
+
+
+def encode_list_entry(name, size, mtime_ns, digest=None):
+    raw = name.encode("utf-8")
+    if digest is not None:
+        raw += bytes.fromhex(digest)
+    return LIST_ENTRY.pack(len(raw) - (32 if digest is not None else 0), size, mtime_ns) + raw
+
+
+def decode_list_entries(data, digests=False):
+    # Trả về danh sách (tên, kích thước, mtime ns), thêm sha256 hex nếu digests
+    entries = []
+    view = memoryview(data)
+    position = 0
+    while position < len(view):
+        if position + LIST_ENTRY.size > len(view):
+            raise ProtocolError("File list has a truncated entry")
+        name_length, size, mtime_ns = LIST_ENTRY.unpack_from(view, position)
+        position += LIST_ENTRY.size
+        end = position + name_length + (32 if digests else 0)
+        if end > len(view):
+            raise ProtocolError("File list has a truncated name")
+        name = bytes(view[position:position + name_length]).decode("utf-8")
+        if digests:
+            entries.append((name, size, mtime_ns, bytes(view[end - 32:end]).hex()))
+        else:
+            entries.append((name, size, mtime_ns))
+        position = end
+    return entries
+
+
+def encode_batch_header(name, size):
+    raw = name.encode("utf-8")
+    return BATCH_ENTRY.pack(len(raw), size) + raw
+
+
+def encode_batch_result(name, code, digest=b""):
+    raw = name.encode("utf-8", "replace")
+    return BATCH_RESULT.pack(len(raw), code, digest) + raw
+
+
+def decode_batch_results(data):
+    # Trả về danh sách (tên, trạng thái, sha256 hex hoặc None)
+    results = []
+    view = memoryview(data)
+    position = 0
+    while position < len(view):
+        if position + BATCH_RESULT.size > len(view):
+            raise ProtocolError("Batch result has a truncated entry")
+        name_length, code, digest = BATCH_RESULT.unpack_from(view, position)
+        position += BATCH_RESULT.size
+        if position + name_length > len(view) or code >= len(BATCH_STATUS_NAMES):
+            raise ProtocolError("Batch result has an invalid entry")
+        name = bytes(view[position:position + name_length]).decode("utf-8", "replace")
+        results.append((name, BATCH_STATUS_NAMES[code], digest.hex() if code == BATCH_STORED else None))
+        position += name_length
+    return results
+
+
+def clamp_buffer_size(size):
+    return max(MIN_BUFFER_SIZE, min(int(size), MAX_BUFFER_SIZE))
+
+
+class BufferPool:
+    # Giữ lại các bytearray lớn để dùng lại giữa các lần truyền,
+    # bộ nhớ không tăng theo số chunk hay số lần upload
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE, max_free=8):
+        self.buffer_size = clamp_buffer_size(buffer_size)
+        self.max_free = max_free
+        self._free = []
+
+    def acquire(self):
+        if self._free:
+            return self._free.pop()
+        return bytearray(self.buffer_size)
+
+    def release(self, buf):
+        if len(self._free) < self.max_free:
+            self._free.append(buf)
+
+
+class _ReadBuffer:
+    # Buffer đọc dùng lại cho một socket; dữ liệu dư (frame kế tiếp, byte đầu
+    # của body, phần sau dấu xuống dòng) được giữ lại cho lần đọc sau.
+    def __init__(self, sock, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.sock = sock
+        self._buf = bytearray(max(buffer_size, HEADER_SIZE))
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+
+    def _buffered(self):
+        return self._end - self._start
+
+    def _make_room(self, n):
+        # Dồn dữ liệu còn lại về đầu buffer nếu phần trống phía sau không đủ n byte;
+        # chỉ nới rộng buffer khi một payload điều khiển lớn hơn cả buffer
+        if n > len(self._buf):
+            pending = self._end - self._start
+            new_buf = bytearray(max(n, 2 * len(self._buf)))
+            new_buf[:pending] = self._view[self._start:self._end]
+            self._view.release()
+            self._buf, self._view = new_buf, memoryview(new_buf)
+            self._start, self._end = 0, pending
+        elif self._start == self._end:
+            self._start = self._end = 0
+        elif len(self._buf) - self._start < n:
+            pending = self._end - self._start
+            self._buf[:pending] = self._view[self._start:self._end]
+            self._start, self._end = 0, pending
+
+    def _find_newline(self, searched, limit):
+        # Tìm '\n' trong phần buffer chưa quét (bytearray.find chạy ở tầng C)
+        index = self._buf.find(b"\n", self._start + searched, self._end)
+        if index >= 0:
+            return index + 1 - self._start
+        if self._buffered() >= limit:
+            raise ProtocolError(f"Line longer than {limit} bytes")
+        return None
+
+    def _take_header(self):
+        header = parse_header(self._buf, self._start)
+        self._start += HEADER_SIZE
+        return header
+
+    def _take(self, n):
+        n = min(n, self._end - self._start)
+        data = bytes(self._view[self._start:self._start + n])
+        self._start += n
+        return data
+
+    def _take_into(self, view):
+        n = min(len(view), self._end - self._start)
+        view[:n] = self._view[self._start:self._start + n]
+        self._start += n
+        return n
+
+    def _check_data_frame(self, header):
+        if header.opcode == OP_DATA:
+            raise ProtocolError("read_frame() cannot buffer a DATA frame")
+
+
+class BufferedSocketReader(_ReadBuffer):
+    # Đọc có buffer từ socket blocking: mỗi lần recv_into lấy càng nhiều byte
+    # càng tốt, các hàm đọc chỉ cắt dữ liệu ra từ buffer
+    def _fill(self, n):
+        # Đảm bảo có ít nhất n byte trong buffer
+        if self._buffered() >= n:
+            return True
+        self._make_room(n)
+        while self._buffered() < n:
+            received = self.sock.recv_into(self._view[self._end:])
+            if not received:
+                return False
+            self._end += received
+        return True
+
+    def readline(self, limit=MAX_CONTROL_PAYLOAD):
+        # Trả về một dòng gồm cả '\n'; b"" nếu kết nối đóng trước khi có dữ liệu
+        searched = 0
+        while True:
+            length = self._find_newline(searched, limit)
+            if length is not None:
+                return self._take(length)
+            searched = self._buffered()
+            if not self._fill(searched + 1):
+                return self._take(self._buffered())
+
+    def readexactly(self, n):
+        if not self._fill(n):
+            raise ConnectionError(f"Connection closed while reading {n} bytes")
+        return self._take(n)
+
+    def read(self, n):
+        # Đọc tối đa n byte: ưu tiên dữ liệu đã có trong buffer
+        if not self._buffered() and not self._fill(1):
+            return b""
+        return self._take(n)
+
+    def readinto(self, view):
+        # Dữ liệu còn trong buffer được chép trước; sau đó recv_into thẳng vào view
+        if self._buffered():
+            return self._take_into(view)
+        return self.sock.recv_into(view)
+
+
+class FrameReader(BufferedSocketReader):
+    # Tách frame trên nền BufferedSocketReader (client)
+    def read_header(self):
+        # Trả về None nếu phía bên kia đóng kết nối giữa hai frame
+        if not self._fill(HEADER_SIZE):
+            if self._buffered():
+                raise ConnectionError("Connection closed in the middle of a frame header")
+            return None
+        return self._take_header()
+
+    def read_frame(self):
+        header = self.read_header()
+        if header is None:
+            return None, None
+        self._check_data_frame(header)
+        return header, self.readexactly(header.length)
+
+    def read_message(self):
+        header, payload = self.read_frame()
+        if header is None:
+            return None, None
+        return header, decode_message(payload)
+
+
+class AsyncBufferedSocketReader(_ReadBuffer):
+    # Phiên bản asyncio cho socket non-blocking (server)
+    def __init__(self, sock, loop, buffer_size=DEFAULT_BUFFER_SIZE):
+        super().__init__(sock, buffer_size)
+        self.loop = loop
+
+    async def _fill(self, n):
+        if self._buffered() >= n:
+            return True
+        self._make_room(n)
+        while self._buffered() < n:
+            received = await self.loop.sock_recv_into(self.sock, self._view[self._end:])
+            if not received:
+                return False
+            self._end += received
+        return True
+
+    async def readline(self, limit=MAX_CONTROL_PAYLOAD):
+        searched = 0
+        while True:
+            length = self._find_newline(searched, limit)
+            if length is not None:
+                return self._take(length)
+            searched = self._buffered()
+            if not await self._fill(searched + 1):
+                return self._take(self._buffered())
+
+    async def readexactly(self, n):
+        if not await self._fill(n):
+            raise ConnectionError(f"Connection closed while reading {n} bytes")
+        return self._take(n)
+
+    async def read(self, n):
+        if not self._buffered() and not await self._fill(1):
+            return b""
+        return self._take(n)
+
+    async def readinto(self, view):
+        if self._buffered():
+            return self._take_into(view)
+        return await self.loop.sock_recv_into(self.sock, view)
+
+
+class AsyncFrameReader(AsyncBufferedSocketReader):
+    async def read_header(self):
+        if not await self._fill(HEADER_SIZE):
+            if self._buffered():
+                raise ConnectionError("Connection closed in the middle of a frame header")
+            return None
+        return self._take_header()
+
+    async def read_frame(self):
+        header = await self.read_header()
+        if header is None:
+            return None, None
+        self._check_data_frame(header)
+        return header, await self.readexactly(header.length)
+
+    async def read_message(self):
+        header, payload = await self.read_frame()
+        if header is None:
+            return None, None
+        return header, decode_message(payload)
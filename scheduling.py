@@ -0,0 +1,129 @@
+import time
+from collections import deque
+
+from admission import DEFAULT_QUEUE_TIMEOUT, AdmissionGate
+from shaping import ShapedFrameReader
+
+# Mỗi giây chờ bù cho chừng này byte kích thước: với 64 MiB/s, một file 50 GB
+# chờ lâu hơn file 2 KB đến cùng lúc tối đa khoảng 13 phút
+DEFAULT_AGING_RATE = 64 * 1024 * 1024
+# Một lượt truyền được chạy ít nhất chừng này giây sau mỗi lần được nhận rồi
+# mới có thể bị tạm dừng nhường chỗ, để tránh đổi qua đổi lại liên tục
+MIN_RUN_SECONDS = 0.2
+# Giới hạn trên của các nhóm kích thước dùng cho thống kê latency
+SIZE_CLASSES = (
+    (64 * 1024, "<64K"),
+    (1024 * 1024, "64K-1M"),
+    (16 * 1024 * 1024, "1M-16M"),
+    (256 * 1024 * 1024, "16M-256M"),
+    (None, ">=256M"),
+)
+LATENCY_SAMPLES = 1000
+
+
+def size_class(size):
+    for limit, name in SIZE_CLASSES:
+        if limit is None or size < limit:
+            return name
+
+
+def percentile(values, fraction):
+    # values đã sắp xếp
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+class TransferTicket:
+    # Một lượt truyền đã xin chỗ ở TransferScheduler; remaining giảm dần theo
+    # số byte đã truyền
+    def __init__(self, scheduler, size):
+        self.scheduler = scheduler
+        self.size = size
+        self.remaining = size
+        self.arrival = time.monotonic()
+        self.started = time.perf_counter()
+        self.admitted_at = None
+        self.holding = False
+        self.preemptions = 0
+
+    async def progress(self, nbytes):
+        # Gọi sau mỗi khối dữ liệu; chỉ tốn một phép so sánh khi không có ai xếp hàng
+        self.remaining = max(self.remaining - nbytes, 0)
+        if self.scheduler.waiters:
+            await self.scheduler.checkpoint(self)
+
+
+class TransferScheduler(AdmissionGate):
+    # Cổng cho các lượt truyền, ưu tiên lượt còn ít byte nhất (SRPT) có aging:
+    # hàng đợi xếp theo thời điểm đến + byte còn lại / aging. Lượt đang chạy
+    # có khoá lớn hơn việc đầu hàng thì tạm dừng ở khối tiếp theo và nhường chỗ,
+    # rồi xếp hàng lại với thời điểm đến ban đầu (không bị từ chối BUSY), nên file
+    # nhỏ không phải chờ file lớn chạy xong. Ghi latency theo nhóm kích thước.
+    def __init__(self, name, limit=None, max_weight=None, timeout=DEFAULT_QUEUE_TIMEOUT,
+                 aging=DEFAULT_AGING_RATE):
+        super().__init__(name, limit, max_weight, timeout, aging)
+        self.preempted = 0
+        self.latencies = {name: deque(maxlen=LATENCY_SAMPLES) for _, name in SIZE_CLASSES}
+        self.completed = dict.fromkeys(self.latencies, 0)
+
+    async def admit(self, size):
+        # Trả về TransferTicket đang giữ chỗ, hoặc AdmissionRejected
+        ticket = TransferTicket(self, size)
+        await self.acquire(size)
+        ticket.holding = True
+        ticket.admitted_at = time.monotonic()
+        return ticket
+
+    async def checkpoint(self, ticket):
+        if not ticket.holding or time.monotonic() - ticket.admitted_at < MIN_RUN_SECONDS:
+            return
+        head_key, _, head_weight, _ = self.waiters[0]
+        if head_key >= self.key(ticket.remaining, ticket.arrival):
+            return
+        # Chỉ nhường khi trả chỗ này thì việc đầu hàng vừa
+        self.active -= 1
+        self.weight -= ticket.size
+        if not self._fits(head_weight):
+            self._take(ticket.size)
+            return
+        ticket.holding = False
+        ticket.preemptions += 1
+        self.preempted += 1
+        await self.wait_turn(ticket.size, ticket.remaining, ticket.arrival, None)
+        ticket.holding = True
+        ticket.admitted_at = time.monotonic()
+
+    def finish(self, ticket):
+        if ticket.holding:
+            ticket.holding = False
+            self.release(ticket.size)
+        name = size_class(ticket.size)
+        self.latencies[name].append(time.perf_counter() - ticket.started)
+        self.completed[name] += 1
+
+    def stats(self):
+        stats = super().stats()
+        classes = {}
+        for name, samples in self.latencies.items():
+            values = sorted(samples)
+            classes[name] = {
+                "count": self.completed[name],
+                "p50": percentile(values, 0.5),
+                "p95": percentile(values, 0.95),
+                "p99": percentile(values, 0.99),
+            }
+        stats.update(aging=self.aging, preempted=self.preempted, latency=classes)
+        return stats
+
+
+class ScheduledFrameReader(ShapedFrameReader):
+    # Byte body nhận qua reader được tính vào ticket của lượt upload đang chạy
+    # trên kết nối (engine gán ticket trong lúc xử lý yêu cầu)
+    def __init__(self, sock, loop, buffer_size, shaper, client):
+        super().__init__(sock, loop, buffer_size, shaper, client)
+        self.ticket = None
+
+    async def readinto(self, view):
+        received = await super().readinto(view)
+        if received and self.ticket is not None:
+            await self.ticket.progress(received)
+        return received
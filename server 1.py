@@ -1,32 +1,40 @@
-import socket
-import threading
+import bisect
 import os
 import time
 import tkinter as tk
 from tkinter import scrolledtext, messagebox, filedialog
 from PIL import Image, ImageTk
-import matplotlib.pyplot as plt
-import pandas as pd
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from dashboard import TransferDashboard
+from guibus import GuiEventBus
+from partials import STATE_DIR_NAME
+from server_engine import build_arg_parser, engine_from_args, ensure_transfer_log, mb_per_second
+
+# Ô nhập giới hạn băng thông: (nhãn, thuộc tính trong config, tham số của set_rate_limits)
+RATE_LIMIT_FIELDS = (
+    ("Global", "global_rate_mb", "global_rate"),
+    ("Upload", "upload_rate_mb", "upload_rate"),
+    ("Download", "download_rate_mb", "download_rate"),
+    ("Per client", "client_rate_mb", "client_rate"),
+)
 
 class FileServerApp:
-    def __init__(self, master):
+    def __init__(self, master, config=None):
         self.master = master
+        # Cấu hình engine (địa chỉ bind, cổng, thư mục lưu, số worker...) dùng chung với CLI
+        self.config = config if config is not None else build_arg_parser().parse_args([])
         self.master.title("File Sharing Server")
         self.master.geometry("1200x800")  # Tăng kích thước để chứa nhiều biểu đồ
 
-        self.server_socket = None
+        self.engine = None
         self.running = False
-        self.received_files_path = "received_files"
-        self.log_file = "transfer_log.csv"
+        self.received_files_path = self.config.storage
+        self.log_file = self.config.log_file
+        # Bản sao đã sắp xếp của các dòng trong files_listbox
+        self.listed_files = []
         os.makedirs(self.received_files_path, exist_ok=True)
+        ensure_transfer_log(self.log_file)
 
-        # Khởi tạo tệp log với các cột bao gồm 'Latency'
-        if not os.path.exists(self.log_file):
-            with open(self.log_file, "w", encoding="utf-8") as f:
-                f.write("Filename,FileSize,Duration,Status,Latency\n")  # Thêm cột Latency
-
-        # Bộ đếm cho các chỉ số hiệu suất
+        # Bộ đếm cho các chỉ số hiệu suất (cập nhật từ sự kiện của engine)
         self.total_transfers = 0
         self.failed_transfers = 0
 
@@ -57,6 +65,18 @@ class FileServerApp:
         )
         self.stop_button.pack(side=tk.LEFT, padx=10)
 
+        # Giới hạn băng thông (MB/s, để trống là không giới hạn), áp dụng ngay khi server đang chạy
+        self.rate_frame = tk.Frame(master)
+        self.rate_frame.pack(pady=5)
+        tk.Label(self.rate_frame, text="Bandwidth limits (MB/s):", font=("Arial", 11)).pack(side=tk.LEFT)
+        self.rate_vars = {}
+        for label, attribute, _ in RATE_LIMIT_FIELDS:
+            tk.Label(self.rate_frame, text=f"{label}:").pack(side=tk.LEFT, padx=(10, 0))
+            value = getattr(self.config, attribute, None)
+            self.rate_vars[attribute] = tk.StringVar(value=f"{value:g}" if value else "")
+            tk.Entry(self.rate_frame, textvariable=self.rate_vars[attribute], width=7).pack(side=tk.LEFT)
+        tk.Button(self.rate_frame, text="Apply", command=self.apply_rate_limits).pack(side=tk.LEFT, padx=10)
+
         # Khung Thông Tin để chứa Received Files và Server Log
         self.info_frame = tk.Frame(master)
         self.info_frame.pack(fill=tk.BOTH, expand=True, padx=20, pady=10)
@@ -121,36 +141,41 @@ class FileServerApp:
         self.graph_frame = tk.Frame(master)
         self.graph_frame.pack(fill=tk.BOTH, expand=True, padx=20, pady=10)
 
-        # Khởi tạo biểu đồ
-        self.update_graphs()
+        # Biểu đồ dùng lại một Figure, chỉ thêm điểm mới; nạp các transfer gần nhất từ log
+        self.dashboard = TransferDashboard(self.graph_frame)
+        self.dashboard.load_history(self.log_file)
 
-        # Optional: Bắt đầu cập nhật biểu đồ định kỳ
-        # self.start_graph_refresh()
+        # Sự kiện từ thread của engine đi qua bus và được áp dụng theo nhịp trên thread Tk
+        self.bus = GuiEventBus(master)
+
+    @staticmethod
+    def format_log_line(message):
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        return f"[{timestamp}] {message}\n"
 
     def log_message(self, message):
+        self.append_log_lines([self.format_log_line(message)])
+
+    def append_log_lines(self, lines):
+        # Nhiều dòng log trong một lần chèn
         self.log_text.config(state=tk.NORMAL)
-        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-        self.log_text.insert(tk.END, f"[{timestamp}] {message}\n")
+        self.log_text.insert(tk.END, "".join(lines))
         self.log_text.config(state=tk.DISABLED)
         self.log_text.see(tk.END)
 
     def start_server(self):
         if not self.running:
             try:
+                self.engine = engine_from_args(self.config)
+                self.engine.add_listener(self.on_engine_event)
+                self.engine.start()
                 self.running = True
-                self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                # self.server_socket.bind(("0.0.0.0", 9999))
-                self.server_socket.bind(("192.168.5.98", 9999))
-
-                self.server_socket.listen(5)
-                self.server_socket.settimeout(5)
-                self.status_label.config(text="Server Status: Running", fg="green")
+                self.status_label.config(text=f"Server Status: Running on {self.engine.host}:{self.engine.port}", fg="green")
                 self.start_button.config(state=tk.DISABLED)
                 self.stop_button.config(state=tk.NORMAL)
-                threading.Thread(target=self.accept_clients, daemon=True).start()
-                self.log_message("Server started on port 9999.")
             except Exception as e:
                 self.log_message(f"Failed to start server: {e}")
+                self.engine = None
                 self.running = False
                 self.status_label.config(text="Server Status: Stopped", fg="red")
                 self.start_button.config(state=tk.NORMAL)
@@ -160,196 +185,103 @@ class FileServerApp:
         if self.running:
             self.running = False
             try:
-                self.server_socket.close()
+                self.engine.stop()
                 self.status_label.config(text="Server Status: Stopped", fg="red")
                 self.start_button.config(state=tk.NORMAL)
                 self.stop_button.config(state=tk.DISABLED)
-                self.log_message("Server stopped.")
             except Exception as e:
                 self.log_message(f"Error stopping server: {e}")
 
-    def accept_clients(self):
-        while self.running:
-            try:
-                client_socket, client_address = self.server_socket.accept()
-                client_socket.settimeout(5)
-
-                threading.Thread(target=self.handle_client, args=(client_socket, client_address), daemon=True).start()
-                self.log_message(f"Client connected: {client_address}")
-            except OSError:
-                break  # Socket đã được đóng
-            except Exception as e:
-                self.log_message(f"Error accepting client: {e}")
-
-    def handle_client(self, client_socket, client_address):
+    def apply_rate_limits(self):
+        limits = {}
         try:
-            while self.running:
-                request = client_socket.recv(1024).decode(errors="surrogateescape")
-                if not request:
-                    break
-
-                if request.startswith("UPLOAD"):
-                    self.handle_upload(client_socket, request)
-                elif request.startswith("LIST"):
-                    self.handle_list(client_socket)
-                elif request.startswith("DOWNLOAD"):
-                    self.handle_download(client_socket, request, client_address)
-                elif request.startswith("DELETE"):
-                    self.handle_delete(client_socket, request)
-                else:
-                    client_socket.sendall(b"ERROR: Unknown command.")
-        except Exception as e:
-            self.log_message(f"Error handling client {client_address}: {e}")
-            self.failed_transfers += 1
-            self.update_packet_loss_rate()
-        finally:
-            client_socket.close()
-            self.log_message(f"Client disconnected: {client_address}")
+            for label, attribute, name in RATE_LIMIT_FIELDS:
+                text = self.rate_vars[attribute].get().strip()
+                value = float(text) if text else None
+                if value is not None and value <= 0:
+                    raise ValueError(f"{label} limit must be positive")
+                setattr(self.config, attribute, value)
+                limits[name] = mb_per_second(value)
+        except ValueError as e:
+            messagebox.showerror("Error", f"Invalid bandwidth limit: {e}")
+            return
+        # Lần Start sau đọc lại từ config; nếu đang chạy thì đổi ngay trong engine
+        if self.running and self.engine is not None:
+            self.engine.set_rate_limits(**limits)
+        else:
+            self.log_message("Bandwidth limits saved; they apply when the server starts.")
+
+    def on_engine_event(self, event, data):
+        # Gọi từ thread của engine: chỉ đưa vào bus, không chạm vào widget. Log,
+        # transfer và thay đổi danh sách file được gom; thống kê chỉ giữ bản mới nhất
+        if event == "log":
+            self.bus.post_batch("log", self.append_log_lines, self.format_log_line(data["message"]))
+        elif event == "transfer":
+            self.bus.post_batch("transfer", self.apply_transfers, data)
+        elif event == "files_changed":
+            self.bus.post_batch("files", self.apply_file_changes, data)
+        elif event == "stats":
+            self.bus.post_latest("stats", self.apply_engine_event, event, data)
+        else:
+            self.bus.post(self.apply_engine_event, event, data)
 
-    def handle_upload(self, client_socket, request):
-        try:
-            # Log yêu cầu nhận
-            self.log_message(f"Received UPLOAD command: {request}")
-            
-            # Tách các phần của yêu cầu thành 3 phần
-            parts = request.strip().split(" ", 2)  # Chia thành 3 phần: "UPLOAD", "filename", "filesize"
-            if len(parts) < 3:
-                client_socket.sendall(b"ERROR: Invalid UPLOAD command. Format should be: UPLOAD filename filesize")
-                self.failed_transfers += 1
-                self.update_packet_loss_rate()
-                self.log_message(f"Invalid UPLOAD command received: {request}")
-                return
-
-            _, filename, filesize_str = parts
-
-            # Xác minh và chuyển đổi filesize thành integer
-            try:
-                filesize = int(filesize_str)
-            except ValueError:
-                client_socket.sendall(b"ERROR: Filesize must be an integer.")
-                self.failed_transfers += 1
-                self.update_packet_loss_rate()
-                self.log_message(f"Invalid filesize received for file '{filename}': '{filesize_str}'")
-                return
-
-            # Đảm bảo tên file an toàn
-            safe_filename = os.path.basename(filename)
-            filepath = os.path.join(self.received_files_path, safe_filename)
-
-            # Ghi nhận thời gian bắt đầu
-            start_time = time.time()
-            total_bytes = 0
-
-            with open(filepath, "wb") as f:
-                while total_bytes < filesize:
-                    data = client_socket.recv(min(4096, filesize - total_bytes))
-                    if not data:
-                        break
-                    f.write(data)
-                    total_bytes += len(data)
-
-            # Ghi nhận thời gian kết thúc
-            end_time = time.time()
-            duration = end_time - start_time  # Duration tính bằng giây
-            transfer_speed = total_bytes / duration if duration > 0 else 0
-            latency = duration * 1000  # Convert to milliseconds
-
-            # Ghi vào file log bao gồm latency
-            status = "SUCCESS" if total_bytes == filesize else "INCOMPLETE"
-            with open(self.log_file, "a", encoding="utf-8") as f:
-                f.write(f"{safe_filename},{total_bytes},{duration:.2f},{status},{latency:.2f}\n")
-
-            if status == "SUCCESS":
-                client_socket.sendall(b"UPLOAD_SUCCESS")
-                self.log_message(f"File '{safe_filename}' ({total_bytes} bytes) received in {duration:.2f} seconds. Latency: {latency:.2f} ms")
-                self.total_transfers += 1
-            else:
-                client_socket.sendall(b"UPLOAD_INCOMPLETE")
-                self.log_message(f"File '{safe_filename}' incomplete. Received {total_bytes} of {filesize} bytes. Latency: {latency:.2f} ms")
-                self.failed_transfers += 1
+    def apply_transfers(self, transfers):
+        self.transfer_speed_label.config(text=f"Transfer Performance: {transfers[-1]['speed']:.2f} bytes/sec", fg="blue")
+        for data in transfers:
+            self.dashboard.add_transfer(data["filesize"], data["duration"], data["latency"])
 
-            self.transfer_speed_label.config(text=f"Transfer Performance: {transfer_speed:.2f} bytes/sec", fg="blue")
+    def apply_file_changes(self, changes):
+        # Có thay đổi cả danh sách thì dựng lại một lần, không thì sửa từng dòng
+        if any(data.get("filename") is None for data in changes):
             self.update_file_list()
-            self.master.after(0, self.update_graphs)
+            return
+        for data in changes:
+            self.update_file_entry(data["filename"], data["deleted"])
 
-        except Exception as e:
-            client_socket.sendall(b"ERROR: File transfer failed.")
-            self.log_message(f"Failed to save file '{filename}': {e}")
-            self.failed_transfers += 1
+    def apply_engine_event(self, event, data):
+        if event == "stats":
+            self.total_transfers = data["total_transfers"]
+            self.failed_transfers = data["failed_transfers"]
             self.update_packet_loss_rate()
-            self.master.after(0, self.update_graphs)
-
-            
-
-    def handle_list(self, client_socket):
-        try:
-            files = os.listdir(self.received_files_path)
-            file_list = "|".join(files)
-            client_socket.sendall(file_list.encode("utf-8"))
-        except Exception as e:
-            client_socket.sendall(b"ERROR: Unable to list files.")
-            self.log_message(f"Error listing files: {e}")
-
-    def handle_download(self, client_socket, request, client_address):
-        try:
-            parts = request.strip().split(" ", 1)
-            if len(parts) < 2:
-                client_socket.sendall(b"ERROR: Invalid DOWNLOAD command.\n")
-                return
-
-            _, filename = parts
-            filepath = os.path.join(self.received_files_path, os.path.basename(filename))
-
-            if os.path.exists(filepath):
-                filesize = os.path.getsize(filepath)
-                response = f"FILE_FOUND {filesize}\n"
-                client_socket.sendall(response.encode("utf-8"))  # Đảm bảo kết thúc bằng '\n'
-
-                # Gửi dữ liệu file
-                with open(filepath, "rb") as f:
-                    while True:
-                        chunk = f.read(4096)
-                        if not chunk:
-                            break
-                        client_socket.sendall(chunk)
-            else:
-                response = "FILE_NOT_FOUND\n"
-                client_socket.sendall(response.encode("utf-8"))  # Đảm bảo kết thúc bằng '\n'
-        except Exception as e:
-            error_message = "ERROR: Unable to send file.\n"
-            client_socket.sendall(error_message.encode("utf-8"))
-            logging.error(f"Error handling download: {e}")
-
-    def handle_delete(self, client_socket, request):
-        try:
-            parts = request.split(" ", 1)
-            if len(parts) < 2:
-                client_socket.sendall(b"ERROR: Invalid DELETE command.")
-                return
-
-            _, filename = parts
-            filepath = os.path.join(self.received_files_path, os.path.basename(filename))
-
-            if os.path.exists(filepath):
-                os.remove(filepath)
-                client_socket.sendall(b"FILE_DELETED")
-                self.log_message(f"File '{filename}' deleted by client.")
-                self.update_file_list()
-            else:
-                client_socket.sendall(b"FILE_NOT_FOUND")
-        except Exception as e:
-            client_socket.sendall(b"ERROR: Unable to delete file.")
-            self.log_message(f"Error deleting file '{filename}': {e}")
+        elif event == "stopped":
+            self.running = False
+            self.status_label.config(text="Server Status: Stopped", fg="red")
+            self.start_button.config(state=tk.NORMAL)
+            self.stop_button.config(state=tk.DISABLED)
+
+    def update_packet_loss_rate(self):
+        attempts = self.total_transfers + self.failed_transfers
+        if attempts == 0:
+            self.packet_loss_label.config(text="Packet Loss Rate: N/A")
+            return
+        rate = self.failed_transfers / attempts * 100
+        self.packet_loss_label.config(text=f"Packet Loss Rate: {rate:.2f}%")
 
     def update_file_list(self):
+        # Khi server chạy thì lấy từ chỉ mục của engine, chỉ quét thư mục khi đã dừng
         self.files_listbox.delete(0, tk.END)
         try:
-            files = os.listdir(self.received_files_path)
-            for file in files:
-                self.files_listbox.insert(tk.END, file)
+            if self.running and self.engine is not None:
+                files = self.engine.file_index.list_names()
+            else:
+                files = sorted(name for name in os.listdir(self.received_files_path) if name != STATE_DIR_NAME)
+            self.listed_files = files
+            if files:
+                self.files_listbox.insert(tk.END, *files)
         except Exception as e:
             self.log_message(f"Error updating file list: {e}")
 
+    def update_file_entry(self, filename, deleted):
+        # Thêm/xoá đúng một dòng thay vì dựng lại cả danh sách sau mỗi upload
+        index = bisect.bisect_left(self.listed_files, filename)
+        present = index < len(self.listed_files) and self.listed_files[index] == filename
+        if deleted and present:
+            del self.listed_files[index]
+            self.files_listbox.delete(index)
+        elif not deleted and not present:
+            self.listed_files.insert(index, filename)
+            self.files_listbox.insert(index, filename)
+
     def delete_file(self):
         selection = self.files_listbox.curselection()
         if not selection:
@@ -359,16 +291,19 @@ class FileServerApp:
         filename = self.files_listbox.get(selection[0])
         filepath = os.path.join(self.received_files_path, filename)
 
-        if os.path.exists(filepath):
-            try:
+        try:
+            if self.running and self.engine is not None:
+                # Qua engine để chỉ mục file và chỉ mục chunk được cập nhật cùng lúc
+                self.engine.delete_file(filename)
+            else:
                 os.remove(filepath)
-                self.log_message(f"File '{filename}' deleted by server.")
                 self.update_file_list()
-                messagebox.showinfo("Success", f"File '{filename}' deleted successfully.")
-            except Exception as e:
-                messagebox.showerror("Error", f"Failed to delete file: {e}")
-        else:
+            self.log_message(f"File '{filename}' deleted by server.")
+            messagebox.showinfo("Success", f"File '{filename}' deleted successfully.")
+        except FileNotFoundError:
             messagebox.showerror("Error", "File not found.")
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to delete file: {e}")
 
     def open_file(self, event):
         selection = self.files_listbox.curselection()
@@ -424,92 +359,18 @@ class FileServerApp:
         except Exception as e:
             messagebox.showerror("Error", f"Unable to display text: {e}")
 
-    def update_graphs(self):
-        # Xóa các biểu đồ hiện tại
-        for widget in self.graph_frame.winfo_children():
-            widget.destroy()
-
-        try:
-            # Đọc và xử lý dữ liệu từ tệp log
-            with open(self.log_file, "r", encoding="utf-8", errors="replace") as f:
-                df = pd.read_csv(f)
-
-            # Kiểm tra các cột cần thiết
-            required_columns = {"Filename", "FileSize", "Duration", "Status", "Latency"}
-            if not required_columns.issubset(df.columns):
-                missing = required_columns - set(df.columns)
-                self.log_message(f"Missing columns in log file: {', '.join(missing)}")
-                return
-
-            # Lọc các dòng hợp lệ
-            df = df[(df["Duration"] > 0) & (df["FileSize"] > 0)]
-            df["Speed"] = df["FileSize"] / df["Duration"]
-
-            # Tạo một khung phụ để quản lý layout
-            graphs_subframe = tk.Frame(self.graph_frame)
-            graphs_subframe.pack(fill=tk.BOTH, expand=True)
-
-            # 1. Bandwidth Over Time
-            fig_bandwidth, ax_bandwidth = plt.subplots(figsize=(5, 4))
-            ax_bandwidth.plot(df.index + 1, df["Speed"], marker='o', linestyle='-', color='blue')
-            ax_bandwidth.set_title("Transmission speed")
-            ax_bandwidth.set_xlabel("Transfer Number")
-            ax_bandwidth.set_ylabel("Speed (bytes/second)")
-            ax_bandwidth.grid(True)
-            canvas_bandwidth = FigureCanvasTkAgg(fig_bandwidth, master=graphs_subframe)
-            canvas_bandwidth.draw()
-            canvas_bandwidth.get_tk_widget().pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=5, pady=5)
-
-           
-
-            # 3. File Size vs Transfer Time
-            fig_file_size_time, ax_file_size_time = plt.subplots(figsize=(5, 4))
-            ax_file_size_time.scatter(df["FileSize"], df["Duration"], color='green')
-            ax_file_size_time.set_title("File Size vs. Transfer Time")
-            ax_file_size_time.set_xlabel("File Size (bytes)")
-            ax_file_size_time.set_ylabel("Transfer Time (seconds)")
-            ax_file_size_time.grid(True)
-            canvas_file_size_time = FigureCanvasTkAgg(fig_file_size_time, master=graphs_subframe)
-            canvas_file_size_time.draw()
-            canvas_file_size_time.get_tk_widget().pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=5, pady=5)
-
-            # 4. Latency Over Transfers
-            fig_latency, ax_latency = plt.subplots(figsize=(5, 4))
-            ax_latency.plot(df.index + 1, df["Latency"], marker='o', linestyle='-', color='purple')
-            ax_latency.set_title("Latency Over Transfers")
-            ax_latency.set_xlabel("Transfer Number")
-            ax_latency.set_ylabel("Latency (ms)")
-            ax_latency.grid(True)
-            canvas_latency = FigureCanvasTkAgg(fig_latency, master=graphs_subframe)
-            canvas_latency.draw()
-            canvas_latency.get_tk_widget().pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=5, pady=5)
-
-        except pd.errors.EmptyDataError:
-            self.log_message("Log file is empty. No data to display.")
-        except pd.errors.ParserError as e:
-            self.log_message(f"Error parsing log file: {e}")
-        except KeyError as e:
-            self.log_message(f"Missing expected column in log file: {e}")
-        except Exception as e:
-            self.log_message(f"Error updating graphs: {e}")
-
-    
     def on_closing(self):
         if self.running:
             self.stop_server()
+        self.bus.close()
+        self.dashboard.close()
         self.master.destroy()
 
-    # Optional: Implement periodic graph updates
-    """
-    def start_graph_refresh(self):
-        self.update_graphs()
-        # Schedule the next update after 60 seconds (60000 milliseconds)
-        self.master.after(60000, self.start_graph_refresh)
-    """
 
 def main():
+    config = build_arg_parser("File Sharing Server (Tkinter dashboard)").parse_args()
     root = tk.Tk()
-    app = FileServerApp(root)
+    app = FileServerApp(root, config)
     root.protocol("WM_DELETE_WINDOW", app.on_closing)
     root.mainloop()
 
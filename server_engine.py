@@ -0,0 +1,2035 @@
+import argparse
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from admission import DEFAULT_QUEUE_TIMEOUT, AdmissionGate, AdmissionRejected
+from chunkstore import CHUNK_RECORD, MAX_CHUNK_SIZE, MIN_CHUNK_SIZE, ChunkIndex, decode_manifest
+from compression import MAX_COMPRESSED_FRAME, BlockCompressor, BlockDecoder, format_compression, parse_compression
+from delta import DELTA_OP, OP_COPY, OP_LITERAL, block_size_for, decode_ops, file_signatures
+from fileindex import FileIndex
+from metrics import SIZE_BUCKETS, MetricsRegistry, MetricsServer, TransferLogWriter
+from mux import MuxStream, MuxWriter
+from protocol import (
+    BATCH_BUSY, BATCH_ENTRY, BATCH_FAILED, BATCH_INVALID_NAME, BATCH_STORED,
+    FLAG_END, OP_BATCH_UPLOAD, OP_CANCEL, OP_CHUNK_UPLOAD, OP_COMMIT, OP_DATA, OP_DELTA_UPLOAD, OP_DELETE, OP_DOWNLOAD, OP_LIST, OP_MUX, OP_REPLY,
+    OP_STRIPE_COMMIT, OP_STRIPE_OPEN, OP_STRIPE_PUT, OP_UPLOAD, OP_WINDOW, OPCODE_NAMES,
+    DEFAULT_BUFFER_SIZE, DEFAULT_LIST_PAGE, FLAG_COMPRESSED, LIST_SORT_KEYS, MAX_LIST_PAGE, MUX_CREDIT, MUX_FRAME_SIZE,
+    MUX_MAX_STREAMS, MUX_WINDOW_FRAMES,
+    BufferPool, ProtocolError, decode_message, encode_batch_result, encode_list_entry, encode_message, pack_header,
+)
+from scheduling import DEFAULT_AGING_RATE, ScheduledFrameReader, TransferScheduler
+from shaping import DOWNLOAD, TrafficShaper
+from partials import (
+    STATE_DIR_NAME, OffsetWriter, PartialUploads, combine_range_digests, file_etag, hash_file, hash_file_range,
+    place_file, preallocate, prune_empty_dirs,
+)
+
+logger = logging.getLogger("server_engine")
+
+DEFAULT_HOST = "0.0.0.0"
+DEFAULT_PORT = 9999
+DEFAULT_WORKERS = 4
+
+# FileSize là số byte thực của file (logical), WireBytes là số byte body thực sự
+# đi qua mạng (nhỏ hơn khi nén, dedup hoặc delta)
+LOG_COLUMNS = ["Filename", "FileSize", "Duration", "Status", "Latency", "Operation", "Method", "Throughput",
+               "WireBytes"]
+LOG_HEADER = ",".join(LOG_COLUMNS) + "\n"
+# Header của các phiên bản log cũ -> phần thêm vào cuối mỗi dòng khi nâng cấp
+LEGACY_LOG_HEADERS = {
+    "Filename,FileSize,Duration,Status,Latency\n": ",UPLOAD,,,",
+    "Filename,FileSize,Duration,Status,Latency,Operation,Method,Throughput\n": ",",
+}
+CHUNK_SIZE = 4096
+
+# Cách gửi file cho DOWNLOAD: "sendfile" dùng os.sendfile của kernel (tự động
+# quay về đọc/gửi qua buffer nếu không hỗ trợ), "copy" là vòng read()/sendall() cũ
+DOWNLOAD_METHODS = ("sendfile", "copy")
+# Buffer đọc frame nhỏ cho mỗi kết nối: phần lớn kết nối chỉ chờ lệnh
+READER_BUFFER_SIZE = 8 * 1024
+# Khối đọc khi chép dữ liệu từ bản cũ trong upload delta
+COPY_BLOCK_SIZE = 1024 * 1024
+# Upload hàng loạt: file nhỏ hơn mức này được giữ trong bộ nhớ và ghi theo nhóm
+# khoảng BATCH_FLUSH_BYTES; file lớn hơn được ghi thẳng ra đĩa trong lúc nhận
+BATCH_SMALL_FILE_SIZE = 256 * 1024
+BATCH_FLUSH_BYTES = 4 * 1024 * 1024
+# Phiên upload song song không có hoạt động trong khoảng này sẽ bị huỷ
+STRIPE_SESSION_TIMEOUT = 3600
+# Giới hạn mặc định của admission control (None: không giới hạn)
+DEFAULT_MAX_CONNECTIONS = 256
+DEFAULT_MAX_TRANSFERS = 32
+# Kết nối bị từ chối vẫn được đọc yêu cầu đầu tiên (trong thời gian này) để trả BUSY
+REJECT_READ_TIMEOUT = 5.0
+# sendfile được gọi theo từng đoạn để giới hạn băng thông đổi lúc đang chạy vẫn có hiệu lực
+SENDFILE_SLICE = 16 * 1024 * 1024
+# Các yêu cầu truyền dữ liệu, phải qua transfer_gate; trọng số là số byte của yêu cầu
+TRANSFER_OPCODES = (OP_UPLOAD, OP_DOWNLOAD, OP_STRIPE_PUT, OP_CHUNK_UPLOAD, OP_DELTA_UPLOAD, OP_BATCH_UPLOAD)
+
+
+class StripeSession:
+    # Một upload song song: file đích đã cấp phát trước, các dải byte đã nhận đủ
+    # cùng SHA-256 của từng dải (tính khi nhận), và SHA-256 của cả file được băm
+    # dần theo phần đầu file đã liền mạch (hashed byte đầu)
+    def __init__(self, token, filename, filesize, path):
+        self.token = token
+        self.filename = filename
+        self.filesize = filesize
+        self.path = path
+        self.ranges = []
+        self.digests = {}
+        self.hasher = hashlib.sha256()
+        self.hashed = 0
+        self.hashing = None
+        self.active_puts = 0
+        self.started = time.perf_counter()
+        self.last_activity = time.monotonic()
+
+    def add_range(self, offset, length, digest):
+        self.ranges.append((offset, length))
+        self.digests[offset] = (length, digest)
+        self.last_activity = time.monotonic()
+
+    def is_complete(self):
+        # Các dải đã nhận (có thể gửi lại, chồng nhau) phải phủ kín [0, filesize)
+        covered = 0
+        for offset, length in sorted(self.ranges):
+            if offset > covered:
+                return False
+            covered = max(covered, offset + length)
+        return covered >= self.filesize
+
+
+def ensure_transfer_log(log_file):
+    # Khởi tạo tệp log với các cột bao gồm 'Latency'
+    if not os.path.exists(log_file):
+        with open(log_file, "w", encoding="utf-8") as f:
+            f.write(LOG_HEADER)
+        return
+
+    # Nâng cấp log cũ (ít cột hơn) lên định dạng mới
+    with open(log_file, "r", encoding="utf-8", errors="replace") as f:
+        suffix = LEGACY_LOG_HEADERS.get(f.readline())
+        if suffix is None:
+            return
+        rows = f.readlines()
+    with open(log_file, "w", encoding="utf-8") as f:
+        f.write(LOG_HEADER)
+        for row in rows:
+            if row.strip():
+                f.write(row.rstrip("\r\n") + suffix + "\n")
+
+
+class FileServerEngine:
+    # Engine asyncio không phụ thuộc GUI: mỗi kết nối là một coroutine trên cùng
+    # một event loop, thao tác đĩa blocking chạy trên pool `workers` thread.
+    # GUI hoặc CLI chỉ quan sát qua các sự kiện phát ra bởi emit().
+    #
+    # Sự kiện:
+    #   log            message
+    #   transfer       operation, method, filename, filesize, duration, status, latency, speed, wire_bytes
+    #   files_changed  filename, deleted (không có filename: cả danh sách đã đổi)
+    #   stats          total_transfers, failed_transfers, admission (admission_stats()), shaping
+    #   admission      gate, retry_after, client, active, queued, rejected... (một yêu cầu bị từ chối)
+    #   dedup          logical_bytes, wire_bytes, bytes_saved, ratio
+    #   log_flushed    rows (một lô dòng mới đã được ghi vào transfer log)
+    #   started        host, port
+    #   stopped
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, received_files_path="received_files",
+                 log_file="transfer_log.csv", backlog=1024, download_method="sendfile",
+                 buffer_size=DEFAULT_BUFFER_SIZE, workers=DEFAULT_WORKERS, compression=True,
+                 max_connections=DEFAULT_MAX_CONNECTIONS, max_transfers=DEFAULT_MAX_TRANSFERS,
+                 max_inflight_bytes=None, queue_timeout=DEFAULT_QUEUE_TIMEOUT,
+                 global_rate=None, upload_rate=None, download_rate=None, client_rate=None,
+                 transfer_aging=DEFAULT_AGING_RATE, metrics_host="127.0.0.1", metrics_port=None):
+        if download_method not in DOWNLOAD_METHODS:
+            raise ValueError(f"download_method must be one of {DOWNLOAD_METHODS}")
+        if workers < 0:
+            raise ValueError("workers must be >= 0")
+        for name, limit in (("max_connections", max_connections), ("max_transfers", max_transfers),
+                            ("max_inflight_bytes", max_inflight_bytes)):
+            if limit is not None and limit < 1:
+                raise ValueError(f"{name} must be >= 1 or None")
+        self.host = host
+        self.port = port
+        self.received_files_path = received_files_path
+        self.log_file = log_file
+        self.backlog = backlog
+        self.download_method = download_method
+        self.workers = workers
+        # Cho phép client thoả thuận nén body (zlib/lzma/bz2)
+        self.compression = compression
+        self.executor = None
+        # Buffer nhận upload được cấp phát trước và dùng lại giữa các lần truyền
+        self.buffers = BufferPool(buffer_size)
+        self.partials = PartialUploads(received_files_path)
+        # Metadata (kích thước, mtime, SHA-256) của các file đã lưu cho LIST/DOWNLOAD
+        self.file_index = FileIndex(received_files_path)
+        self._hashing = set()
+        # Tên file đang được upload; hai client không được ghi cùng một file
+        self.active_uploads = set()
+        self.stripe_sessions = {}
+        # Chỉ mục chunk cho upload khử trùng lặp
+        self.chunk_index = ChunkIndex(received_files_path)
+        # Admission control: số kết nối được phục vụ, số lượt truyền và tổng byte
+        # đang truyền cùng lúc; phần vượt xếp hàng tối đa queue_timeout giây
+        self.connection_gate = AdmissionGate("connection", max_connections, timeout=queue_timeout)
+        # Lượt truyền nhỏ được ưu tiên (SRPT có aging, transfer_aging byte/giây; None là FIFO)
+        self.transfer_gate = TransferScheduler("transfer", max_transfers, max_inflight_bytes, timeout=queue_timeout,
+                                               aging=transfer_aging)
+        # Ticket của lượt download đang chạy trên mỗi socket / MuxStream
+        self.transfer_tickets = {}
+        # Giới hạn băng thông (byte/giây): toàn server, theo chiều, theo client
+        self.shaper = TrafficShaper(global_rate, upload_rate, download_rate, client_rate)
+
+        self.server_socket = None
+        self.loop = None
+        self.thread = None
+        self.running = False
+        self._stop_requested = False
+        self._stopped = None
+        self._client_tasks = set()
+        self.listeners = []
+
+        # Các chỉ số hiệu suất (an toàn giữa các thread); metrics_port khác None thì
+        # được xuất ở http://metrics_host:metrics_port/metrics dạng Prometheus
+        self.metrics = MetricsRegistry("filetransfer_")
+        self.register_metrics()
+        self.metrics_host = metrics_host
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        # Transfer log CSV được ghi theo lô trên thread nền trong lúc server chạy
+        self.transfer_log = None
+
+        os.makedirs(self.received_files_path, exist_ok=True)
+        ensure_transfer_log(self.log_file)
+
+    # ---- Sự kiện -------------------------------------------------------
+
+    def add_listener(self, callback):
+        # callback(event, data) được gọi từ thread của event loop
+        self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+    def emit(self, event, **data):
+        for callback in list(self.listeners):
+            try:
+                callback(event, data)
+            except Exception:
+                # Lỗi của một listener không được chặn các listener khác, nhưng phải để lại dấu vết
+                logger.exception(f"Listener {callback!r} failed while handling '{event}' event")
+
+    def log_message(self, message):
+        self.emit("log", message=message)
+
+    # ---- Chỉ số ---------------------------------------------------------
+
+    def register_metrics(self):
+        metrics = self.metrics
+        self.results = metrics.counter("requests_total", "Completed (success) and failed requests", ("result",))
+        self.transfers = metrics.counter("transfers_total", "Logged transfers", ("operation", "method", "status"))
+        self.transfer_seconds = metrics.histogram("transfer_duration_seconds", "Transfer duration", ("operation",))
+        self.transfer_sizes = metrics.histogram("transfer_size_bytes", "Transfer size", ("operation",),
+                                                buckets=SIZE_BUCKETS)
+        self.transfer_bytes = metrics.counter("transfer_bytes_total", "Bytes transferred", ("operation", "kind"))
+        self.dedup_bytes = metrics.counter("dedup_bytes_total", "Deduplicated upload bytes (file vs wire)",
+                                           ("kind",))
+        # Đọc trạng thái của engine lúc scrape: chỉ đọc số nguyên, không duyệt cấu trúc của event loop
+        def per_gate(value):
+            return lambda: {(gate.name,): value(gate) for gate in (self.connection_gate, self.transfer_gate)}
+
+        metrics.gauge("admission_active", "Requests holding an admission slot", ("gate",),
+                      callback=per_gate(lambda gate: gate.active))
+        metrics.gauge("admission_queued", "Requests waiting for an admission slot", ("gate",),
+                      callback=per_gate(lambda gate: len(gate.waiters)))
+        metrics.counter("admission_admitted_total", "Admitted requests", ("gate",),
+                        callback=per_gate(lambda gate: gate.admitted))
+        metrics.counter("admission_rejected_total", "Requests answered BUSY", ("gate",),
+                        callback=per_gate(lambda gate: gate.rejected))
+        metrics.counter("scheduler_preemptions_total", "Transfers paused for a smaller one",
+                        callback=lambda: self.transfer_gate.preempted)
+        metrics.counter("shaping_throttled_seconds_total", "Time spent waiting for bandwidth tokens",
+                        callback=lambda: self.shaper.throttled_seconds)
+        metrics.gauge("connections", "Open client connections", callback=lambda: len(self._client_tasks))
+
+    @property
+    def total_transfers(self):
+        return self.results.value(result="success")
+
+    @property
+    def failed_transfers(self):
+        return self.results.value(result="failure")
+
+    def record_failure(self, count=1):
+        self.results.inc(count, result="failure")
+        self.emit("stats", total_transfers=self.total_transfers, failed_transfers=self.failed_transfers,
+                  admission=self.admission_stats(), shaping=self.shaper.stats())
+
+    def record_success(self, count=1):
+        self.results.inc(count, result="success")
+        self.emit("stats", total_transfers=self.total_transfers, failed_transfers=self.failed_transfers,
+                  admission=self.admission_stats(), shaping=self.shaper.stats())
+
+    def set_rate_limits(self, client=None, **limits):
+        # Đổi giới hạn băng thông khi đang chạy, gọi được từ thread bất kỳ (GUI).
+        # client: địa chỉ IP để đặt mức riêng (limits chỉ có "rate"); không có thì
+        # limits là global_rate, upload_rate, download_rate, client_rate
+        def apply():
+            if client is not None:
+                self.shaper.set_client_rate(client, limits.get("rate"))
+            else:
+                self.shaper.set_limits(**limits)
+            self.log_message(f"Rate limits changed: {self.shaper.stats()}")
+
+        try:
+            in_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            in_loop = False
+        if self.loop is None or in_loop or not self.loop.is_running():
+            apply()
+        else:
+            async def apply_in_loop():
+                apply()
+            asyncio.run_coroutine_threadsafe(apply_in_loop(), self.loop).result()
+
+    async def run_io(self, func, *args):
+        # Thao tác đĩa blocking: chạy trên pool worker nếu có, nếu không thì ngay trên loop
+        if self.executor is None:
+            return func(*args)
+        return await self.loop.run_in_executor(self.executor, func, *args)
+
+    async def record_transfer(self, operation, method, filename, filesize, duration, status, wire_bytes=None):
+        # Cập nhật metrics, đưa một dòng vào transfer log (ghi theo lô) và phát sự
+        # kiện "transfer"; wire_bytes mặc định bằng filesize (gửi thô)
+        if wire_bytes is None:
+            wire_bytes = filesize
+        transfer_speed = filesize / duration if duration > 0 else 0
+        latency = duration * 1000  # Convert to milliseconds
+        self.transfers.inc(operation=operation, method=method, status=status)
+        self.transfer_seconds.observe(duration, operation=operation)
+        self.transfer_sizes.observe(filesize, operation=operation)
+        self.transfer_bytes.inc(filesize, operation=operation, kind="logical")
+        self.transfer_bytes.inc(wire_bytes, operation=operation, kind="wire")
+        self.transfer_log.write([
+            filename, filesize, f"{duration:.2f}", status, f"{latency:.2f}",
+            operation, method, f"{transfer_speed:.0f}", wire_bytes,
+        ])
+        self.emit("transfer", operation=operation, method=method, filename=filename, filesize=filesize,
+                  duration=duration, status=status, latency=latency, speed=transfer_speed, wire_bytes=wire_bytes)
+        return transfer_speed, latency
+
+    # ---- Vòng đời ------------------------------------------------------
+
+    def bind(self):
+        # Bind đồng bộ để lỗi (cổng bận, sai địa chỉ...) được báo ngay cho người gọi
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server_socket.bind((self.host, self.port))
+            server_socket.listen(self.backlog)
+            server_socket.setblocking(False)
+        except Exception:
+            server_socket.close()
+            raise
+        self.server_socket = server_socket
+        self.port = server_socket.getsockname()[1]
+
+    def start(self):
+        # Chạy event loop trong một thread nền (dùng cho GUI)
+        self.bind()
+        self.thread = threading.Thread(target=self._run_loop, daemon=True)
+        self.thread.start()
+
+    def _run_loop(self):
+        try:
+            asyncio.run(self.serve_forever())
+        except Exception as e:
+            self.log_message(f"Server loop crashed: {e}")
+        finally:
+            self.running = False
+
+    def call_in_loop(self, callback):
+        # Chạy callback trên thread của event loop (gọi từ thread khác)
+        try:
+            self.loop.call_soon_threadsafe(callback)
+        except RuntimeError:
+            pass  # Loop đã đóng
+
+    def stop(self):
+        # An toàn khi gọi từ thread khác
+        self._stop_requested = True
+        self.running = False
+        if self.loop is not None and self._stopped is not None:
+            try:
+                self.loop.call_soon_threadsafe(self._stopped.set)
+            except RuntimeError:
+                pass  # Loop đã đóng
+
+    async def serve_forever(self):
+        if self.server_socket is None:
+            self.bind()
+        self.loop = asyncio.get_running_loop()
+        if self.workers:
+            self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix="file-io")
+        self._stopped = asyncio.Event()
+        if self._stop_requested:
+            self._stopped.set()
+        self.running = not self._stop_requested
+        self.transfer_log = TransferLogWriter(
+            self.log_file,
+            on_flush=lambda rows: self.call_in_loop(lambda: self.emit("log_flushed", rows=rows)),
+            on_error=lambda e: self.call_in_loop(lambda: self.log_message(f"Error writing transfer log: {e}")))
+        if self.metrics_port is not None:
+            try:
+                self.metrics_server = MetricsServer(self.metrics, self.metrics_host, self.metrics_port).start()
+                self.log_message(f"Metrics available at http://{self.metrics_server.host}:{self.metrics_server.port}/metrics")
+            except OSError as e:
+                self.log_message(f"Could not start metrics endpoint: {e}")
+        # Chỉ mục file, chỉ mục chunk (dedup) và việc dọn upload dở đã hết hạn phải
+        # xong trước khi nhận kết nối đầu tiên: yêu cầu đến sớm không được thấy chỉ
+        # mục rỗng, và việc dọn không được chạy song song với một lần resume
+        files = await self.run_io(self.file_index.load)
+        self.emit("files_changed")
+        expired = await self.run_io(self.partials.cleanup_expired)
+        indexed = await self.run_io(self.chunk_index.load)
+        accept_task = self.loop.create_task(self.accept_clients())
+        self.emit("started", host=self.host, port=self.port)
+        self.log_message(f"Server started on {self.host}:{self.port}.")
+        self.log_message(f"Indexed {files} stored file(s).")
+        if expired:
+            self.log_message(f"Removed {expired} expired partial upload(s).")
+        if indexed:
+            self.log_message(f"Loaded chunk index for {indexed} file(s).")
+        try:
+            await self._stopped.wait()
+        finally:
+            accept_task.cancel()
+            for task in list(self._client_tasks):
+                task.cancel()
+            await asyncio.gather(accept_task, *self._client_tasks, return_exceptions=True)
+            self.server_socket.close()
+            self.server_socket = None
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+            if self.metrics_server is not None:
+                self.metrics_server.close()
+                self.metrics_server = None
+            self.transfer_log.close()
+            self.file_index.close()
+            self.running = False
+            self.log_message("Server stopped.")
+            self.emit("stopped")
+
+    async def accept_clients(self):
+        while self.running:
+            try:
+                client_socket, client_address = await self.loop.sock_accept(self.server_socket)
+            except asyncio.CancelledError:
+                raise
+            except OSError as e:
+                self.log_message(f"Error accepting client: {e}")
+                await asyncio.sleep(0.1)
+                continue
+            client_socket.setblocking(False)
+            task = self.loop.create_task(self.handle_client(client_socket, client_address))
+            self._client_tasks.add(task)
+            task.add_done_callback(self._client_tasks.discard)
+            self.log_message(f"Client connected: {client_address}")
+
+    # ---- Xử lý yêu cầu -------------------------------------------------
+
+    async def handle_client(self, client_socket, client_address):
+        # Mọi byte upload nhận qua reader này đều đi qua shaper và scheduler
+        reader = ScheduledFrameReader(client_socket, self.loop, READER_BUFFER_SIZE, self.shaper, client_address[0])
+        admitted = False
+        try:
+            # Đủ max_connections thì kết nối mới chờ (chưa đọc yêu cầu nào) tới khi có chỗ
+            try:
+                await self.connection_gate.acquire()
+                admitted = True
+            except AdmissionRejected as e:
+                await self.reject_connection(client_socket, reader, client_address, e)
+                return
+            while self.running:
+                header = await reader.read_header()
+                if header is None:
+                    break
+                if header.opcode == OP_DATA:
+                    raise ProtocolError("Unexpected DATA frame outside of an UPLOAD request")
+                request = decode_message(await reader.readexactly(header.length))
+                ticket = None
+                if header.opcode in TRANSFER_OPCODES:
+                    ticket = await self.admit_transfer(client_socket, reader, header.request_id, header.opcode,
+                                                       request, client_address)
+                    if ticket is None:
+                        continue
+                    reader.ticket = self.transfer_tickets[client_socket] = ticket
+                try:
+                    await self.dispatch(client_socket, reader, header, request, client_address)
+                finally:
+                    if ticket is not None:
+                        reader.ticket = None
+                        del self.transfer_tickets[client_socket]
+                        self.transfer_gate.finish(ticket)
+                if header.opcode == OP_MUX:
+                    break
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self.log_message(f"Error handling client {client_address}: {e}")
+            self.record_failure()
+        finally:
+            client_socket.close()
+            if admitted:
+                self.connection_gate.release()
+            self.log_message(f"Client disconnected: {client_address}")
+
+    async def dispatch(self, client_socket, reader, header, request, client_address):
+        if header.opcode == OP_UPLOAD:
+            await self.handle_upload(client_socket, reader, header.request_id, request)
+        elif header.opcode == OP_LIST:
+            await self.handle_list(client_socket, header.request_id, request)
+        elif header.opcode == OP_DOWNLOAD:
+            await self.handle_download(client_socket, header.request_id, request, client_address)
+        elif header.opcode == OP_DELETE:
+            await self.handle_delete(client_socket, header.request_id, request)
+        elif header.opcode == OP_STRIPE_OPEN:
+            await self.handle_stripe_open(client_socket, header.request_id, request)
+        elif header.opcode == OP_STRIPE_PUT:
+            await self.handle_stripe_put(client_socket, reader, header.request_id, request)
+        elif header.opcode == OP_STRIPE_COMMIT:
+            await self.handle_stripe_commit(client_socket, header.request_id, request)
+        elif header.opcode == OP_CHUNK_UPLOAD:
+            await self.handle_chunk_upload(client_socket, reader, header.request_id, request)
+        elif header.opcode == OP_DELTA_UPLOAD:
+            await self.handle_delta_upload(client_socket, reader, header.request_id, request)
+        elif header.opcode == OP_BATCH_UPLOAD:
+            await self.handle_batch_upload(client_socket, reader, header.request_id)
+        elif header.opcode == OP_MUX:
+            await self.send_reply(client_socket, header.request_id, status="MUX_READY",
+                                  frame_size=MUX_FRAME_SIZE, max_streams=MUX_MAX_STREAMS, window=MUX_WINDOW_FRAMES)
+            await self.serve_multiplexed(client_socket, reader, client_address)
+        else:
+            await self.send_reply(client_socket, header.request_id, status="ERROR", message="Unknown command.")
+
+    # ---- Admission control ---------------------------------------------
+
+    def transfer_weight(self, opcode, request):
+        # Số byte một yêu cầu sẽ truyền, theo kích thước khai báo (hoặc của file đang lưu)
+        if opcode == OP_DOWNLOAD:
+            size = request.get("length")
+            if not isinstance(size, int):
+                filename = request.get("filename")
+                entry = self.file_index.get(self.safe_filename(filename)) if isinstance(filename, str) else None
+                size = entry.st_size if entry is not None else 0
+        elif opcode == OP_STRIPE_PUT:
+            size = request.get("length")
+        elif opcode == OP_BATCH_UPLOAD:
+            size = request.get("total")
+        else:
+            size = request.get("filesize")
+        return size if isinstance(size, int) and size > 0 else 0
+
+    @staticmethod
+    def body_follows(opcode, request):
+        # Client gửi body ngay sau yêu cầu mà không chờ phản hồi
+        return (opcode in (OP_STRIPE_PUT, OP_CHUNK_UPLOAD, OP_BATCH_UPLOAD)
+                or (opcode == OP_UPLOAD and not request.get("resume")))
+
+    async def discard_body(self, reader):
+        # Đọc bỏ các frame DATA của yêu cầu bị từ chối, tới frame có FLAG_END
+        while True:
+            header = await reader.read_header()
+            if header is None:
+                raise ConnectionError("Connection closed while discarding a request body")
+            if header.opcode != OP_DATA:
+                raise ProtocolError(f"Expected DATA frame, got opcode {header.opcode:#x}")
+            if not await self.skip_bytes(reader, header.length):
+                raise ConnectionError("Connection closed while discarding a request body")
+            if header.flags & FLAG_END:
+                return
+
+    def report_rejection(self, gate, error, client_address):
+        self.log_message(f"Rejected {gate.name} from {client_address}: {error}")
+        self.emit("admission", gate=gate.name, retry_after=error.retry_after, client=str(client_address),
+                  **gate.stats())
+
+    async def admit_transfer(self, client_socket, reader, request_id, opcode, request, client_address):
+        # Chờ chỗ trong transfer_gate. Trả về TransferTicket đang giữ chỗ (gọi
+        # transfer_gate.finish sau khi xong), hoặc None nếu đã trả lời BUSY
+        try:
+            return await self.transfer_gate.admit(self.transfer_weight(opcode, request))
+        except AdmissionRejected as e:
+            self.report_rejection(self.transfer_gate, e, client_address)
+            if reader is not None and self.body_follows(opcode, request):
+                await self.discard_body(reader)
+            await self.send_reply(client_socket, request_id, status="BUSY", retry_after=e.retry_after,
+                                  message=f"Server is busy; retry in {e.retry_after} s.")
+            return None
+
+    async def reject_connection(self, client_socket, reader, client_address, error):
+        # Không có chỗ sau queue_timeout: trả BUSY cho yêu cầu đầu tiên rồi đóng
+        self.report_rejection(self.connection_gate, error, client_address)
+        try:
+            header = await asyncio.wait_for(reader.read_header(), REJECT_READ_TIMEOUT)
+        except (asyncio.TimeoutError, OSError, ProtocolError):
+            return
+        if header is not None and header.opcode != OP_DATA:
+            await self.send_reply(client_socket, header.request_id, status="BUSY", retry_after=error.retry_after,
+                                  message=f"Server is busy; retry in {error.retry_after} s.")
+
+    def admission_stats(self):
+        # Độ sâu hàng đợi, số đang chạy và thời gian chờ của từng cổng; với
+        # transfers thêm latency p50/p95/p99 theo nhóm kích thước
+        return {"connections": self.connection_gate.stats(), "transfers": self.transfer_gate.stats()}
+
+    async def send_bytes(self, client_socket, data, bulk=False):
+        # client_socket là socket, hoặc MuxStream khi kết nối đang ghép kênh; bulk
+        # đánh dấu frame DATA của body lớn (nhường cho frame điều khiển)
+        if isinstance(client_socket, MuxStream):
+            await client_socket.send(data, bulk)
+        else:
+            await self.loop.sock_sendall(client_socket, data)
+
+    @staticmethod
+    def peer_host(client_socket):
+        # Địa chỉ IP của client, là khoá của bucket băng thông theo client
+        sock = client_socket.writer.sock if isinstance(client_socket, MuxStream) else client_socket
+        try:
+            return sock.getpeername()[0]
+        except OSError:
+            return None
+
+    async def send_reply(self, client_socket, request_id, **fields):
+        await self.send_bytes(client_socket, encode_message(OP_REPLY, request_id, **fields))
+
+    async def serve_multiplexed(self, client_socket, reader, client_address):
+        # Mỗi yêu cầu LIST/DOWNLOAD/DELETE chạy thành một task riêng; mọi frame trả
+        # về đi qua một MuxWriter, nên một download lớn không chặn LIST hay DELETE
+        # gửi sau nó trên cùng kết nối. Đủ MUX_MAX_STREAMS yêu cầu thì ngừng đọc
+        # yêu cầu mới cho tới khi có yêu cầu xong (backpressure qua TCP)
+        writer = MuxWriter(self.loop, client_socket)
+        slots = asyncio.Semaphore(MUX_MAX_STREAMS)
+        streams = {}
+        channels = {}  # request id -> MuxStream, để nhận credit / lệnh huỷ của client
+        handlers = {
+            OP_LIST: lambda stream, request_id, request: self.handle_list(stream, request_id, request),
+            OP_DOWNLOAD: lambda stream, request_id, request: self.handle_download(stream, request_id, request,
+                                                                                  client_address),
+            OP_DELETE: lambda stream, request_id, request: self.handle_delete(stream, request_id, request),
+        }
+
+        async def run(stream, opcode, handler, request):
+            ticket = None
+            try:
+                if opcode in TRANSFER_OPCODES:
+                    ticket = await self.admit_transfer(stream, None, stream.request_id, opcode, request, client_address)
+                    if ticket is None:
+                        return
+                    self.transfer_tickets[stream] = ticket
+                await handler(stream, stream.request_id, request)
+                await stream.drain()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.log_message(f"Error handling multiplexed request {stream.request_id} from {client_address}: {e}")
+                self.record_failure()
+                # Kết thúc riêng yêu cầu này, các yêu cầu khác trên kết nối vẫn chạy tiếp
+                try:
+                    if not stream.replied:
+                        await self.send_reply(stream, stream.request_id, status="ERROR", message="Request failed.")
+                    elif not stream.ended:
+                        await stream.send(pack_header(OP_DATA, stream.request_id, 0, FLAG_END))
+                except ConnectionError:
+                    pass
+            finally:
+                if ticket is not None:
+                    del self.transfer_tickets[stream]
+                    self.transfer_gate.finish(ticket)
+
+        def finished(request_id):
+            # Chạy cả khi task bị huỷ (OP_CANCEL) trước khi kịp bắt đầu
+            del streams[request_id]
+            del channels[request_id]
+            slots.release()
+
+        try:
+            while self.running:
+                header = await reader.read_header()
+                if header is None:
+                    break
+                if header.opcode == OP_DATA:
+                    # Body của một yêu cầu đã bị từ chối (vd. UPLOAD): đọc bỏ
+                    if not await self.skip_bytes(reader, header.length):
+                        break
+                    continue
+                if header.opcode in (OP_WINDOW, OP_CANCEL):
+                    payload = await reader.readexactly(header.length)
+                    stream = channels.get(header.request_id)
+                    # Yêu cầu đã xong thì bỏ qua: credit / lệnh huỷ có thể đến muộn
+                    if stream is None:
+                        continue
+                    if header.opcode == OP_CANCEL:
+                        streams[header.request_id].cancel()
+                    elif len(payload) == MUX_CREDIT.size:
+                        stream.add_credit(MUX_CREDIT.unpack(payload)[0])
+                    else:
+                        raise ProtocolError("Invalid WINDOW frame")
+                    continue
+                request = decode_message(await reader.readexactly(header.length))
+                stream = MuxStream(writer, header.request_id, MUX_WINDOW_FRAMES)
+                handler = handlers.get(header.opcode)
+                if handler is None:
+                    name = OPCODE_NAMES.get(header.opcode, f"{header.opcode:#x}")
+                    await self.send_reply(stream, header.request_id, status="ERROR",
+                                          message=f"{name} is not supported on a multiplexed connection.")
+                    continue
+                if header.request_id in streams:
+                    await self.send_reply(stream, header.request_id, status="ERROR",
+                                          message=f"Request {header.request_id} is already in progress.")
+                    continue
+                await slots.acquire()
+                channels[header.request_id] = stream
+                task = streams[header.request_id] = self.loop.create_task(run(stream, header.opcode, handler, request))
+                task.add_done_callback(lambda task, request_id=header.request_id: finished(request_id))
+            # Client đóng chiều gửi: trả lời nốt các yêu cầu đang chạy rồi mới đóng
+            await asyncio.gather(*streams.values(), return_exceptions=True)
+            await writer.drain()
+        finally:
+            for task in list(streams.values()):
+                task.cancel()
+            await asyncio.gather(*streams.values(), return_exceptions=True)
+            await writer.close()
+
+    @staticmethod
+    def _consume_chunk(f, hasher, data):
+        # Băm và ghi cùng một buffer trên thread worker
+        if hasher is not None:
+            hasher.update(data)
+        if f is not None:
+            f.write(data)
+
+    @staticmethod
+    def _decode_chunk(decoder, f, hasher, payload, limit):
+        # Giải nén một frame rồi băm và ghi như frame thô
+        try:
+            data = decoder.decode(payload, limit)
+        except (ValueError, OSError, EOFError) as e:
+            raise ProtocolError(f"Invalid compressed frame: {e}")
+        FileServerEngine._consume_chunk(f, hasher, data)
+        return len(data)
+
+    async def read_payload(self, reader, length):
+        # Đọc trọn payload của một frame vào bytearray riêng (không làm phình buffer
+        # đọc của kết nối). None nếu kết nối đóng giữa chừng
+        payload = bytearray(length)
+        view = memoryview(payload)
+        filled = 0
+        try:
+            while filled < length:
+                received = await reader.readinto(view[filled:])
+                if not received:
+                    return None
+                filled += received
+        finally:
+            view.release()
+        return payload
+
+    async def receive_body(self, reader, f, hasher=None, decoder=None, limit=None):
+        # Đọc các frame DATA cho tới frame có FLAG_END, recv_into thẳng vào một
+        # buffer lớn dùng lại và ghi từ memoryview ra file (không tạo bytes mới).
+        # Với decoder (nén đã thoả thuận), frame có FLAG_COMPRESSED được giải nén
+        # trước khi ghi; limit chặn tổng số byte sau giải nén.
+        # Trả về (số byte thực nhận được, đã nhận đủ body hay chưa)
+        buf = self.buffers.acquire()
+        view = memoryview(buf)
+        total_bytes = 0
+        try:
+            while True:
+                header = await reader.read_header()
+                if header is None:
+                    return total_bytes, False
+                if header.opcode != OP_DATA:
+                    raise ProtocolError(f"Expected DATA frame, got opcode {header.opcode:#x}")
+                if header.flags & FLAG_COMPRESSED:
+                    if decoder is None or header.length > MAX_COMPRESSED_FRAME:
+                        raise ProtocolError("Unexpected compressed DATA frame")
+                    payload = await self.read_payload(reader, header.length)
+                    if payload is None:
+                        return total_bytes, False
+                    allowed = MAX_COMPRESSED_FRAME if limit is None else limit - total_bytes
+                    total_bytes += await self.run_io(self._decode_chunk, decoder, f, hasher, payload, allowed)
+                    if header.flags & FLAG_END:
+                        return total_bytes, True
+                    continue
+                remaining = header.length
+                while remaining:
+                    wanted = min(len(view), remaining)
+                    filled = 0
+                    while filled < wanted:
+                        received = await reader.readinto(view[filled:wanted])
+                        if not received:
+                            break
+                        filled += received
+                    if filled and (f is not None or hasher is not None):
+                        await self.run_io(self._consume_chunk, f, hasher, view[:filled])
+                    if decoder is not None:
+                        decoder.count_raw(filled)
+                    total_bytes += filled
+                    remaining -= filled
+                    if filled < wanted:
+                        return total_bytes, False
+                if header.flags & FLAG_END:
+                    return total_bytes, True
+        finally:
+            view.release()
+            self.buffers.release(buf)
+
+    def negotiate_compression(self, spec):
+        # Chấp nhận codec client đề nghị nếu server cho phép nén và hiểu codec đó
+        if not self.compression or spec is None:
+            return None
+        try:
+            return parse_compression(spec)
+        except ValueError as e:
+            self.log_message(f"Compression '{spec}' refused: {e}")
+            return None
+
+    @staticmethod
+    def describe_compression(compression, logical_bytes, wire_bytes):
+        if compression is None:
+            return ""
+        ratio = logical_bytes / wire_bytes if wire_bytes else 0
+        return f" ({format_compression(compression)}: {wire_bytes} bytes on the wire, ratio {ratio:.2f})"
+
+    def safe_filename(self, filename):
+        # Đảm bảo tên file an toàn: đường dẫn tương đối "a/b/c" (đồng bộ thư mục) nằm
+        # trong thư mục lưu, không có "..", không đi vào thư mục trạng thái
+        if not isinstance(filename, str) or "\0" in filename:
+            return None
+        parts = [part for part in filename.replace("\\", "/").split("/") if part not in ("", ".")]
+        if not parts or ".." in parts or parts[0] == STATE_DIR_NAME:
+            return None
+        return "/".join(parts)
+
+    async def handle_upload(self, client_socket, reader, request_id, request):
+        filename = request.get("filename")
+        filesize = request.get("filesize")
+        # Với resume, client chờ UPLOAD_READY (kèm offset) rồi mới gửi body;
+        # nếu không, body theo ngay sau yêu cầu
+        resume = bool(request.get("resume"))
+        try:
+            # Log yêu cầu nhận
+            self.log_message(f"Received UPLOAD command: {request}")
+
+            safe_filename = self.safe_filename(filename)
+            if safe_filename is None:
+                error = "Invalid UPLOAD command. Payload must contain filename and filesize."
+            elif not isinstance(filesize, int) or filesize < 0:
+                error = "Filesize must be an integer."
+            elif safe_filename in self.active_uploads:
+                error = f"File '{safe_filename}' is already being uploaded."
+            else:
+                error = None
+            if error:
+                if not resume:
+                    # Vẫn phải đọc hết body để không lệch frame kế tiếp
+                    await self.receive_body(reader, None)
+                await self.send_reply(client_socket, request_id, status="ERROR", message=error)
+                self.record_failure()
+                self.log_message(f"Rejected UPLOAD command {request}: {error}")
+                return
+
+            self.active_uploads.add(safe_filename)
+            try:
+                await self.receive_upload(client_socket, reader, request_id, request, safe_filename, filesize, resume)
+            finally:
+                self.active_uploads.discard(safe_filename)
+
+        except Exception as e:
+            self.log_message(f"Failed to save file '{filename}': {e}")
+            # Không biết còn bao nhiêu byte body trên đường truyền, đóng kết nối
+            raise
+
+    async def receive_upload(self, client_socket, reader, request_id, request, safe_filename, filesize, resume):
+        # Dữ liệu được ghi vào file partial; chỉ khi đủ byte (và digest khớp nếu
+        # client gửi COMMIT) mới đổi tên sang received_files/<name>
+        f, offset, hasher = await self.run_io(
+            self.partials.prepare, safe_filename, filesize, request.get("mtime"), resume)
+        # Nén chỉ được thoả thuận qua UPLOAD_READY, nên cần chế độ resume
+        compression = self.negotiate_compression(request.get("compression")) if resume else None
+        decoder = BlockDecoder(compression) if compression is not None else None
+        if resume:
+            await self.send_reply(client_socket, request_id, status="UPLOAD_READY", offset=offset,
+                                  compression=format_compression(compression))
+            if offset:
+                self.log_message(f"Resuming upload of '{safe_filename}' at byte {offset} of {filesize}.")
+
+        # Ghi nhận thời gian bắt đầu
+        start_time = time.perf_counter()
+        try:
+            received, finished = await self.receive_body(reader, f, hasher, decoder, filesize - offset)
+        finally:
+            await self.run_io(f.close)
+        total_bytes = offset + received
+        wire_bytes = decoder.wire_bytes if decoder is not None else received
+
+        expected_digest = None
+        if finished and resume:
+            header, commit = await reader.read_message()
+            if header is None:
+                finished = False
+            elif header.opcode != OP_COMMIT or header.request_id != request_id:
+                raise ProtocolError(f"Expected COMMIT for upload {request_id}, got opcode {header.opcode:#x}")
+            else:
+                expected_digest = commit.get("sha256")
+        digest = hasher.hexdigest()
+
+        # Ghi nhận thời gian kết thúc
+        duration = time.perf_counter() - start_time  # Duration tính bằng giây
+
+        if not finished:
+            # Mất kết nối: giữ lại file partial để client resume sau
+            status = "INCOMPLETE"
+        elif total_bytes != filesize:
+            status = "INCOMPLETE"
+            await self.run_io(self.partials.discard, safe_filename)
+        elif expected_digest is not None and expected_digest != digest:
+            status = "CORRUPT"
+            await self.run_io(self.partials.discard, safe_filename)
+        else:
+            status = "SUCCESS"
+            await self.run_io(self.partials.finalize, safe_filename,
+                              os.path.join(self.received_files_path, safe_filename))
+            await self.run_io(self.file_index.put, safe_filename, digest)
+
+        # Ghi vào file log bao gồm latency
+        method = "recv" if compression is None else f"recv+{compression[0]}"
+        _, latency = await self.record_transfer("UPLOAD", method, safe_filename, received, duration, status, wire_bytes)
+
+        if status == "SUCCESS":
+            await self.send_reply(client_socket, request_id, status="UPLOAD_SUCCESS", received=total_bytes,
+                                  transferred=wire_bytes, sha256=digest)
+            self.log_message(f"File '{safe_filename}' ({total_bytes} bytes) received in {duration:.2f} seconds. Latency: {latency:.2f} ms"
+                             + self.describe_compression(compression, received, wire_bytes))
+            self.record_success()
+            self.emit("files_changed", filename=safe_filename, deleted=False)
+        elif status == "CORRUPT":
+            await self.send_reply(client_socket, request_id, status="UPLOAD_CORRUPT", received=total_bytes,
+                                  sha256=digest)
+            self.log_message(f"File '{safe_filename}' failed verification (sha256 {digest}, expected {expected_digest}); partial data discarded.")
+            self.record_failure()
+        else:
+            if finished:
+                await self.send_reply(client_socket, request_id, status="UPLOAD_INCOMPLETE", received=total_bytes)
+                self.log_message(f"File '{safe_filename}' incomplete. Received {total_bytes} of {filesize} bytes. Latency: {latency:.2f} ms")
+            else:
+                self.log_message(f"Upload of '{safe_filename}' interrupted at {total_bytes} of {filesize} bytes; kept for resume.")
+            self.record_failure()
+
+    # ---- Upload song song (striped) -----------------------------------
+
+    def expire_stripe_sessions(self):
+        now = time.monotonic()
+        for token, session in list(self.stripe_sessions.items()):
+            if not session.active_puts and now - session.last_activity > STRIPE_SESSION_TIMEOUT:
+                self.drop_stripe_session(session)
+                self.log_message(f"Striped upload of '{session.filename}' expired.")
+
+    def drop_stripe_session(self, session):
+        self.stripe_sessions.pop(session.token, None)
+        if session.hashing is not None:
+            session.hashing.cancel()
+        self.active_uploads.discard(session.filename)
+        try:
+            os.remove(session.path)
+        except OSError:
+            pass
+
+    async def handle_stripe_open(self, client_socket, request_id, request):
+        # Cấp phát trước file đích; các kết nối sau đó gửi STRIPE_PUT với token
+        self.expire_stripe_sessions()
+        filename = request.get("filename")
+        filesize = request.get("filesize")
+        safe_filename = self.safe_filename(filename)
+        if safe_filename is None or not isinstance(filesize, int) or filesize < 0:
+            await self.send_reply(client_socket, request_id, status="ERROR", message="Invalid STRIPE_OPEN command.")
+            return
+        if safe_filename in self.active_uploads:
+            await self.send_reply(client_socket, request_id, status="ERROR",
+                                  message=f"File '{safe_filename}' is already being uploaded.")
+            return
+
+        token = uuid.uuid4().hex
+        path = self.partials.stripe_path(token)
+        try:
+            await self.run_io(preallocate, path, filesize)
+        except Exception as e:
+            await self.send_reply(client_socket, request_id, status="ERROR", message="Unable to allocate file.")
+            self.log_message(f"Error preallocating '{safe_filename}' ({filesize} bytes): {e}")
+            return
+        self.active_uploads.add(safe_filename)
+        self.stripe_sessions[token] = StripeSession(token, safe_filename, filesize, path)
+        self.log_message(f"Striped upload of '{safe_filename}' ({filesize} bytes) opened.")
+        await self.send_reply(client_socket, request_id, status="STRIPE_READY", token=token)
+
+    async def handle_stripe_put(self, client_socket, reader, request_id, request):
+        session = self.stripe_sessions.get(request.get("token"))
+        offset = request.get("offset")
+        length = request.get("length")
+        if (session is None or not isinstance(offset, int) or not isinstance(length, int)
+                or offset < 0 or length < 0 or offset + length > session.filesize):
+            await self.receive_body(reader, None)
+            await self.send_reply(client_socket, request_id, status="ERROR", message="Invalid STRIPE_PUT command.")
+            return
+
+        # Mỗi dải được pwrite thẳng vào đúng vị trí trong file đã cấp phát, và
+        # băm trên chính buffer nhận được
+        session.active_puts += 1
+        hasher = hashlib.sha256()
+        try:
+            writer = await self.run_io(OffsetWriter, session.path, offset, offset + length)
+            try:
+                received, finished = await self.receive_body(reader, writer, hasher)
+            finally:
+                await self.run_io(writer.close)
+        finally:
+            session.active_puts -= 1
+
+        if not finished:
+            return
+        if received != length:
+            await self.send_reply(client_socket, request_id, status="ERROR",
+                                  message=f"Range at {offset} incomplete: {received} of {length} bytes.")
+            return
+        session.add_range(offset, length, hasher.hexdigest())
+        if session.hashing is None or session.hashing.done():
+            session.hashing = self.loop.create_task(self.hash_stripe_frontier(session))
+        await self.send_reply(client_socket, request_id, status="STRIPE_ACK", offset=offset, length=length)
+
+    async def hash_stripe_frontier(self, session):
+        # SHA-256 của cả file (cho chỉ mục) được băm theo thứ tự, mỗi khi dải nối
+        # tiếp phần đã băm đã về; chạy song song với các dải còn đang gửi (dữ liệu
+        # vừa ghi còn trong page cache) nên COMMIT không phải đọc lại cả file
+        while True:
+            length = session.digests.get(session.hashed, (0, None))[0]
+            if not length:
+                return
+            await self.run_io(hash_file_range, session.path, session.hashed, length, session.hasher)
+            session.hashed += length
+
+    async def handle_stripe_commit(self, client_socket, request_id, request):
+        session = self.stripe_sessions.get(request.get("token"))
+        if session is None:
+            await self.send_reply(client_socket, request_id, status="ERROR", message="Unknown stripe token.")
+            return
+        if session.active_puts or not session.is_complete():
+            await self.send_reply(client_socket, request_id, status="UPLOAD_INCOMPLETE",
+                                  message="Not all byte ranges have been received.")
+            return
+
+        # So SHA-256 của các dải (client gửi bản gộp ranges_sha256; client cũ gửi
+        # sha256 của cả file) rồi đổi tên nguyên tử sang vị trí cuối cùng
+        self.stripe_sessions.pop(session.token, None)
+        try:
+            if session.hashing is not None:
+                await session.hashing
+        except Exception as e:
+            self.log_message(f"Error hashing striped upload of '{session.filename}': {e}")
+        if session.hashed == session.filesize:
+            digest = session.hasher.hexdigest()
+        else:
+            # Dải chồng nhau hoặc lệch nhau (client khác cách chia): băm lại cả file
+            digest = (await self.run_io(hash_file, session.path, hashlib.sha256())).hexdigest()
+        duration = time.perf_counter() - session.started
+        expected_ranges = request.get("ranges_sha256")
+        expected_digest = request.get("sha256")
+        if ((expected_ranges is not None and expected_ranges != combine_range_digests(session.digests))
+                or (expected_digest is not None and expected_digest != digest)):
+            self.drop_stripe_session(session)
+            await self.record_transfer("UPLOAD", "striped", session.filename, session.filesize, duration, "CORRUPT")
+            await self.send_reply(client_socket, request_id, status="UPLOAD_CORRUPT", sha256=digest)
+            self.log_message(f"Striped upload of '{session.filename}' failed verification; discarded.")
+            self.record_failure()
+            return
+
+        try:
+            await self.run_io(place_file, session.path, os.path.join(self.received_files_path, session.filename))
+            await self.run_io(self.file_index.put, session.filename, digest)
+        finally:
+            self.active_uploads.discard(session.filename)
+        _, latency = await self.record_transfer("UPLOAD", "striped", session.filename, session.filesize,
+                                                duration, "SUCCESS")
+        await self.send_reply(client_socket, request_id, status="UPLOAD_SUCCESS", received=session.filesize,
+                              sha256=digest)
+        self.log_message(f"File '{session.filename}' ({session.filesize} bytes) received over parallel streams in {duration:.2f} seconds.")
+        self.record_success()
+        self.emit("files_changed", filename=session.filename, deleted=False)
+
+    # ---- Upload khử trùng lặp (chunk theo nội dung) -------------------
+
+    def record_dedup(self, logical_bytes, wire_bytes):
+        self.dedup_bytes.inc(logical_bytes, kind="logical")
+        self.dedup_bytes.inc(wire_bytes, kind="wire")
+        total_logical = self.dedup_bytes.value(kind="logical")
+        total_wire = self.dedup_bytes.value(kind="wire")
+        ratio = total_logical / total_wire if total_wire else 0
+        self.emit("dedup", logical_bytes=total_logical, wire_bytes=total_wire,
+                  bytes_saved=total_logical - total_wire, ratio=ratio)
+
+    @staticmethod
+    def _store_chunk(f, hasher, data, digest):
+        # Kiểm tra SHA-256 của chunk vừa nhận rồi ghi vào file partial
+        if hashlib.sha256(data).digest() != digest:
+            return False
+        if f is not None:
+            hasher.update(data)
+            f.write(data)
+        return True
+
+    @staticmethod
+    def _copy_within(f, hasher, offset, length):
+        # Chunk lặp lại trong chính file đang upload: chép từ phần đã ghi
+        f.flush()
+        with open(f.name, "rb") as source:
+            source.seek(offset)
+            data = source.read(length)
+        hasher.update(data)
+        f.write(data)
+
+    async def receive_chunk(self, reader, view, length):
+        # Mỗi chunk còn thiếu đi trong một frame DATA riêng
+        header = await reader.read_header()
+        if header is None:
+            return False
+        if header.opcode != OP_DATA or header.length != length:
+            raise ProtocolError(f"Expected a {length}-byte chunk, got opcode {header.opcode:#x} ({header.length} bytes)")
+        filled = 0
+        while filled < length:
+            received = await reader.readinto(view[filled:length])
+            if not received:
+                return False
+            filled += received
+        return True
+
+    async def handle_chunk_upload(self, client_socket, reader, request_id, request):
+        # Yêu cầu đi kèm body là manifest (độ dài + SHA-256 của từng chunk). Server
+        # trả CHUNKS_NEEDED cùng bitmap các chunk chưa có; client chỉ gửi các chunk đó,
+        # phần còn lại được chép từ các file đã lưu
+        filename = request.get("filename")
+        filesize = request.get("filesize")
+        count = request.get("chunks")
+        safe_filename = self.safe_filename(filename)
+        if (safe_filename is None or not isinstance(filesize, int) or filesize < 0
+                or not isinstance(count, int) or not 0 <= count <= filesize // MIN_CHUNK_SIZE + 1):
+            error = "Invalid CHUNK_UPLOAD command."
+        elif safe_filename in self.active_uploads:
+            error = f"File '{safe_filename}' is already being uploaded."
+        else:
+            error = None
+        manifest = io.BytesIO()
+        received, finished = await self.receive_body(reader, manifest if error is None else None)
+        if not finished:
+            return
+        chunks = None
+        if error is None and received == count * CHUNK_RECORD.size:
+            chunks = decode_manifest(manifest.getvalue())
+            if (sum(length for _, length, _ in chunks) != filesize
+                    or not all(0 < length <= MAX_CHUNK_SIZE for _, length, _ in chunks)):
+                chunks = None
+        if chunks is None:
+            await self.send_reply(client_socket, request_id, status="ERROR", message=error or "Invalid chunk manifest.")
+            self.record_failure()
+            return
+
+        self.active_uploads.add(safe_filename)
+        try:
+            await self.receive_chunk_upload(client_socket, reader, request_id, request, safe_filename,
+                                            filesize, chunks, received)
+        finally:
+            self.active_uploads.discard(safe_filename)
+
+    async def receive_chunk_upload(self, client_socket, reader, request_id, request, safe_filename,
+                                   filesize, chunks, manifest_size):
+        start_time = time.perf_counter()
+        # Bản cũ cùng tên (vd. upload thường) được chia chunk trước để dedup với nó
+        await self.run_io(self.chunk_index.index_file, safe_filename)
+        locations = await self.run_io(self.chunk_index.lookup, [digest for _, _, digest in chunks])
+
+        # Kế hoạch ghép file: chép từ file đã lưu, nhận qua mạng, hoặc chép lại
+        # một chunk đã nhận trước đó trong chính upload này
+        plan = []
+        first_seen = {}
+        bitmap = bytearray((len(chunks) + 7) // 8)
+        needed_bytes = 0
+        for i, ((offset, length, digest), location) in enumerate(zip(chunks, locations)):
+            if location is not None:
+                plan.append(("copy", digest, location))
+            elif digest in first_seen:
+                plan.append(("dup", digest, first_seen[digest]))
+            else:
+                first_seen[digest] = offset
+                bitmap[i // 8] |= 0x80 >> (i % 8)
+                needed_bytes += length
+                plan.append(("recv", digest, length))
+        reused_bytes = sum(location[2] for location in locations if location is not None)
+        await self.send_reply(client_socket, request_id, status="CHUNKS_NEEDED", needed=len(first_seen),
+                              bytes=needed_bytes, reused=reused_bytes)
+        await self.loop.sock_sendall(client_socket, pack_header(OP_DATA, request_id, len(bitmap), FLAG_END) + bitmap)
+
+        f, _, hasher = await self.run_io(self.partials.prepare, safe_filename, filesize, None, False)
+        buf = bytearray(MAX_CHUNK_SIZE)
+        view = memoryview(buf)
+        intact = True
+        finished = True
+        try:
+            index = 0
+            while index < len(plan):
+                kind, digest, detail = plan[index]
+                if kind == "copy":
+                    # Gom các chunk liên tiếp có sẵn vào một lần chạy trên worker
+                    run = []
+                    while index < len(plan) and plan[index][0] == "copy":
+                        run.append(plan[index][1:])
+                        index += 1
+                    if intact:
+                        intact = await self.run_io(self.chunk_index.copy_chunks, f, hasher, run)
+                    continue
+                if kind == "recv":
+                    if not await self.receive_chunk(reader, view, detail):
+                        finished = False
+                        break
+                    if intact:
+                        intact = await self.run_io(self._store_chunk, f, hasher, view[:detail], digest)
+                elif intact:
+                    await self.run_io(self._copy_within, f, hasher, detail, chunks[index][1])
+                index += 1
+        finally:
+            view.release()
+            await self.run_io(f.close)
+
+        digest = hasher.hexdigest()
+        duration = time.perf_counter() - start_time
+        wire_bytes = manifest_size + needed_bytes
+        expected_digest = request.get("sha256")
+        if finished and intact and (expected_digest is None or expected_digest == digest):
+            status = "SUCCESS"
+            await self.run_io(self.partials.finalize, safe_filename,
+                              os.path.join(self.received_files_path, safe_filename))
+            await self.run_io(self.file_index.put, safe_filename, digest)
+            await self.run_io(self.chunk_index.add_file, safe_filename, chunks)
+        else:
+            status = "INCOMPLETE" if not finished else "CORRUPT"
+            await self.run_io(self.partials.discard, safe_filename)
+        await self.record_transfer("UPLOAD", "dedup", safe_filename, filesize, duration, status, wire_bytes)
+
+        if status == "SUCCESS":
+            self.record_dedup(filesize, wire_bytes)
+            ratio = filesize / wire_bytes if wire_bytes else 0
+            await self.send_reply(client_socket, request_id, status="UPLOAD_SUCCESS", received=filesize,
+                                  transferred=wire_bytes, reused=reused_bytes, dedup_ratio=ratio, sha256=digest)
+            self.log_message(f"File '{safe_filename}' ({filesize} bytes) stored from {len(chunks)} chunks in {duration:.2f} seconds; "
+                             f"{wire_bytes} bytes transferred, {filesize - wire_bytes} bytes saved (dedup ratio {ratio:.2f}).")
+            self.record_success()
+            self.emit("files_changed", filename=safe_filename, deleted=False)
+        elif status == "CORRUPT":
+            # Chunk nguồn đổi giữa chừng hoặc digest không khớp: client gửi lại là đủ,
+            # các file đã đổi đã bị loại khỏi chỉ mục
+            await self.send_reply(client_socket, request_id, status="UPLOAD_CORRUPT", received=filesize, sha256=digest,
+                                  message="Stored chunks changed during the upload; upload again.")
+            self.log_message(f"Deduplicated upload of '{safe_filename}' failed verification; discarded.")
+            self.record_failure()
+        else:
+            self.log_message(f"Deduplicated upload of '{safe_filename}' interrupted.")
+            self.record_failure()
+
+    # ---- Upload delta (kiểu rsync) -------------------------------------
+
+    @staticmethod
+    def _copy_range(source, f, hasher, offset, length):
+        # Chép một dải byte của bản cũ sang file partial (chạy trên worker)
+        source.seek(offset)
+        remaining = length
+        while remaining:
+            data = source.read(min(COPY_BLOCK_SIZE, remaining))
+            if not data:
+                return False
+            hasher.update(data)
+            f.write(data)
+            remaining -= len(data)
+        return True
+
+    async def read_data_payload(self, reader, limit):
+        # Đọc một frame DATA (có FLAG_END) không quá `limit` byte
+        header = await reader.read_header()
+        if header is None:
+            return None
+        if header.opcode != OP_DATA or not header.flags & FLAG_END or header.length > limit:
+            raise ProtocolError(f"Expected a DATA frame of at most {limit} bytes, got opcode {header.opcode:#x} ({header.length} bytes)")
+        return await self.read_payload(reader, header.length)
+
+    async def receive_exact(self, reader, f, hasher, length):
+        # Một đoạn literal đi trong đúng một frame DATA dài `length` byte
+        header = await reader.read_header()
+        if header is None:
+            return False
+        if header.opcode != OP_DATA or header.length != length:
+            raise ProtocolError(f"Expected {length} bytes of literal data, got opcode {header.opcode:#x} ({header.length} bytes)")
+        buf = self.buffers.acquire()
+        view = memoryview(buf)
+        try:
+            remaining = length
+            while remaining:
+                received = await reader.readinto(view[:min(len(view), remaining)])
+                if not received:
+                    return False
+                await self.run_io(self._consume_chunk, f, hasher, view[:received])
+                remaining -= received
+            return True
+        finally:
+            view.release()
+            self.buffers.release(buf)
+
+    def _validate_delta(self, ops, filesize, block_size, blocks):
+        # Các lệnh phải dựng lại đúng filesize byte, literal nối tiếp nhau theo thứ tự
+        position = 0
+        for kind, a, b in ops:
+            if kind == OP_COPY and a + b <= blocks:
+                position += b * block_size
+            elif kind == OP_LITERAL and a == position:
+                position += b
+            else:
+                return False
+        return position == filesize
+
+    async def handle_delta_upload(self, client_socket, reader, request_id, request):
+        # Server gửi chữ ký khối của bản đang lưu (DELTA_READY + DATA); client gửi
+        # danh sách lệnh delta, từng đoạn literal, rồi COMMIT với SHA-256 của file mới
+        filename = request.get("filename")
+        filesize = request.get("filesize")
+        safe_filename = self.safe_filename(filename)
+        if safe_filename is None or not isinstance(filesize, int) or filesize < 0:
+            await self.send_reply(client_socket, request_id, status="ERROR", message="Invalid DELTA_UPLOAD command.")
+            return
+        if safe_filename in self.active_uploads:
+            await self.send_reply(client_socket, request_id, status="ERROR",
+                                  message=f"File '{safe_filename}' is already being uploaded.")
+            return
+        try:
+            source = await self.run_io(open, os.path.join(self.received_files_path, safe_filename), "rb")
+        except FileNotFoundError:
+            # Chưa có bản cũ: client upload cả file như bình thường
+            await self.send_reply(client_socket, request_id, status="FILE_NOT_FOUND")
+            return
+
+        self.active_uploads.add(safe_filename)
+        try:
+            with source:
+                await self.receive_delta_upload(client_socket, reader, request_id, safe_filename, filesize, source)
+        finally:
+            self.active_uploads.discard(safe_filename)
+
+    async def receive_delta_upload(self, client_socket, reader, request_id, safe_filename, filesize, source):
+        start_time = time.perf_counter()
+        basis_size = os.fstat(source.fileno()).st_size
+        block_size = block_size_for(basis_size)
+        signatures = await self.run_io(file_signatures, source, block_size)
+        blocks = basis_size // block_size
+        await self.send_reply(client_socket, request_id, status="DELTA_READY", block_size=block_size, blocks=blocks)
+        await self.loop.sock_sendall(client_socket, pack_header(OP_DATA, request_id, len(signatures), FLAG_END) + signatures)
+
+        # Mỗi khối file mới sinh tối đa một lệnh COPY và một lệnh LITERAL
+        payload = await self.read_data_payload(reader, DELTA_OP.size * (2 * (filesize // block_size) + 2))
+        if payload is None:
+            return
+        try:
+            ops = decode_ops(payload)
+        except ValueError as e:
+            raise ProtocolError(str(e))
+        if not self._validate_delta(ops, filesize, block_size, blocks):
+            raise ProtocolError("Delta instructions do not rebuild the announced file size")
+
+        f, _, hasher = await self.run_io(self.partials.prepare, safe_filename, filesize, None, False)
+        literal_bytes = 0
+        finished = True
+        try:
+            for kind, a, b in ops:
+                if kind == OP_COPY:
+                    if not await self.run_io(self._copy_range, source, f, hasher, a * block_size, b * block_size):
+                        raise IOError(f"Stored copy of '{safe_filename}' shrank during a delta upload")
+                elif not await self.receive_exact(reader, f, hasher, b):
+                    finished = False
+                    break
+                else:
+                    literal_bytes += b
+        finally:
+            await self.run_io(f.close)
+
+        expected_digest = None
+        if finished:
+            header, commit = await reader.read_message()
+            if header is None:
+                finished = False
+            elif header.opcode != OP_COMMIT or header.request_id != request_id:
+                raise ProtocolError(f"Expected COMMIT for upload {request_id}, got opcode {header.opcode:#x}")
+            else:
+                expected_digest = commit.get("sha256")
+        digest = hasher.hexdigest()
+        duration = time.perf_counter() - start_time
+        wire_bytes = len(payload) + literal_bytes
+
+        if not finished:
+            status = "INCOMPLETE"
+        elif expected_digest is not None and expected_digest != digest:
+            status = "CORRUPT"
+        else:
+            status = "SUCCESS"
+        if status == "SUCCESS":
+            await self.run_io(self.partials.finalize, safe_filename,
+                              os.path.join(self.received_files_path, safe_filename))
+            await self.run_io(self.file_index.put, safe_filename, digest)
+        else:
+            await self.run_io(self.partials.discard, safe_filename)
+        await self.record_transfer("UPLOAD", "delta", safe_filename, filesize, duration, status, wire_bytes)
+
+        if status == "SUCCESS":
+            await self.send_reply(client_socket, request_id, status="UPLOAD_SUCCESS", received=filesize,
+                                  transferred=wire_bytes, matched=filesize - literal_bytes, sha256=digest)
+            self.log_message(f"File '{safe_filename}' ({filesize} bytes) rebuilt from a delta in {duration:.2f} seconds; "
+                             f"{literal_bytes} literal bytes, {filesize - literal_bytes} bytes reused.")
+            self.record_success()
+            self.emit("files_changed", filename=safe_filename, deleted=False)
+        elif status == "CORRUPT":
+            await self.send_reply(client_socket, request_id, status="UPLOAD_CORRUPT", received=filesize, sha256=digest)
+            self.log_message(f"Delta upload of '{safe_filename}' failed verification; discarded.")
+            self.record_failure()
+        else:
+            self.log_message(f"Delta upload of '{safe_filename}' interrupted.")
+            self.record_failure()
+
+    # ---- Upload hàng loạt ----------------------------------------------
+
+    def _store_batch(self, files):
+        # Ghi các file nhỏ đã nhận đủ trong bộ nhớ: mỗi file qua file tạm rồi đổi
+        # tên, chỉ mục cập nhật một lần cho cả nhóm. files: [(tên, dữ liệu, kết quả)].
+        # Chạy trên thread I/O nên không ghi log ở đây: trả về [(tên, lỗi)] để
+        # handle_batch_upload ghi trên event loop
+        stored = []
+        failed = []
+        for name, data, result in files:
+            temp_path = self.partials.batch_path(name)
+            try:
+                with open(temp_path, "wb") as f:
+                    f.write(data)
+                place_file(temp_path, os.path.join(self.received_files_path, name))
+            except OSError as e:
+                failed.append((name, e))
+                result[1] = BATCH_FAILED
+                continue
+            digest = hashlib.sha256(data).digest()
+            result[2] = digest
+            stored.append((name, digest.hex()))
+        self.file_index.put_many(stored)
+        return failed
+
+    async def read_bytes(self, reader, count):
+        # Đọc đúng count byte vào bytearray riêng (không nới buffer của reader);
+        # None nếu mất kết nối
+        data = bytearray(count)
+        view = memoryview(data)
+        try:
+            filled = 0
+            while filled < count:
+                received = await reader.readinto(view[filled:])
+                if not received:
+                    return None
+                filled += received
+            return data
+        finally:
+            view.release()
+
+    async def skip_bytes(self, reader, count):
+        # Đọc bỏ phần nội dung của một mục bị từ chối; False nếu mất kết nối
+        buf = self.buffers.acquire()
+        view = memoryview(buf)
+        try:
+            while count:
+                received = await reader.readinto(view[:min(len(view), count)])
+                if not received:
+                    return False
+                count -= received
+            return True
+        finally:
+            view.release()
+            self.buffers.release(buf)
+
+    async def receive_batch_file(self, reader, name, size, result):
+        # Mục lớn hơn một buffer: ghi thẳng ra file tạm thay vì giữ trong bộ nhớ
+        temp_path = self.partials.batch_path(name)
+        hasher = hashlib.sha256()
+        f = await self.run_io(open, temp_path, "wb")
+        buf = self.buffers.acquire()
+        view = memoryview(buf)
+        try:
+            remaining = size
+            while remaining:
+                received = await reader.readinto(view[:min(len(view), remaining)])
+                if not received:
+                    break
+                await self.run_io(self._consume_chunk, f, hasher, view[:received])
+                remaining -= received
+        finally:
+            view.release()
+            self.buffers.release(buf)
+            await self.run_io(f.close)
+        if remaining:
+            await self.run_io(self.partials.discard_path, temp_path)
+            return False
+        await self.run_io(place_file, temp_path, os.path.join(self.received_files_path, name))
+        await self.run_io(self.file_index.put, name, hasher.hexdigest())
+        result[2] = hasher.digest()
+        return True
+
+    async def handle_batch_upload(self, client_socket, reader, request_id):
+        # Nhiều file nối tiếp nhau trong một yêu cầu, không có vòng hỏi-đáp nào giữa
+        # các file. File nhỏ được gom trong bộ nhớ rồi ghi theo nhóm trên một lần
+        # chuyển sang thread I/O; transfer log và dashboard chỉ cập nhật một lần
+        start_time = time.perf_counter()
+        results = []        # [tên, mã trạng thái, digest] theo thứ tự trong batch
+        pending = []        # File nhỏ đã nhận đủ, chưa ghi xuống đĩa
+        pending_bytes = 0
+        received_bytes = 0
+        finished = False
+
+        async def flush():
+            nonlocal pending, pending_bytes
+            files, pending, pending_bytes = pending, [], 0
+            try:
+                failed = await self.run_io(self._store_batch, files)
+            finally:
+                for name, _, _ in files:
+                    self.active_uploads.discard(name)
+            for name, error in failed:
+                self.log_message(f"Error storing '{name}' from a batch: {error}")
+
+        try:
+            while True:
+                header = await reader.read_header()
+                if header is None:
+                    break
+                if header.opcode != OP_DATA:
+                    raise ProtocolError(f"Expected DATA frame in batch, got opcode {header.opcode:#x}")
+                if header.flags & FLAG_END and header.length == 0:
+                    finished = True
+                    break
+                if header.length < BATCH_ENTRY.size:
+                    raise ProtocolError("Batch entry is shorter than its header")
+                name_length, size = BATCH_ENTRY.unpack(await reader.readexactly(BATCH_ENTRY.size))
+                if header.length != BATCH_ENTRY.size + name_length + size:
+                    raise ProtocolError("Batch entry length does not match its header")
+                try:
+                    name = self.safe_filename((await reader.readexactly(name_length)).decode("utf-8"))
+                except UnicodeDecodeError:
+                    name = None
+                result = [name or "", BATCH_STORED, b""]
+                results.append(result)
+                if name is None or name in self.active_uploads:
+                    result[1] = BATCH_INVALID_NAME if name is None else BATCH_BUSY
+                    if not await self.skip_bytes(reader, size):
+                        break
+                    continue
+
+                self.active_uploads.add(name)
+                if size <= BATCH_SMALL_FILE_SIZE:
+                    data = await self.read_bytes(reader, size)
+                    if data is None:
+                        self.active_uploads.discard(name)
+                        results.pop()
+                        break
+                    pending.append((name, data, result))
+                    pending_bytes += size
+                    received_bytes += size
+                    if pending_bytes >= BATCH_FLUSH_BYTES:
+                        await flush()
+                    continue
+                try:
+                    stored = await self.receive_batch_file(reader, name, size, result)
+                finally:
+                    self.active_uploads.discard(name)
+                if not stored:
+                    results.pop()
+                    break
+                received_bytes += size
+        finally:
+            # Các file đã nhận đủ vẫn được lưu dù batch bị ngắt giữa chừng
+            await flush()
+
+        duration = time.perf_counter() - start_time
+        stored = sum(1 for _, code, _ in results if code == BATCH_STORED)
+        failed = len(results) - stored
+        status = "SUCCESS" if finished and not failed else "INCOMPLETE"
+        await self.record_transfer("UPLOAD", "batch", f"{stored} file(s)", received_bytes, duration, status)
+        if stored:
+            self.record_success(stored)
+            self.emit("files_changed")
+        if failed or not finished:
+            self.record_failure(failed or 1)
+        if not finished:
+            self.log_message(f"Batch upload interrupted after {stored} file(s).")
+            return
+
+        body = b"".join(encode_batch_result(name, code, digest) for name, code, digest in results)
+        await self.send_reply(client_socket, request_id, status="BATCH_DONE", count=len(results),
+                              stored=stored, failed=failed)
+        await self.loop.sock_sendall(client_socket, pack_header(OP_DATA, request_id, len(body), FLAG_END) + body)
+        self.log_message(f"Batch of {len(results)} file(s) ({received_bytes} bytes) received in {duration:.2f} seconds; "
+                         f"{stored} stored, {failed} rejected.")
+
+    def _hash_stored_file(self, name, entry):
+        path = os.path.join(self.received_files_path, name)
+        st = os.stat(path)
+        digest = hash_file(path, hashlib.sha256()).hexdigest()
+        if not self.file_index.set_digest(name, digest, st):
+            return entry
+        return self.file_index.get(name)
+
+    async def ensure_digest(self, name, entry):
+        # Manifest cần digest của mọi file: file chưa có (đặt vào bằng tay) được băm
+        # một lần rồi lưu vào chỉ mục
+        if entry.sha256 is not None:
+            return entry
+        try:
+            return await self.run_io(self._hash_stored_file, name, entry)
+        except OSError:
+            return entry  # File vừa bị xoá/thay: gửi kèm digest rỗng
+
+    @staticmethod
+    def _valid_list_cursor(cursor, sort):
+        # Tên với sort theo tên, [giá trị, tên] với sort theo kích thước/mtime
+        if cursor is None:
+            return True
+        if sort == "name":
+            return isinstance(cursor, str)
+        return (isinstance(cursor, list) and len(cursor) == 2
+                and isinstance(cursor[0], int) and isinstance(cursor[1], str))
+
+    async def handle_list(self, client_socket, request_id, request):
+        # Một trang danh sách file, lấy từ chỉ mục: lọc theo prefix và/hoặc glob,
+        # sắp theo tên/kích thước/mtime, phân trang bằng cursor. Các mục đi trong
+        # body DATA (độ dài tên + kích thước + mtime + tên) nên không bị giới hạn
+        # bởi kích thước payload điều khiển và tên chứa ký tự bất kỳ vẫn an toàn
+        prefix = request.get("prefix") or ""
+        pattern = request.get("pattern") or None
+        sort = request.get("sort", "name")
+        reverse = request.get("reverse", False)
+        limit = request.get("limit", DEFAULT_LIST_PAGE)
+        cursor = request.get("cursor")
+        with_digests = request.get("digests", False)
+        if (not isinstance(prefix, str) or (pattern is not None and not isinstance(pattern, str))
+                or sort not in LIST_SORT_KEYS or not isinstance(reverse, bool) or not isinstance(with_digests, bool)
+                or not isinstance(limit, int) or not 1 <= limit <= MAX_LIST_PAGE
+                or not self._valid_list_cursor(cursor, sort)):
+            await self.send_reply(client_socket, request_id, status="ERROR", message="Invalid LIST command.")
+            return
+        try:
+            entries, next_cursor = await self.run_io(self.file_index.page, prefix, pattern, sort, reverse,
+                                                     limit, cursor)
+            if with_digests:
+                entries = [(name, await self.ensure_digest(name, entry)) for name, entry in entries]
+        except Exception as e:
+            await self.send_reply(client_socket, request_id, status="ERROR", message="Unable to list files.")
+            self.log_message(f"Error listing files: {e}")
+            return
+        await self.send_reply(client_socket, request_id, status="OK", count=len(entries),
+                              total=len(self.file_index), cursor=next_cursor)
+
+        # Gom các mục thành frame DATA cỡ buffer; frame cuối mang FLAG_END. Trên kết
+        # nối ghép kênh, frame cỡ MUX_FRAME_SIZE và là bulk để xen với các body khác
+        frame_size = MUX_FRAME_SIZE if isinstance(client_socket, MuxStream) else self.buffers.buffer_size
+        pending = bytearray()
+        for name, entry in entries:
+            encoded = encode_list_entry(name, entry.st_size, entry.st_mtime_ns,
+                                        (entry.sha256 or "00" * 32) if with_digests else None)
+            if pending and len(pending) + len(encoded) > frame_size:
+                await self.send_bytes(client_socket, pack_header(OP_DATA, request_id, len(pending)) + pending,
+                                      bulk=True)
+                pending = bytearray()
+            pending += encoded
+        await self.send_bytes(client_socket, pack_header(OP_DATA, request_id, len(pending), FLAG_END) + pending,
+                              bulk=True)
+
+    async def handle_download(self, client_socket, request_id, request, client_address):
+        filename = request.get("filename")
+        offset = request.get("offset", 0)
+        length = request.get("length")
+        # Resume: client gửi lại etag của bản đã tải dở; nếu file đã đổi thì gửi lại từ đầu
+        if_range = request.get("if_range")
+        safe_filename = self.safe_filename(filename)
+        if (safe_filename is None
+                or not isinstance(offset, int) or offset < 0
+                or (length is not None and (not isinstance(length, int) or length < 0))):
+            await self.send_reply(client_socket, request_id, status="ERROR", message="Invalid DOWNLOAD command.")
+            return
+
+        filepath = os.path.join(self.received_files_path, safe_filename)
+        try:
+            f = await self.run_io(open, filepath, "rb")
+        except FileNotFoundError:
+            if await self.run_io(self.file_index.remove, safe_filename):
+                self.emit("files_changed", filename=safe_filename, deleted=True)
+            await self.send_reply(client_socket, request_id, status="FILE_NOT_FOUND")
+            return
+        except Exception as e:
+            await self.send_reply(client_socket, request_id, status="ERROR", message="Unable to send file.")
+            self.log_message(f"Error handling download: {e}")
+            return
+
+        with f:
+            st = os.fstat(f.fileno())
+            filesize = st.st_size
+            etag = file_etag(st)
+            if if_range is not None and if_range != etag:
+                offset, length = 0, None
+            if offset > filesize:
+                await self.send_reply(client_socket, request_id, status="ERROR",
+                                      message=f"Offset {offset} is beyond the end of the file ({filesize} bytes).")
+                return
+            # Khoảng byte [offset, offset + count) được gửi đi
+            count = filesize - offset if length is None else min(length, filesize - offset)
+
+            # Nén thì không dùng được sendfile: từng khối được đọc, nén rồi gửi thành frame riêng.
+            # Ghép kênh cũng vậy: body được cắt thành frame MUX_FRAME_SIZE để xen với yêu cầu khác
+            compression = self.negotiate_compression(request.get("compression"))
+            muxed = isinstance(client_socket, MuxStream)
+            method = "mux" if muxed else self.download_method
+            if compression is not None:
+                method = f"{method}+{compression[0]}"
+
+            # SHA-256 của cả file (nếu đã biết) đi trong header để client kiểm tra ngay
+            # trong lúc nhận, không phải đọc lại file sau khi tải xong
+            if self.file_index.get(safe_filename) is None:
+                # File được đặt vào thư mục khi server đang chạy: đưa vào chỉ mục
+                await self.run_io(self.file_index.put, safe_filename)
+                self.emit("files_changed", filename=safe_filename, deleted=False)
+            digest = self.file_index.digest(safe_filename, st)
+            # Chưa biết digest (file đặt vào thư mục bằng tay...): nếu đường gửi có đọc
+            # dữ liệu qua Python thì băm luôn khi gửi trọn file, còn sendfile thì băm nền
+            hasher = None
+            if digest is None and offset == 0 and count == filesize:
+                if compression is not None or muxed or self.download_method != "sendfile":
+                    hasher = hashlib.sha256()
+                else:
+                    self.hash_in_background(safe_filename, st)
+
+            # Khi header đã gửi đi thì lỗi giữa chừng chỉ có thể xử lý bằng cách đóng kết nối
+            await self.send_reply(client_socket, request_id, status="FILE_FOUND", filesize=filesize,
+                                  offset=offset, length=count, etag=etag, sha256=digest,
+                                  compression=format_compression(compression))
+
+            start_time = time.perf_counter()
+            wire_bytes = None
+            try:
+                if compression is not None:
+                    sent, wire_bytes = await self.send_compressed_range(client_socket, request_id, f, offset, count,
+                                                                        BlockCompressor(compression), hasher)
+                elif muxed:
+                    sent = await self.send_framed_range(client_socket, request_id, f, offset, count, hasher)
+                else:
+                    await self.loop.sock_sendall(client_socket, pack_header(OP_DATA, request_id, count, FLAG_END))
+                    if self.download_method == "sendfile":
+                        sent = await self.send_file_range(client_socket, f, offset, count)
+                    else:
+                        sent = await self.copy_file_range(client_socket, f, offset, count, hasher)
+                if sent != count:
+                    raise IOError(f"File '{filename}' shrank while being sent to {client_address}")
+            except Exception:
+                await self.record_transfer("DOWNLOAD", method, safe_filename, 0,
+                                           time.perf_counter() - start_time, "INCOMPLETE")
+                raise
+            duration = time.perf_counter() - start_time
+            if hasher is not None:
+                await self.run_io(self.file_index.set_digest, safe_filename, hasher.hexdigest(), st)
+            await self.record_transfer("DOWNLOAD", method, safe_filename, count, duration, "SUCCESS", wire_bytes)
+            if compression is not None:
+                self.log_message(f"File '{safe_filename}' ({count} bytes) sent in {duration:.2f} seconds"
+                                 + self.describe_compression(compression, count, wire_bytes))
+
+    @staticmethod
+    def _read_and_encode(f, compressor, offset, length, hasher=None):
+        f.seek(offset)
+        block = f.read(length)
+        if hasher is not None:
+            hasher.update(block)
+        payload, compressed = compressor.encode(block)
+        return len(block), payload, compressed
+
+    def hash_in_background(self, name, st):
+        # Băm file trên luồng I/O rồi lưu digest cho các lần tải sau; mỗi file chỉ
+        # băm một lần cùng lúc, kết quả bị bỏ nếu file đổi trong lúc băm. Với
+        # --workers 0 thì không băm: băm cả file ngay trên loop sẽ chặn mọi kết nối
+        if self.executor is None or name in self._hashing:
+            return
+        self._hashing.add(name)
+
+        def work():
+            digest = hash_file(os.path.join(self.received_files_path, name), hashlib.sha256()).hexdigest()
+            return self.file_index.set_digest(name, digest, st)
+
+        def done(future):
+            self._hashing.discard(name)
+            if future.exception() is not None:
+                self.log_message(f"Error hashing '{name}': {future.exception()}")
+
+        self.loop.run_in_executor(self.executor, work).add_done_callback(done)
+
+    async def send_compressed_range(self, client_socket, request_id, f, offset, count, compressor, hasher=None):
+        # Mỗi khối buffer_size byte là một frame DATA; frame nén mang FLAG_COMPRESSED.
+        # Trên kết nối ghép kênh khối chỉ MUX_FRAME_SIZE byte (khối nén không cắt
+        # được thành nhiều frame), để body xen với yêu cầu khác.
+        # Trả về (số byte thực đã gửi, số byte trên đường truyền)
+        block_size = self.buffers.buffer_size
+        if isinstance(client_socket, MuxStream):
+            block_size = min(block_size, MUX_FRAME_SIZE)
+        peer = self.peer_host(client_socket)
+        ticket = self.transfer_tickets.get(client_socket)
+        sent = 0
+        while True:
+            wanted = min(block_size, count - sent)
+            length, payload, compressed = await self.run_io(self._read_and_encode, f, compressor,
+                                                            offset + sent, wanted, hasher)
+            sent += length
+            last = sent >= count or length < wanted
+            flags = (FLAG_COMPRESSED if compressed else 0) | (FLAG_END if last else 0)
+            await self.send_bytes(client_socket, pack_header(OP_DATA, request_id, len(payload), flags) + payload, bulk=True)
+            if self.shaper.active:
+                await self.shaper.throttle(peer, DOWNLOAD, len(payload))
+            if ticket is not None:
+                await ticket.progress(length)
+            if last:
+                return sent, compressor.wire_bytes
+
+    @staticmethod
+    def _read_block(f, offset, length, hasher=None):
+        f.seek(offset)
+        block = f.read(length)
+        if hasher is not None:
+            hasher.update(block)
+        return block
+
+    async def send_framed_range(self, stream, request_id, f, offset, count, hasher=None):
+        # Download trên kết nối ghép kênh: đọc từng khối buffer_size rồi gửi thành
+        # các frame DATA MUX_FRAME_SIZE byte, frame cuối mang FLAG_END
+        block_size = self.buffers.buffer_size
+        peer = self.peer_host(stream)
+        ticket = self.transfer_tickets.get(stream)
+        sent = 0
+        while True:
+            wanted = min(block_size, count - sent)
+            block = await self.run_io(self._read_block, f, offset + sent, wanted, hasher)
+            sent += len(block)
+            last = sent >= count or len(block) < wanted
+            view = memoryview(block)
+            for start in range(0, max(len(block), 1), MUX_FRAME_SIZE):
+                piece = view[start:start + MUX_FRAME_SIZE]
+                flags = FLAG_END if last and start + MUX_FRAME_SIZE >= len(block) else 0
+                await stream.send(pack_header(OP_DATA, request_id, len(piece), flags) + piece, bulk=True)
+                if self.shaper.active:
+                    await self.shaper.throttle(peer, DOWNLOAD, len(piece))
+            if ticket is not None:
+                await ticket.progress(len(block))
+            if last:
+                return sent
+
+    async def send_file_range(self, client_socket, f, offset, count):
+        # Zero-copy qua os.sendfile; loop.sock_sendfile tự quay về read/send
+        # khi hệ điều hành hoặc loại socket không hỗ trợ sendfile
+        # Khi có giới hạn băng thông thì gửi từng đoạn buffer_size và chờ theo shaper
+        peer = self.peer_host(client_socket)
+        ticket = self.transfer_tickets.get(client_socket)
+        sent = 0
+        while sent < count:
+            shaped = self.shaper.active
+            length = min(self.buffers.buffer_size if shaped else SENDFILE_SLICE, count - sent)
+            n = await self.loop.sock_sendfile(client_socket, f, offset + sent, length, fallback=True)
+            sent += n
+            if n < length:
+                break
+            if shaped:
+                await self.shaper.throttle(peer, DOWNLOAD, n)
+            if ticket is not None:
+                await ticket.progress(n)
+        return sent
+
+    async def copy_file_range(self, client_socket, f, offset, count, hasher=None):
+        # Đường gửi cũ: đọc từng khối vào bytes rồi sendall
+        f.seek(offset)
+        peer = self.peer_host(client_socket)
+        ticket = self.transfer_tickets.get(client_socket)
+        remaining = count
+        while remaining:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            if hasher is not None:
+                hasher.update(chunk)
+            await self.loop.sock_sendall(client_socket, chunk)
+            remaining -= len(chunk)
+            if self.shaper.active:
+                await self.shaper.throttle(peer, DOWNLOAD, len(chunk))
+            if ticket is not None:
+                await ticket.progress(len(chunk))
+        return count - remaining
+
+    def _delete_file(self, name):
+        # Xoá file đã lưu cùng mọi chỉ mục trỏ vào nó, không phát sự kiện (chạy trên
+        # thread I/O). Trả về (có file, danh sách file có đổi): file đã mất nhưng còn
+        # trong chỉ mục thì chỉ mục vẫn được dọn
+        try:
+            os.remove(os.path.join(self.received_files_path, name))
+        except FileNotFoundError:
+            return False, self.file_index.remove(name)
+        prune_empty_dirs(self.received_files_path, name)
+        self.chunk_index.remove_file(name)
+        self.file_index.remove(name)
+        return True, True
+
+    def delete_file(self, name):
+        # Dùng từ thread khác (dashboard); sự kiện được phát trên event loop.
+        # FileNotFoundError nếu không có file
+        found, changed = self._delete_file(name)
+        if changed:
+            self.call_in_loop(lambda: self.emit("files_changed", filename=name, deleted=True))
+        if not found:
+            raise FileNotFoundError(name)
+
+    async def handle_delete(self, client_socket, request_id, request):
+        filename = request.get("filename")
+        try:
+            safe_filename = self.safe_filename(filename)
+            if safe_filename is None:
+                await self.send_reply(client_socket, request_id, status="ERROR", message="Invalid DELETE command.")
+                return
+
+            found, changed = await self.run_io(self._delete_file, safe_filename)
+            if changed:
+                self.emit("files_changed", filename=safe_filename, deleted=True)
+            if not found:
+                await self.send_reply(client_socket, request_id, status="FILE_NOT_FOUND")
+            else:
+                await self.send_reply(client_socket, request_id, status="FILE_DELETED")
+                self.log_message(f"File '{filename}' deleted by client.")
+        except Exception as e:
+            await self.send_reply(client_socket, request_id, status="ERROR", message="Unable to delete file.")
+            self.log_message(f"Error deleting file '{filename}': {e}")
+
+
+# ---- Chạy headless: python -m server_engine ---------------------------
+
+def build_arg_parser(description="Headless file transfer server"):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--host", default=DEFAULT_HOST, help="Bind address (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="TCP port (default: %(default)s)")
+    parser.add_argument("--storage", default="received_files", help="Directory for stored files (default: %(default)s)")
+    parser.add_argument("--log-file", default="transfer_log.csv", help="Transfer log CSV (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="Threads for blocking disk I/O, 0 runs it on the event loop (default: %(default)s)")
+    parser.add_argument("--buffer-size", type=int, default=DEFAULT_BUFFER_SIZE,
+                        help="Receive buffer size in bytes (default: %(default)s)")
+    parser.add_argument("--download-method", choices=DOWNLOAD_METHODS, default="sendfile",
+                        help="How DOWNLOAD bodies are sent (default: %(default)s)")
+    parser.add_argument("--backlog", type=int, default=1024, help="listen() backlog (default: %(default)s)")
+    parser.add_argument("--no-compression", action="store_true",
+                        help="Refuse compressed UPLOAD/DOWNLOAD bodies requested by clients")
+    parser.add_argument("--max-connections", type=int, default=DEFAULT_MAX_CONNECTIONS,
+                        help="Connections served at once; more wait in a queue (default: %(default)s)")
+    parser.add_argument("--max-transfers", type=int, default=DEFAULT_MAX_TRANSFERS,
+                        help="Uploads/downloads running at once (default: %(default)s)")
+    parser.add_argument("--max-inflight-mb", type=int, default=None,
+                        help="Total MiB of transfers running at once (default: unlimited)")
+    parser.add_argument("--global-rate-mb", type=float, default=None,
+                        help="Total bandwidth cap in MB/s (default: unlimited)")
+    parser.add_argument("--upload-rate-mb", type=float, default=None,
+                        help="Bandwidth cap for all uploads in MB/s (default: unlimited)")
+    parser.add_argument("--download-rate-mb", type=float, default=None,
+                        help="Bandwidth cap for all downloads in MB/s (default: unlimited)")
+    parser.add_argument("--client-rate-mb", type=float, default=None,
+                        help="Bandwidth cap per client address in MB/s (default: unlimited)")
+    parser.add_argument("--aging-mb", type=float, default=DEFAULT_AGING_RATE / 1e6,
+                        help="Scheduler aging in MB/s: queued transfers are ordered by size, and each second "
+                             "of waiting counts as this many MB less; 0 serves them in arrival order "
+                             "(default: %(default).1f)")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve Prometheus metrics on this port at /metrics (default: disabled)")
+    parser.add_argument("--metrics-host", default="127.0.0.1",
+                        help="Address of the metrics endpoint (default: %(default)s)")
+    parser.add_argument("--queue-timeout", type=float, default=DEFAULT_QUEUE_TIMEOUT,
+                        help="Seconds a queued request waits before it is answered BUSY (default: %(default)s)")
+    return parser
+
+
+def engine_from_args(args):
+    return FileServerEngine(
+        args.host, args.port, args.storage, args.log_file,
+        backlog=args.backlog, download_method=args.download_method,
+        buffer_size=args.buffer_size, workers=args.workers, compression=not args.no_compression,
+        max_connections=args.max_connections, max_transfers=args.max_transfers,
+        max_inflight_bytes=args.max_inflight_mb * 1024 * 1024 if args.max_inflight_mb else None,
+        queue_timeout=args.queue_timeout,
+        global_rate=mb_per_second(args.global_rate_mb), upload_rate=mb_per_second(args.upload_rate_mb),
+        download_rate=mb_per_second(args.download_rate_mb), client_rate=mb_per_second(args.client_rate_mb),
+        transfer_aging=mb_per_second(args.aging_mb),
+        metrics_host=args.metrics_host, metrics_port=args.metrics_port,
+    )
+
+
+def mb_per_second(value):
+    # MB/s trên dòng lệnh -> byte/giây; None hoặc 0 là không giới hạn
+    return value * 1e6 if value else None
+
+
+def log_event(event, data):
+    # Subscriber mặc định khi chạy không có GUI: ghi sự kiện ra logging
+    if event == "log":
+        logging.info(data["message"])
+    elif event == "transfer":
+        logging.info(
+            f"{data['operation']} {data['filename']}: {data['filesize']} bytes, {data['status']}, "
+            f"{data['speed'] / 1e6:.2f} MB/s ({data['method']})"
+        )
+
+
+async def serve_until_signal(engine):
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, engine.stop)
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows: KeyboardInterrupt vẫn dừng asyncio.run()
+    await engine.serve_forever()
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    engine = engine_from_args(args)
+    engine.add_listener(log_event)
+    try:
+        asyncio.run(serve_until_signal(engine))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
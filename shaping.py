@@ -0,0 +1,163 @@
+import asyncio
+import time
+
+from protocol import AsyncFrameReader
+
+UPLOAD = "upload"
+DOWNLOAD = "download"
+# Bucket cho phép dồn tối đa chừng này giây lưu lượng (nhưng không dưới MIN_BURST)
+BURST_SECONDS = 0.25
+MIN_BURST = 256 * 1024
+# Khi có quá MAX_CLIENT_BUCKETS bucket client, các bucket không dùng trong chừng này giây bị dọn đi
+IDLE_BUCKET_SECONDS = 60
+MAX_CLIENT_BUCKETS = 1024
+RATE_LIMIT_NAMES = ("global_rate", "upload_rate", "download_rate", "client_rate")
+
+
+class TokenBucket:
+    # rate byte/giây. Cho phép "nợ": lấy quá số token hiện có thì trả về số giây
+    # người gọi phải chờ để bù, nên một khối lớn không bị cắt nhỏ
+    def __init__(self, rate, now):
+        self.rate = rate
+        self.burst = max(rate * BURST_SECONDS, MIN_BURST)
+        self.tokens = self.burst
+        self.updated = now
+
+    def set_rate(self, rate, now):
+        self.refill(now)
+        self.rate = rate
+        self.burst = max(rate * BURST_SECONDS, MIN_BURST)
+        self.tokens = min(self.tokens, self.burst)
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, nbytes, now):
+        self.refill(now)
+        self.tokens -= nbytes
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class TrafficShaper:
+    # Token bucket phân cấp: mỗi khối dữ liệu trừ token ở bucket toàn cục, bucket
+    # của chiều truyền (upload/download) và bucket của client (theo địa chỉ IP,
+    # hoặc mức riêng đặt bằng set_client_rate), rồi chờ theo bucket thiếu nhiều
+    # nhất. Mức None là không giới hạn. Đổi được khi đang chạy; chỉ dùng từ event loop.
+    def __init__(self, global_rate=None, upload_rate=None, download_rate=None, client_rate=None):
+        self.limits = dict.fromkeys(RATE_LIMIT_NAMES)
+        self.client_rates = {}
+        self.global_bucket = None
+        self.direction_buckets = {}
+        self.client_buckets = {}
+        self.active = False
+        # Chi phí CPU của chính bộ shaping (không tính thời gian chờ)
+        self.calls = 0
+        self.overhead_ns = 0
+        self.throttled_seconds = 0.0
+        self.set_limits(global_rate=global_rate, upload_rate=upload_rate, download_rate=download_rate,
+                        client_rate=client_rate)
+
+    @staticmethod
+    def _update(bucket, rate, now):
+        if rate is None:
+            return None
+        if bucket is None:
+            return TokenBucket(rate, now)
+        bucket.set_rate(rate, now)
+        return bucket
+
+    def set_limits(self, **limits):
+        # Đổi một hoặc nhiều mức (byte/giây): global_rate, upload_rate, download_rate, client_rate
+        for name, rate in limits.items():
+            if name not in self.limits:
+                raise ValueError(f"Unknown rate limit: {name}")
+            if rate is not None and rate <= 0:
+                raise ValueError(f"{name} must be positive or None")
+            self.limits[name] = rate
+        now = time.monotonic()
+        self.global_bucket = self._update(self.global_bucket, self.limits["global_rate"], now)
+        for direction in (UPLOAD, DOWNLOAD):
+            bucket = self._update(self.direction_buckets.get(direction), self.limits[f"{direction}_rate"], now)
+            if bucket is None:
+                self.direction_buckets.pop(direction, None)
+            else:
+                self.direction_buckets[direction] = bucket
+        for client in list(self.client_buckets):
+            self._update_client(client, now)
+        self._refresh_active()
+
+    def set_client_rate(self, client, rate):
+        # Mức riêng cho một client (None: quay về client_rate chung)
+        if rate is not None and rate <= 0:
+            raise ValueError("rate must be positive or None")
+        if rate is None:
+            self.client_rates.pop(client, None)
+        else:
+            self.client_rates[client] = rate
+        self._update_client(client, time.monotonic())
+        self._refresh_active()
+
+    def _client_rate(self, client):
+        return self.client_rates.get(client, self.limits["client_rate"])
+
+    def _update_client(self, client, now):
+        bucket = self._update(self.client_buckets.get(client), self._client_rate(client), now)
+        if bucket is None:
+            self.client_buckets.pop(client, None)
+        else:
+            self.client_buckets[client] = bucket
+
+    def _refresh_active(self):
+        self.active = any(rate is not None for rate in self.limits.values()) or bool(self.client_rates)
+
+    def _prune(self, now):
+        for client, bucket in list(self.client_buckets.items()):
+            if now - bucket.updated > IDLE_BUCKET_SECONDS:
+                del self.client_buckets[client]
+
+    async def throttle(self, client, direction, nbytes):
+        # Gọi sau khi gửi/nhận nbytes; chờ nếu đã vượt mức của bất kỳ cấp nào
+        start = time.perf_counter_ns()
+        now = time.monotonic()
+        delay = 0.0
+        if self.global_bucket is not None:
+            delay = self.global_bucket.consume(nbytes, now)
+        bucket = self.direction_buckets.get(direction)
+        if bucket is not None:
+            delay = max(delay, bucket.consume(nbytes, now))
+        bucket = self.client_buckets.get(client)
+        if bucket is None and self._client_rate(client) is not None:
+            if len(self.client_buckets) >= MAX_CLIENT_BUCKETS:
+                self._prune(now)
+            bucket = self.client_buckets[client] = TokenBucket(self._client_rate(client), now)
+        if bucket is not None:
+            delay = max(delay, bucket.consume(nbytes, now))
+        self.calls += 1
+        self.overhead_ns += time.perf_counter_ns() - start
+        if delay > 0:
+            self.throttled_seconds += delay
+            await asyncio.sleep(delay)
+
+    def stats(self):
+        stats = dict(self.limits)
+        stats.update(client_overrides=dict(self.client_rates), clients=len(self.client_buckets),
+                     calls=self.calls, overhead_seconds=self.overhead_ns / 1e9,
+                     overhead_us_per_call=self.overhead_ns / self.calls / 1e3 if self.calls else 0.0,
+                     throttled_seconds=self.throttled_seconds)
+        return stats
+
+
+class ShapedFrameReader(AsyncFrameReader):
+    # Reader của một kết nối: mọi byte body nhận qua readinto() đều qua shaper
+    # (chiều upload), nên mọi kiểu upload được giới hạn ở cùng một chỗ
+    def __init__(self, sock, loop, buffer_size, shaper, client):
+        super().__init__(sock, loop, buffer_size)
+        self.shaper = shaper
+        self.client = client
+
+    async def readinto(self, view):
+        received = await super().readinto(view)
+        if received and self.shaper.active:
+            await self.shaper.throttle(self.client, UPLOAD, received)
+        return received
@@ -0,0 +1,285 @@
+import hashlib
+import logging
+import os
+import queue
+import threading
+import time
+
+from partials import combine_range_digests, hash_file_range, preallocate
+from protocol import (
+    FLAG_END, OP_DATA, OP_DOWNLOAD, OP_STRIPE_COMMIT, OP_STRIPE_OPEN, OP_STRIPE_PUT,
+    ProtocolError, pack_header,
+)
+from transfer_client import PARTIAL_SUFFIX, TransferClient, retry_busy
+
+logger = logging.getLogger("transfer_client")
+
+AUTO = "auto"
+MAX_STRIPES = 16
+MIN_SEGMENT_SIZE = 8 * 1024 * 1024
+# Số dải tối đa mỗi file, để tuner có đủ mẫu đo mà không tạo quá nhiều yêu cầu
+TARGET_SEGMENTS = 256
+# Chỉ mở thêm kết nối khi throughput tổng tăng ít nhất 10%
+MIN_GAIN = 0.10
+
+
+def plan_segments(size, segment_size=None):
+    if segment_size is None:
+        segment_size = max(MIN_SEGMENT_SIZE, -(-size // TARGET_SEGMENTS))
+    return [(offset, min(segment_size, size - offset)) for offset in range(0, size, segment_size)]
+
+
+class StripeTuner:
+    # Leo đồi đơn giản: sau khi mỗi kết nối đã xong ít nhất một dải kể từ lần mở
+    # kết nối gần nhất, so sánh throughput tổng với mức tốt nhất đã thấy.
+    # Còn tăng thì mở thêm kết nối, không tăng nữa thì giữ nguyên số hiện tại.
+    def __init__(self, max_stripes=MAX_STRIPES, min_gain=MIN_GAIN):
+        self.max_stripes = max_stripes
+        self.min_gain = min_gain
+        self.best_rate = 0.0
+        self.frozen = False
+        self._reset(1)
+
+    def _reset(self, stripes):
+        self.stripes = stripes
+        self.window_start = time.perf_counter()
+        self.window_bytes = 0
+        self.window_segments = 0
+
+    def observe(self, nbytes):
+        # Trả về True nếu nên mở thêm một kết nối
+        self.window_bytes += nbytes
+        self.window_segments += 1
+        if self.frozen or self.window_segments < self.stripes:
+            return False
+        elapsed = time.perf_counter() - self.window_start
+        rate = self.window_bytes / elapsed if elapsed > 0 else 0.0
+        if rate > self.best_rate * (1 + self.min_gain) and self.stripes < self.max_stripes:
+            self.best_rate = rate
+            self._reset(self.stripes + 1)
+            return True
+        self.frozen = True
+        return False
+
+
+class StripedTransfer:
+    # Chia một file thành các dải byte và truyền song song qua nhiều kết nối.
+    # stripes là số kết nối cố định, hoặc AUTO để tự tăng theo throughput đo được.
+    def __init__(self, host, port, stripes=AUTO, segment_size=None, max_stripes=MAX_STRIPES, progress=None):
+        if stripes != AUTO and (not isinstance(stripes, int) or stripes < 1):
+            raise ValueError("stripes must be a positive integer or 'auto'")
+        self.host = host
+        self.port = port
+        self.stripes = stripes
+        self.segment_size = segment_size
+        self.max_stripes = max_stripes
+        self.progress = progress
+        self.stripes_used = 0
+        self._lock = threading.Lock()
+        self._done_bytes = 0
+        self._total_bytes = 0
+
+    def _add_progress(self, nbytes):
+        with self._lock:
+            self._done_bytes += nbytes
+            done = self._done_bytes
+        if self.progress is not None:
+            self.progress(done, self._total_bytes)
+
+    def _run(self, segments, transfer_segment):
+        # Chạy transfer_segment(client, offset, length) trên một nhóm thread,
+        # mỗi thread giữ một kết nối riêng
+        self._done_bytes = 0
+        self._total_bytes = sum(length for _, length in segments)
+        self._add_progress(0)  # Báo tổng số byte ngay khi bắt đầu
+        work = queue.Queue()
+        for segment in segments:
+            work.put(segment)
+        errors = []
+        workers = []
+        tuner = StripeTuner(self.max_stripes) if self.stripes == AUTO else None
+
+        def worker():
+            try:
+                with TransferClient(self.host, self.port) as client:
+                    while not errors:
+                        try:
+                            offset, length = work.get_nowait()
+                        except queue.Empty:
+                            return
+                        transfer_segment(client, offset, length)
+                        with self._lock:
+                            grow = tuner is not None and tuner.observe(length) and not work.empty()
+                        if grow:
+                            start_worker()
+            except Exception as e:
+                errors.append(e)
+
+        def start_worker():
+            with self._lock:
+                thread = threading.Thread(target=worker, daemon=True)
+                workers.append(thread)
+            thread.start()
+
+        initial = 1 if tuner is not None else min(self.stripes, max(len(segments), 1))
+        for _ in range(initial):
+            start_worker()
+        # Danh sách có thể dài ra trong lúc chờ (tuner mở thêm kết nối)
+        index = 0
+        while True:
+            with self._lock:
+                if index >= len(workers):
+                    break
+                thread = workers[index]
+            thread.join()
+            index += 1
+        self.stripes_used = len(workers)
+        if errors:
+            raise errors[0]
+        if not work.empty():
+            raise ProtocolError("Striped transfer stopped before all ranges were sent")
+
+    def upload(self, file_path, remote_name=None):
+        file_name = remote_name or os.path.basename(file_path)
+        file_size = os.path.getsize(file_path)
+        start_time = time.perf_counter()
+
+        with TransferClient(self.host, self.port) as control:
+            request_id = control.send_request(OP_STRIPE_OPEN, filename=file_name, filesize=file_size)
+            reply = control.read_reply(request_id)
+            if reply.get("status") != "STRIPE_READY":
+                return reply
+            token = reply["token"]
+
+            # SHA-256 của từng dải được tính trên chính buffer gửi đi (không đọc file lần
+            # hai); lúc COMMIT server so bản gộp với digest nó tính khi nhận từng dải
+            digests = {}
+
+            def send_segment(client, offset, length):
+                put_id = client.send_request(OP_STRIPE_PUT, token=token, offset=offset, length=length)
+                client.sock.sendall(pack_header(OP_DATA, put_id, length, FLAG_END))
+                hasher = hashlib.sha256()
+                view = client._view()
+                try:
+                    with open(file_path, "rb") as f:
+                        f.seek(offset)
+                        sent = 0
+                        while sent < length:
+                            n = f.readinto(view[:min(len(view), length - sent)])
+                            if not n:
+                                # Đã khai báo độ dài frame, không thể gửi thiếu: phải đóng kết nối
+                                client.close()
+                                raise IOError(f"File '{file_name}' shrank during upload")
+                            hasher.update(view[:n])
+                            client.sock.sendall(view[:n])
+                            sent += n
+                finally:
+                    view.release()
+                with self._lock:
+                    digests[offset] = (length, hasher.hexdigest())
+                return client.read_reply(put_id)
+
+            def put_segment(client, offset, length):
+                # Server quá tải trả BUSY (đã đọc bỏ dải vừa gửi): gửi lại sau retry_after
+                ack = retry_busy(lambda: send_segment(client, offset, length))
+                if ack.get("status") != "STRIPE_ACK":
+                    raise ProtocolError(f"Range at {offset} rejected: {ack}")
+                self._add_progress(length)
+
+            self._run(plan_segments(file_size, self.segment_size), put_segment)
+
+            request_id = control.send_request(OP_STRIPE_COMMIT, token=token,
+                                              ranges_sha256=combine_range_digests(digests))
+            reply = control.read_reply(request_id)
+
+        duration = time.perf_counter() - start_time
+        reply.update(stripes=self.stripes_used, duration=duration,
+                     throughput=file_size / duration if duration > 0 else 0)
+        logger.info(f"Striped upload of '{file_name}' over {self.stripes_used} connection(s): {reply}")
+        return reply
+
+    def download(self, filename, save_path):
+        start_time = time.perf_counter()
+        with TransferClient(self.host, self.port) as control:
+            # Yêu cầu 0 byte chỉ để biết kích thước và etag của phiên bản hiện tại
+            request_id = control.send_request(OP_DOWNLOAD, filename=filename, offset=0, length=0)
+            reply = control.read_reply(request_id)
+            if reply.get("status") != "FILE_FOUND":
+                return reply
+            control.receive_body(None)
+        filesize = reply["filesize"]
+        etag = reply.get("etag")
+        expected_digest = reply.get("sha256")
+
+        part_path = save_path + PARTIAL_SUFFIX
+        preallocate(part_path, filesize)
+        segments = plan_segments(filesize, self.segment_size)
+
+        # Các dải về không theo thứ tự, nên SHA-256 được tính trên một thread riêng
+        # theo phần đầu file đã liền mạch, trong lúc các dải sau vẫn đang tải
+        completed = set()
+        frontier = threading.Condition()
+        stopped = []
+        hasher = hashlib.sha256() if expected_digest else None
+
+        def hash_frontier():
+            for offset, length in segments:
+                with frontier:
+                    while offset not in completed and not stopped:
+                        frontier.wait()
+                    if offset not in completed:
+                        return
+                hash_file_range(part_path, offset, length, hasher)
+
+        hasher_thread = threading.Thread(target=hash_frontier, daemon=True)
+        if hasher is not None:
+            hasher_thread.start()
+
+        def get_segment(client, offset, length):
+            def request_segment():
+                get_id = client.send_request(OP_DOWNLOAD, filename=filename, offset=offset, length=length, if_range=etag)
+                return client.read_reply(get_id)
+
+            found = retry_busy(request_segment)
+            if found.get("status") != "FILE_FOUND":
+                raise ProtocolError(f"Range at {offset} failed: {found}")
+            if found.get("offset") != offset or found.get("length") != length:
+                # File trên server đã đổi: body là cả file mới, không đọc tiếp được
+                client.close()
+                raise ProtocolError(f"File '{filename}' changed on the server during a striped download")
+            with open(part_path, "r+b") as f:
+                f.seek(offset)
+                received, finished = client.receive_body(f)
+            if not finished or received != length:
+                raise ConnectionError(f"Range at {offset} incomplete: {received} of {length} bytes")
+            with frontier:
+                completed.add(offset)
+                frontier.notify()
+            self._add_progress(length)
+
+        try:
+            self._run(segments, get_segment)
+        except Exception:
+            with frontier:
+                stopped.append(True)
+                frontier.notify()
+            if hasher is not None:
+                hasher_thread.join()
+            os.remove(part_path)
+            raise
+        duration = time.perf_counter() - start_time
+        result = {"status": "DOWNLOAD_SUCCESS", "filesize": filesize, "received": filesize,
+                  "stripes": self.stripes_used, "duration": duration,
+                  "throughput": filesize / duration if duration > 0 else 0,
+                  "sha256": expected_digest, "verified": hasher is not None}
+        if hasher is not None:
+            hasher_thread.join()
+            if hasher.hexdigest() != expected_digest:
+                logger.error(f"Striped download of '{filename}' has sha256 {hasher.hexdigest()}, expected {expected_digest}")
+                os.remove(part_path)
+                result.update(status="DOWNLOAD_CORRUPT", verified=False)
+                return result
+        os.replace(part_path, save_path)
+
+        logger.info(f"Striped download of '{filename}' over {self.stripes_used} connection(s): {result}")
+        return result
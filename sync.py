@@ -0,0 +1,314 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from partials import hash_file
+from progress import ProgressReporter, log_progress
+from transfer_client import PARTIAL_META_SUFFIX, PARTIAL_SUFFIX, TransferClient, retry_busy
+
+logger = logging.getLogger("transfer_client")
+
+DEFAULT_CONCURRENCY = 4
+# File nhỏ được gom thành BATCH_UPLOAD (mỗi batch tối đa BATCH_MAX_FILES file),
+# file lớn đi bằng UPLOAD thường để resume được
+BATCH_FILE_SIZE = 256 * 1024
+BATCH_MAX_FILES = 1000
+# Cache digest cục bộ ở gốc thư mục: chỉ băm lại file có kích thước/mtime đã đổi
+MANIFEST_CACHE_NAME = ".sync-manifest.json"
+PUSH = "push"
+PULL = "pull"
+
+
+def _skipped(entry):
+    # Cache manifest và file tạm của download dở (<file>.part cùng <file>.part.json)
+    if entry.name == MANIFEST_CACHE_NAME or entry.name.endswith(PARTIAL_META_SUFFIX):
+        return True
+    return entry.name.endswith(PARTIAL_SUFFIX) and os.path.exists(entry.path + ".json")
+
+
+def local_manifest(root):
+    # {đường dẫn tương đối dùng '/': (kích thước, mtime ns, sha256)}
+    cache_path = os.path.join(root, MANIFEST_CACHE_NAME)
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    manifest = {}
+    hashed = 0
+    pending = [""]
+    while pending:
+        directory = pending.pop()
+        with os.scandir(os.path.join(root, directory)) as it:
+            for entry in it:
+                name = directory + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(name + "/")
+                    continue
+                if not entry.is_file() or _skipped(entry):
+                    continue
+                st = entry.stat()
+                cached = cache.get(name)
+                if cached is not None and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+                    digest = cached[2]
+                else:
+                    digest = hash_file(entry.path, hashlib.sha256()).hexdigest()
+                    hashed += 1
+                manifest[name] = (st.st_size, st.st_mtime_ns, digest)
+    save_manifest_cache(root, manifest)
+    logger.info(f"Local manifest of '{root}': {len(manifest)} file(s), {hashed} hashed")
+    return manifest
+
+
+def save_manifest_cache(root, manifest):
+    cache_path = os.path.join(root, MANIFEST_CACHE_NAME)
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, cache_path)
+
+
+def diff_manifests(source, target, mirror):
+    # Trả về (các đường dẫn cần chép từ source sang target, các đường dẫn cần xoá
+    # ở target). So theo kích thước và SHA-256; mtime hai bên không so được với
+    # nhau (mtime trên server là lúc upload)
+    changed = sorted(name for name, (size, _, digest) in source.items()
+                     if name not in target or target[name][0] != size or target[name][2] != digest)
+    deleted = sorted(name for name in target if name not in source) if mirror else []
+    return changed, deleted
+
+
+class DirectorySync:
+    # Đồng bộ một cây thư mục với server: push (local -> server) hoặc pull
+    # (server -> local). File trên server mang tên prefix + đường dẫn tương đối.
+    # Hai manifest (đường dẫn, kích thước, mtime, SHA-256) được so ở client, rồi
+    # chỉ các file khác nhau được truyền qua `concurrency` kết nối song song; với
+    # mirror, file không còn ở phía nguồn bị xoá ở phía đích.
+    def __init__(self, host, port, concurrency=DEFAULT_CONCURRENCY, mirror=False, progress=None):
+        if not isinstance(concurrency, int) or concurrency < 1:
+            raise ValueError("concurrency must be a positive integer")
+        self.host = host
+        self.port = port
+        self.concurrency = concurrency
+        self.mirror = mirror
+        self.progress = progress
+        self._lock = threading.Lock()
+        self._done_bytes = 0
+        self._total_bytes = 0
+
+    @staticmethod
+    def _prefix(remote_prefix):
+        remote_prefix = (remote_prefix or "").strip("/")
+        return remote_prefix + "/" if remote_prefix else ""
+
+    def remote_manifest(self, client, prefix):
+        manifest = {}
+        for name, size, mtime_ns, digest in client.iter_files(prefix=prefix, digests=True):
+            manifest[name[len(prefix):]] = (size, mtime_ns, digest)
+        return manifest
+
+    def _add_progress(self, nbytes):
+        with self._lock:
+            self._done_bytes += nbytes
+            done = self._done_bytes
+        if self.progress is not None:
+            self.progress(done, self._total_bytes)
+
+    def _run(self, jobs, total_bytes):
+        # Chạy các job (hàm nhận một TransferClient) trên tối đa `concurrency`
+        # thread, mỗi thread giữ một kết nối riêng. Lỗi của một job không dừng
+        # các job khác; trả về danh sách (mô tả job, lỗi)
+        self._done_bytes = 0
+        self._total_bytes = total_bytes
+        self._add_progress(0)  # Báo tổng số byte ngay khi bắt đầu
+        work = queue.Queue()
+        for job in jobs:
+            work.put(job)
+        failures = []
+
+        def worker():
+            client = None
+            try:
+                while True:
+                    try:
+                        description, job = work.get_nowait()
+                    except queue.Empty:
+                        return
+                    try:
+                        if client is None or not client.is_connected():
+                            client = TransferClient(self.host, self.port).connect()
+                        job(client)
+                    except Exception as e:
+                        logger.error(f"Sync {description} failed: {e}")
+                        with self._lock:
+                            failures.append((description, str(e)))
+                        if isinstance(e, OSError) and client is not None:
+                            client.close()
+            finally:
+                if client is not None:
+                    client.close()
+
+        threads = [threading.Thread(target=worker, daemon=True)
+                   for _ in range(min(self.concurrency, max(len(jobs), 1)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return failures
+
+    def push(self, local_dir, remote_prefix=""):
+        prefix = self._prefix(remote_prefix)
+        start_time = time.perf_counter()
+        local = local_manifest(local_dir)
+        with TransferClient(self.host, self.port) as client:
+            remote = self.remote_manifest(client, prefix)
+        uploads, deletes = diff_manifests(local, remote, self.mirror)
+        manifest_time = time.perf_counter() - start_time
+
+        jobs = []
+        batch = []
+        total_bytes = 0
+
+        def upload_batch(files, nbytes):
+            def job(client):
+                reply = retry_busy(lambda: client.upload_batch(files))
+                rejected = [f"{name}: {status}" for name, status, _ in reply.get("results", ()) if status != "STORED"]
+                if reply.get("status") != "BATCH_DONE" or rejected:
+                    raise IOError(f"batch rejected {rejected or reply}")
+                self._add_progress(nbytes)
+            return job
+
+        def upload_file(path, name, nbytes):
+            def job(client):
+                reply = retry_busy(lambda: client.upload(path, name))
+                if reply.get("status") != "UPLOAD_SUCCESS":
+                    raise IOError(f"server replied {reply}")
+                self._add_progress(nbytes)
+            return job
+
+        def delete_file(name):
+            def job(client):
+                reply = client.delete(name)
+                if reply.get("status") not in ("FILE_DELETED", "FILE_NOT_FOUND"):
+                    raise IOError(f"server replied {reply}")
+            return job
+
+        batch_bytes = 0
+        for name in uploads:
+            size = local[name][0]
+            path = os.path.join(local_dir, *name.split("/"))
+            total_bytes += size
+            if size > BATCH_FILE_SIZE:
+                jobs.append((f"upload of '{name}'", upload_file(path, prefix + name, size)))
+                continue
+            batch.append((path, prefix + name))
+            batch_bytes += size
+            if len(batch) >= BATCH_MAX_FILES:
+                jobs.append((f"batch of {len(batch)} file(s)", upload_batch(batch, batch_bytes)))
+                batch, batch_bytes = [], 0
+        if batch:
+            jobs.append((f"batch of {len(batch)} file(s)", upload_batch(batch, batch_bytes)))
+        for name in deletes:
+            jobs.append((f"delete of '{name}'", delete_file(prefix + name)))
+        return self._finish(PUSH, jobs, total_bytes, len(uploads), deletes, len(local), manifest_time)
+
+    def pull(self, local_dir, remote_prefix=""):
+        prefix = self._prefix(remote_prefix)
+        start_time = time.perf_counter()
+        os.makedirs(local_dir, exist_ok=True)
+        local = local_manifest(local_dir)
+        with TransferClient(self.host, self.port) as client:
+            remote = self.remote_manifest(client, prefix)
+        downloads, deletes = diff_manifests(remote, local, self.mirror)
+        manifest_time = time.perf_counter() - start_time
+
+        def download_file(name, nbytes):
+            def job(client):
+                path = os.path.join(local_dir, *name.split("/"))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                result = retry_busy(lambda: client.download(prefix + name, path))
+                if result.get("status") != "DOWNLOAD_SUCCESS":
+                    raise IOError(f"download ended with {result}")
+                # Digest đã được kiểm tra trong lúc tải: ghi vào cache để lần sau khỏi băm lại
+                st = os.stat(path)
+                with self._lock:
+                    local[name] = (st.st_size, st.st_mtime_ns, result.get("sha256") or remote[name][2])
+                self._add_progress(nbytes)
+            return job
+
+        jobs = [(f"download of '{name}'", download_file(name, remote[name][0])) for name in downloads]
+        total_bytes = sum(remote[name][0] for name in downloads)
+        # Xoá cục bộ thì không cần kết nối: làm ngay trên thread này
+        for name in deletes:
+            path = os.path.join(local_dir, *name.split("/"))
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            local.pop(name, None)
+            parent = os.path.dirname(path)
+            while os.path.normpath(parent) != os.path.normpath(local_dir) and not os.listdir(parent):
+                os.rmdir(parent)
+                parent = os.path.dirname(parent)
+        report = self._finish(PULL, jobs, total_bytes, len(downloads), deletes, len(remote), manifest_time)
+        save_manifest_cache(local_dir, local)
+        return report
+
+    def _finish(self, direction, jobs, total_bytes, transfers, deletes, source_files, manifest_time):
+        start_time = time.perf_counter()
+        failures = self._run(jobs, total_bytes)
+        transfer_time = time.perf_counter() - start_time
+        report = {
+            "status": "SYNC_DONE" if not failures else "SYNC_INCOMPLETE",
+            "direction": direction,
+            "files": source_files,
+            "transferred": transfers,
+            "unchanged": source_files - transfers,
+            "deleted": len(deletes),
+            "bytes": total_bytes,
+            "manifest_seconds": manifest_time,
+            "transfer_seconds": transfer_time,
+            "failures": failures,
+        }
+        logger.info(f"Sync ({direction}): {transfers} file(s) / {total_bytes} bytes transferred, "
+                    f"{len(deletes)} deleted; manifest diff {manifest_time:.2f} s, transfer {transfer_time:.2f} s")
+        return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mirror a directory tree to or from the file server")
+    parser.add_argument("direction", choices=(PUSH, PULL), help="push: local -> server, pull: server -> local")
+    parser.add_argument("local_dir", help="Local directory")
+    parser.add_argument("--prefix", default="", help="Remote path prefix (default: storage root)")
+    parser.add_argument("--host", default="127.0.0.1", help="Server address (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=9999, help="Server port (default: %(default)s)")
+    parser.add_argument("--mirror", action="store_true", help="Delete files that no longer exist on the source side")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="Parallel connections (default: %(default)s)")
+    parser.add_argument("--progress-interval", type=float, default=5.0,
+                        help="Seconds between progress log lines, 0 to disable (default: %(default)s)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    progress = None
+    if args.progress_interval > 0:
+        # Ghi log mỗi `progress_interval` giây hoặc mỗi 10% tổng số byte
+        progress = ProgressReporter(log_progress(logger, f"Sync ({args.direction})"),
+                                    interval=args.progress_interval, step=0.1)
+    sync = DirectorySync(args.host, args.port, args.concurrency, args.mirror, progress=progress)
+    if args.direction == PUSH:
+        report = sync.push(args.local_dir, args.prefix)
+    else:
+        report = sync.pull(args.local_dir, args.prefix)
+    if progress is not None:
+        progress.finish()
+    print(json.dumps(report, indent=2))
+    return 0 if report["status"] == "SYNC_DONE" else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,59 @@
+import io
+import random
+
+import pytest
+
+import chunkstore
+from chunkstore import (
+    MAX_CHUNK_SIZE, MIN_CHUNK_SIZE, _cut_points, decode_manifest, encode_manifest, iter_chunks,
+)
+
+
+def random_bytes(size, seed):
+    return random.Random(seed).randbytes(size)
+
+
+def test_cut_points_respect_chunk_bounds():
+    data = random_bytes(2 * 1024 * 1024, 1)
+    cuts = _cut_points(data, True)
+    assert cuts[-1] == len(data)
+    sizes = [end - start for start, end in zip([0] + cuts, cuts)]
+    assert all(size <= MAX_CHUNK_SIZE for size in sizes)
+    assert all(size >= MIN_CHUNK_SIZE for size in sizes[:-1])
+
+
+def test_cut_points_keep_tail_until_final():
+    data = random_bytes(300 * 1024, 2)
+    cuts = _cut_points(data, False)
+    assert not cuts or cuts[-1] < len(data)
+    assert _cut_points(data, True)[:len(cuts)] == cuts
+    assert _cut_points(bytes(MAX_CHUNK_SIZE * 2), False) == [MAX_CHUNK_SIZE, MAX_CHUNK_SIZE * 2]
+
+
+def test_cut_candidates_match_pure_python(monkeypatch):
+    data = random_bytes(512 * 1024, 3)
+    expected = chunkstore._cut_candidates(data)
+    monkeypatch.setattr(chunkstore, "numpy", None)
+    assert chunkstore._cut_candidates(data) == expected
+
+
+def test_iter_chunks_covers_file_and_survives_insert():
+    data = random_bytes(3 * 1024 * 1024, 4)
+    chunks = list(iter_chunks(io.BytesIO(data)))
+    offset = 0
+    for chunk_offset, length, _ in chunks:
+        assert chunk_offset == offset
+        offset += length
+    assert offset == len(data)
+    # Chèn vài byte ở giữa: phần lớn chunk vẫn giống bản cũ
+    edited = data[:1500000] + b"inserted" + data[1500000:]
+    old = {digest for _, _, digest in chunks}
+    new = [digest for _, _, digest in iter_chunks(io.BytesIO(edited))]
+    assert sum(digest in old for digest in new) >= len(new) - 3
+
+
+def test_manifest_round_trip():
+    chunks = list(iter_chunks(io.BytesIO(random_bytes(1024 * 1024, 5))))
+    assert decode_manifest(encode_manifest(chunks)) == chunks
+    with pytest.raises(ValueError):
+        decode_manifest(encode_manifest(chunks)[:-1])
@@ -0,0 +1,53 @@
+import os
+import zlib
+
+import pytest
+
+from compression import (
+    CODECS, SAMPLE_BLOCKS, BlockCompressor, BlockDecoder, format_compression, parse_compression,
+)
+
+
+def test_parse_compression():
+    assert parse_compression(None) is None
+    assert parse_compression("none") is None
+    assert parse_compression("zlib") == ("zlib", 6)
+    assert parse_compression("lzma:3") == ("lzma", 3)
+    assert format_compression(parse_compression("bz2:1")) == "bz2:1"
+    for spec in ("gzip", "zlib:x", "bz2:0", 5):
+        with pytest.raises(ValueError):
+            parse_compression(spec)
+
+
+@pytest.mark.parametrize("codec", sorted(CODECS))
+def test_block_round_trip(codec):
+    block = b"transfer " * 10000
+    compressor = BlockCompressor(parse_compression(codec))
+    decoder = BlockDecoder(parse_compression(codec))
+    payload, compressed = compressor.encode(block)
+    assert compressed and len(payload) < len(block)
+    assert decoder.decode(payload, len(block)) == block
+    assert (decoder.logical_bytes, decoder.wire_bytes) == (len(block), len(payload))
+
+
+def test_compressor_gives_up_on_incompressible_data():
+    compressor = BlockCompressor(("zlib", 6))
+    for _ in range(SAMPLE_BLOCKS):
+        compressor.encode(os.urandom(64 * 1024))
+    assert not compressor.enabled
+    block = b"a" * 1000
+    assert compressor.encode(block) == (block, False)
+
+
+def test_decoder_stops_compression_bombs():
+    bomb = zlib.compress(bytes(16 * 1024 * 1024))
+    decoder = BlockDecoder(("zlib", 6))
+    with pytest.raises(ValueError, match="expands beyond"):
+        decoder.decode(bomb, 64 * 1024)
+    assert decoder.logical_bytes == 0
+
+
+def test_decoder_rejects_truncated_frame():
+    payload = zlib.compress(os.urandom(10000))
+    with pytest.raises(ValueError, match="Truncated"):
+        BlockDecoder(("zlib", 6)).decode(payload[:-10], 10000)
@@ -0,0 +1,70 @@
+import io
+import random
+
+import pytest
+
+import delta
+from delta import (
+    OP_COPY, OP_LITERAL, block_size_for, compute_delta, decode_ops, encode_ops, file_signatures,
+)
+
+
+def apply_delta(old, new, ops, block_size):
+    # Dựng lại file mới như server: COPY lấy khối từ bản cũ, LITERAL lấy từ file mới
+    out = bytearray()
+    for op, a, b in ops:
+        if op == OP_COPY:
+            out += old[a * block_size:(a + b) * block_size]
+        else:
+            out += new[a:a + b]
+    return bytes(out)
+
+
+def round_trip(old, new):
+    block_size = block_size_for(len(old))
+    signatures = file_signatures(io.BytesIO(old), block_size)
+    ops = compute_delta(io.BytesIO(new), signatures, block_size)
+    assert apply_delta(old, new, ops, block_size) == new
+    return ops, block_size
+
+
+@pytest.fixture(params=["numpy", "python"])
+def scanner(request, monkeypatch):
+    if request.param == "python":
+        monkeypatch.setattr(delta, "numpy", None)
+
+
+def test_delta_round_trip_with_edits(scanner):
+    rng = random.Random(1)
+    old = rng.randbytes(1024 * 1024)
+    new = b"head" + old[:300000] + rng.randbytes(5000) + old[310000:] + b"tail"
+    ops, block_size = round_trip(old, new)
+    literal = sum(b for op, _, b in ops if op == OP_LITERAL)
+    assert literal < 5000 + 10000 + 4 * block_size
+
+
+def test_delta_of_identical_file_is_all_copies(scanner):
+    old = random.Random(2).randbytes(64 * 1024)
+    ops, block_size = round_trip(old, old)
+    assert ops == [(OP_COPY, 0, len(old) // block_size)]
+
+
+def test_delta_against_empty_or_unrelated_file(scanner):
+    new = random.Random(3).randbytes(20000)
+    assert round_trip(b"", new)[0] == [(OP_LITERAL, 0, len(new))]
+    round_trip(random.Random(4).randbytes(20000), new)
+    assert round_trip(new, b"")[0] == []
+
+
+def test_delta_spans_scan_segments(monkeypatch):
+    monkeypatch.setattr(delta, "SCAN_SEGMENT_SIZE", 10000)
+    rng = random.Random(5)
+    old = rng.randbytes(200000)
+    round_trip(old, old[1000:] + rng.randbytes(3000) + old[:50000])
+
+
+def test_ops_round_trip():
+    ops = [(OP_COPY, 0, 3), (OP_LITERAL, 12288, 77)]
+    assert decode_ops(encode_ops(ops)) == ops
+    with pytest.raises(ValueError):
+        decode_ops(encode_ops(ops)[:-1])
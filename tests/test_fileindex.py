@@ -0,0 +1,98 @@
+import os
+
+import pytest
+
+import fileindex
+from fileindex import FileIndex
+
+
+@pytest.fixture
+def index(tmp_path):
+    for i in range(30):
+        name = f"dir/f{i:02d}.txt" if i % 3 == 0 else f"f{i:02d}.bin"
+        path = tmp_path / name
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(b"x" * ((i * 7) % 11))
+        os.utime(path, ns=(0, (100 - i) * 10 ** 9))
+    index = FileIndex(str(tmp_path))
+    index.load()
+    yield index
+    index.close()
+
+
+def all_pages(index, cursor=None, **options):
+    names = []
+    while True:
+        entries, cursor = index.page(cursor=cursor, **options)
+        names += [name for name, _ in entries]
+        if cursor is None:
+            return names
+
+
+def test_load_skips_state_directory(index):
+    assert len(index) == 30
+    assert not any(name.startswith(".") for name in index.list_names())
+
+
+@pytest.mark.parametrize("sort", ["name", "size", "mtime"])
+@pytest.mark.parametrize("reverse", [False, True])
+def test_pages_follow_sort_order(index, sort, reverse):
+    if sort == "name":
+        key = lambda name: name
+    elif sort == "size":
+        key = lambda name: (index.get(name).st_size, name)
+    else:
+        key = lambda name: (index.get(name).st_mtime_ns, name)
+    expected = sorted(index.list_names(), key=key, reverse=reverse)
+    assert all_pages(index, sort=sort, reverse=reverse, limit=4) == expected
+
+
+def test_prefix_and_pattern(index):
+    assert all_pages(index, prefix="dir/", limit=3) == [f"dir/f{i:02d}.txt" for i in range(0, 30, 3)]
+    assert all_pages(index, pattern="f1?.bin", limit=2) == ["f10.bin", "f11.bin", "f13.bin", "f14.bin",
+                                                           "f16.bin", "f17.bin", "f19.bin"]
+    assert all_pages(index, prefix="dir/", pattern="dir/f2*", reverse=True) == ["dir/f27.txt", "dir/f24.txt",
+                                                                              "dir/f21.txt"]
+    assert index.page(prefix="dir/", pattern="f*") == ([], None)
+
+
+def test_scan_limit_returns_cursor(index, monkeypatch):
+    monkeypatch.setattr(fileindex, "MAX_SCAN_PER_PAGE", 5)
+    entries, cursor = index.page(pattern="*.txt", sort="size")
+    assert cursor is not None and len(entries) < 5
+    assert all_pages(index, pattern="*.txt", sort="size") == sorted(
+        (name for name in index.list_names() if name.endswith(".txt")),
+        key=lambda name: (index.get(name).st_size, name))
+
+
+def test_cursor_survives_concurrent_changes(index, tmp_path):
+    entries, cursor = index.page(limit=5)
+    index.remove(entries[-1][0])
+    (tmp_path / "a-first.bin").write_bytes(b"new")
+    index.put("a-first.bin")
+    rest = all_pages(index, limit=5, cursor=cursor)
+    assert rest == [name for name in index.list_names() if name > cursor]
+
+
+def test_put_remove_and_digest(index, tmp_path):
+    path = tmp_path / "new.bin"
+    path.write_bytes(b"hello")
+    entry = index.put("new.bin", "ab" * 32)
+    st = os.stat(path)
+    assert index.get("new.bin") == entry and index.digest("new.bin", st) == "ab" * 32
+    path.write_bytes(b"changed!")
+    assert index.digest("new.bin", os.stat(path)) is None
+    assert not index.set_digest("new.bin", "cd" * 32, os.stat(path))
+    assert index.remove("new.bin") and not index.remove("new.bin")
+    assert index.get("new.bin") is None
+
+
+def test_digests_survive_reload(index, tmp_path):
+    index.put("f01.bin", "ef" * 32)
+    index.close()
+    reloaded = FileIndex(str(tmp_path))
+    try:
+        assert reloaded.load() == 30
+        assert reloaded.get("f01.bin").sha256 == "ef" * 32
+    finally:
+        reloaded.close()
@@ -0,0 +1,105 @@
+import asyncio
+import socket
+
+import pytest
+
+from mux import MuxStream, MuxWriter
+from protocol import FLAG_END, OP_DATA, OP_REPLY, FrameReader, encode_frame, encode_message, parse_header
+from transfer_client import QueuedFrameReader
+
+
+def test_mux_stream_waits_for_credit():
+    async def run():
+        loop = asyncio.get_running_loop()
+        left, right = socket.socketpair()
+        left.setblocking(False)
+        writer = MuxWriter(loop, left)
+        try:
+            stream = MuxStream(writer, 5, window=2)
+            await stream.send(encode_message(OP_REPLY, 5, status="FILE_FOUND"))
+            for _ in range(2):
+                await stream.send(encode_frame(OP_DATA, 5, b"x"), bulk=True)
+            blocked = loop.create_task(stream.send(encode_frame(OP_DATA, 5, b"y", FLAG_END), bulk=True))
+            await asyncio.sleep(0.05)
+            assert not blocked.done()
+            stream.add_credit(1)
+            await asyncio.wait_for(blocked, 1)
+            await stream.drain()
+            assert stream.replied and stream.ended and stream.credit == 0
+        finally:
+            await writer.close()
+            left.close()
+        reader = FrameReader(right)
+        try:
+            header, message = reader.read_message()
+            assert message == {"status": "FILE_FOUND"}
+            payloads = []
+            for _ in range(3):
+                header = reader.read_header()
+                payloads.append(reader.readexactly(header.length))
+            assert payloads == [b"x", b"x", b"y"] and header.flags & FLAG_END
+        finally:
+            right.close()
+
+    asyncio.run(run())
+
+
+def test_mux_stream_without_window_is_unlimited():
+    async def run():
+        left, right = socket.socketpair()
+        left.setblocking(False)
+        writer = MuxWriter(asyncio.get_running_loop(), left)
+        try:
+            stream = MuxStream(writer, 1)
+            for _ in range(10):
+                await asyncio.wait_for(stream.send(encode_frame(OP_DATA, 1, b"x"), bulk=True), 1)
+            await stream.drain()
+        finally:
+            await writer.close()
+            left.close()
+            right.close()
+
+    asyncio.run(run())
+
+
+def frame(opcode, payload=b"", flags=0):
+    data = encode_frame(opcode, 1, payload, flags)
+    return parse_header(data), data[len(data) - len(payload):]
+
+
+def test_queued_reader_grants_credit_in_batches():
+    grants = []
+    reader = QueuedFrameReader(grants.append, window=8)
+    for _ in range(9):
+        reader.feed(frame(OP_DATA, b"ab"))
+    reader.feed(frame(OP_DATA, b"", FLAG_END))
+    for _ in range(9):
+        reader.read_header()
+    assert grants == [4, 4] and not reader.ended
+    reader.read_header()
+    assert reader.ended and grants == [4, 4]
+    reader.reset()
+    assert not reader.ended and reader.consumed == 0
+
+
+def test_queued_reader_reads_payload_and_messages():
+    reader = QueuedFrameReader()
+    reader.feed(frame(OP_REPLY, b'{"status":"OK"}'))
+    reader.feed(frame(OP_DATA, b"hello"))
+    reader.feed(None)
+    assert reader.read_message()[1] == {"status": "OK"}
+    reader.read_header()
+    view = memoryview(bytearray(8))
+    assert reader.readinto(view) == 5 and view[:5].tobytes() == b"hello"
+    assert reader.read_header() is None
+    assert reader.read_header() is None
+
+
+def test_queued_reader_fails_when_server_ignores_window():
+    reader = QueuedFrameReader()
+    while reader.feed(frame(OP_DATA, b"x")):
+        pass
+    with pytest.raises(ConnectionError):
+        reader.read_header()
+    with pytest.raises(ConnectionError):
+        reader.read_header()
@@ -0,0 +1,38 @@
+import hashlib
+import os
+
+from partials import (
+    PartialUploads, combine_range_digests, hash_file, hash_file_range, name_from_state, state_name,
+)
+
+
+def test_combine_range_digests_is_order_independent():
+    digests = {0: (10, "aa"), 10: (5, "bb"), 15: (1, "cc")}
+    reordered = dict(reversed(list(digests.items())))
+    assert combine_range_digests(digests) == combine_range_digests(reordered)
+    assert combine_range_digests(digests) != combine_range_digests({0: (10, "aa"), 10: (6, "bb"), 16: (1, "cc")})
+
+
+def test_hash_file_range(tmp_path):
+    path = tmp_path / "data.bin"
+    data = os.urandom(3 * 1024 * 1024 + 17)
+    path.write_bytes(data)
+    assert hash_file(str(path), hashlib.sha256()).digest() == hashlib.sha256(data).digest()
+    part = hash_file_range(str(path), 1000000, 1500000, hashlib.sha256()).digest()
+    assert part == hashlib.sha256(data[1000000:2500000]).digest()
+
+
+def test_state_names_round_trip():
+    for name in ("a.txt", "thư mục/b c.bin", "../x"):
+        encoded = state_name(name)
+        assert "/" not in encoded and name_from_state(encoded) == name
+
+
+def test_discard_path_ignores_missing_files(tmp_path):
+    partials = PartialUploads(str(tmp_path))
+    path = partials.batch_path("a.txt")
+    with open(path, "wb") as f:
+        f.write(b"x")
+    partials.discard_path(path)
+    partials.discard_path(path)
+    assert not os.path.exists(path)
@@ -0,0 +1,127 @@
+import asyncio
+import socket
+
+import pytest
+
+from protocol import (
+    BATCH_BUSY, BATCH_STORED, FLAG_END, HEADER_SIZE, MAX_CONTROL_PAYLOAD, OP_DATA, OP_LIST, OP_REPLY,
+    AsyncFrameReader, FrameReader, ProtocolError, decode_batch_results, decode_list_entries,
+    decode_message, encode_batch_result, encode_frame, encode_list_entry, encode_message,
+    pack_header, parse_header,
+)
+
+
+def test_header_round_trip():
+    header = parse_header(pack_header(OP_DATA, 7, 123456789, FLAG_END))
+    assert (header.opcode, header.flags, header.request_id, header.length) == (OP_DATA, FLAG_END, 7, 123456789)
+
+
+def test_parse_header_rejects_bad_magic_and_version():
+    frame = bytearray(pack_header(OP_LIST, 1, 0))
+    with pytest.raises(ProtocolError):
+        parse_header(b"XX" + bytes(frame[2:]))
+    frame[2] = 99
+    with pytest.raises(ProtocolError):
+        parse_header(frame)
+
+
+def test_parse_header_limits_control_payload():
+    parse_header(pack_header(OP_DATA, 1, MAX_CONTROL_PAYLOAD + 1))
+    with pytest.raises(ProtocolError):
+        parse_header(pack_header(OP_REPLY, 1, MAX_CONTROL_PAYLOAD + 1))
+
+
+def test_message_round_trip():
+    frame = encode_message(OP_REPLY, 3, status="FILE_FOUND", filesize=10)
+    header = parse_header(frame)
+    assert header.length == len(frame) - HEADER_SIZE
+    assert decode_message(frame[HEADER_SIZE:]) == {"status": "FILE_FOUND", "filesize": 10}
+
+
+def test_decode_message_rejects_invalid_payloads():
+    for payload in (b"\xff", b"{", b"[1, 2]"):
+        with pytest.raises(ProtocolError):
+            decode_message(payload)
+
+
+def test_encode_message_rejects_oversized_payload():
+    with pytest.raises(ProtocolError):
+        encode_message(OP_REPLY, 1, data="x" * MAX_CONTROL_PAYLOAD)
+
+
+def test_list_entries_round_trip():
+    digest = "ab" * 32
+    data = encode_list_entry("a.txt", 10, 123) + encode_list_entry("thư mục/b", 0, -5)
+    assert decode_list_entries(data) == [("a.txt", 10, 123), ("thư mục/b", 0, -5)]
+    assert decode_list_entries(encode_list_entry("c", 1, 2, digest), digests=True) == [("c", 1, 2, digest)]
+    with pytest.raises(ProtocolError):
+        decode_list_entries(data[:-1])
+
+
+def test_batch_results_round_trip():
+    digest = bytes(range(32))
+    data = encode_batch_result("a", BATCH_STORED, digest) + encode_batch_result("b", BATCH_BUSY)
+    assert decode_batch_results(data) == [("a", "STORED", digest.hex()), ("b", "BUSY", None)]
+    with pytest.raises(ProtocolError):
+        decode_batch_results(data[:-1])
+
+
+def test_frame_reader_splits_coalesced_frames():
+    left, right = socket.socketpair()
+    try:
+        reply = encode_message(OP_REPLY, 1, status="OK")
+        data = encode_frame(OP_DATA, 1, b"hello", FLAG_END)
+        left.sendall(reply + data)
+        left.close()
+        reader = FrameReader(right, buffer_size=16)
+        header, message = reader.read_message()
+        assert header.request_id == 1 and message == {"status": "OK"}
+        header = reader.read_header()
+        assert header.opcode == OP_DATA and header.flags & FLAG_END
+        view = memoryview(bytearray(header.length))
+        assert reader.readinto(view) == 5 and view.tobytes() == b"hello"
+        assert reader.read_header() is None
+    finally:
+        right.close()
+
+
+def test_frame_reader_refuses_to_buffer_data_frames():
+    left, right = socket.socketpair()
+    try:
+        left.sendall(encode_frame(OP_DATA, 1, b"x"))
+        with pytest.raises(ProtocolError):
+            FrameReader(right).read_frame()
+    finally:
+        left.close()
+        right.close()
+
+
+def test_frame_reader_detects_truncated_header():
+    left, right = socket.socketpair()
+    try:
+        left.sendall(pack_header(OP_REPLY, 1, 0)[:5])
+        left.close()
+        with pytest.raises(ConnectionError):
+            FrameReader(right).read_header()
+    finally:
+        right.close()
+
+
+def test_async_frame_reader():
+    async def run():
+        left, right = socket.socketpair()
+        right.setblocking(False)
+        try:
+            left.sendall(encode_message(OP_REPLY, 2, status="OK") + b"line\nrest")
+            left.close()
+            reader = AsyncFrameReader(right, asyncio.get_running_loop(), buffer_size=8)
+            header = await reader.read_header()
+            payload = await reader.readexactly(header.length)
+            assert decode_message(payload) == {"status": "OK"}
+            assert await reader.readline() == b"line\n"
+            assert await reader.read(100) == b"rest"
+            assert await reader.read_header() is None
+        finally:
+            right.close()
+
+    asyncio.run(run())
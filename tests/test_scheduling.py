@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+import scheduling
+from admission import AdmissionGate, AdmissionRejected
+from scheduling import TransferScheduler, percentile, size_class
+
+
+def test_gate_is_fifo_without_aging():
+    async def run():
+        gate = AdmissionGate("test", limit=1)
+        await gate.acquire()
+        order = []
+
+        async def job(name, size):
+            await gate.acquire(size)
+            order.append(name)
+            gate.release(size)
+
+        tasks = [asyncio.create_task(job(name, size)) for name, size in (("big", 10 ** 9), ("small", 1))]
+        await asyncio.sleep(0)
+        gate.release()
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(run()) == ["big", "small"]
+
+
+def test_gate_rejects_after_timeout():
+    async def run():
+        gate = AdmissionGate("test", limit=1, timeout=0.01)
+        await gate.acquire()
+        with pytest.raises(AdmissionRejected) as raised:
+            await gate.acquire()
+        assert raised.value.retry_after >= 1
+        assert (gate.rejected, gate.active, gate.waiters) == (1, 1, [])
+
+    asyncio.run(run())
+
+
+def test_scheduler_admits_smallest_remaining_first():
+    async def run():
+        scheduler = TransferScheduler("transfers", limit=1)
+        first = await scheduler.admit(100)
+        order = []
+
+        async def job(name, size):
+            ticket = await scheduler.admit(size)
+            order.append(name)
+            scheduler.finish(ticket)
+
+        tasks = [asyncio.create_task(job(name, size))
+                 for name, size in (("large", 10 ** 10), ("medium", 10 ** 8), ("small", 1000))]
+        await asyncio.sleep(0)
+        scheduler.finish(first)
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(run()) == ["small", "medium", "large"]
+
+
+def test_scheduler_preempts_large_transfer(monkeypatch):
+    monkeypatch.setattr(scheduling, "MIN_RUN_SECONDS", 0)
+
+    async def run():
+        scheduler = TransferScheduler("transfers", limit=1)
+        large = await scheduler.admit(10 ** 10)
+        order = []
+
+        async def small():
+            ticket = await scheduler.admit(1000)
+            order.append("small")
+            scheduler.finish(ticket)
+
+        task = asyncio.create_task(small())
+        await asyncio.sleep(0)
+        await large.progress(1024)
+        order.append("large")
+        await task
+        scheduler.finish(large)
+        return order, large.preemptions, scheduler.stats()
+
+    order, preemptions, stats = asyncio.run(run())
+    assert order == ["small", "large"] and preemptions == 1
+    assert stats["preempted"] == 1 and stats["active"] == 0
+
+
+def test_size_classes_and_percentile():
+    assert size_class(0) == "<64K"
+    assert size_class(64 * 1024) == "64K-1M"
+    assert size_class(10 ** 12) == ">=256M"
+    assert percentile([], 0.5) == 0.0
+    assert percentile(list(range(100)), 0.95) == 95
@@ -0,0 +1,45 @@
+import pytest
+
+from shaping import MIN_BURST, TokenBucket, TrafficShaper
+
+
+def test_token_bucket_allows_burst_then_debt():
+    rate = 4 * 1024 * 1024
+    bucket = TokenBucket(rate, now=0.0)
+    assert bucket.burst == rate * 0.25
+    assert bucket.consume(bucket.burst, 0.0) == 0.0
+    # Khối lớn không bị cắt nhỏ: được lấy ngay, rồi chờ đủ thời gian để trả nợ
+    assert bucket.consume(rate, 0.0) == pytest.approx(1.0)
+    assert bucket.consume(0, 0.5) == pytest.approx(0.5)
+    assert bucket.consume(0, 1.0) == 0.0
+
+
+def test_token_bucket_refill_is_capped():
+    bucket = TokenBucket(1000, now=0.0)
+    assert bucket.burst == MIN_BURST
+    bucket.consume(MIN_BURST, 0.0)
+    bucket.refill(10 ** 6)
+    assert bucket.tokens == MIN_BURST
+
+
+def test_set_rate_keeps_debt():
+    bucket = TokenBucket(1000, now=0.0)
+    bucket.consume(MIN_BURST + 1000, 0.0)
+    bucket.set_rate(2000, 0.0)
+    assert bucket.consume(0, 0.0) == pytest.approx(0.5)
+
+
+def test_shaper_limits():
+    shaper = TrafficShaper()
+    assert not shaper.active
+    shaper.set_limits(download_rate=1000)
+    assert shaper.active and "download" in shaper.direction_buckets
+    shaper.set_client_rate("10.0.0.1", 500)
+    shaper.set_limits(download_rate=None)
+    assert shaper.active and not shaper.direction_buckets
+    shaper.set_client_rate("10.0.0.1", None)
+    assert not shaper.active
+    with pytest.raises(ValueError):
+        shaper.set_limits(upload_rate=0)
+    with pytest.raises(ValueError):
+        shaper.set_limits(bogus_rate=1)
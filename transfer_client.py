@@ -0,0 +1,905 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import queue
+import select
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from chunkstore import encode_manifest, iter_chunks
+from compression import MAX_COMPRESSED_FRAME, BlockCompressor, BlockDecoder, parse_compression
+from delta import OP_LITERAL, compute_delta, encode_ops
+from partials import hash_file_prefix
+from protocol import (
+    DEFAULT_BUFFER_SIZE, FLAG_COMPRESSED, FLAG_END, OP_BATCH_UPLOAD, OP_CHUNK_UPLOAD, OP_COMMIT, OP_DATA, OP_DELETE, OP_DELTA_UPLOAD, OP_DOWNLOAD, OP_LIST,
+    OP_CANCEL, OP_MUX, OP_REPLY, OP_UPLOAD, OP_WINDOW, MUX_CREDIT, FrameReader, ProtocolError, clamp_buffer_size, decode_batch_results, decode_list_entries,
+    decode_message, encode_batch_header, encode_message, pack_header,
+)
+
+logger = logging.getLogger("transfer_client")
+
+PARTIAL_SUFFIX = ".part"
+PARTIAL_META_SUFFIX = ".part.json"
+# Số kết nối tối đa của ConnectionPool, và thời gian một kết nối rảnh được giữ lại
+DEFAULT_POOL_SIZE = 4
+DEFAULT_POOL_MAX_IDLE = 300
+# Số lần thử lại khi server trả BUSY (admission control) trước khi bỏ cuộc
+BUSY_RETRIES = 5
+# Giới hạn an toàn số frame một yêu cầu trên kết nối ghép kênh được giữ chờ đọc
+# (64 KiB mỗi frame). Server chỉ gửi trước MUX_WINDOW_FRAMES frame chưa có credit
+# nên bình thường không chạm tới; vượt quá thì yêu cầu bị huỷ cả hai phía
+MUX_QUEUE_FRAMES = 256
+
+
+def retry_busy(call, attempts=BUSY_RETRIES):
+    # Gọi call() (trả về dict phản hồi) lại sau retry_after giây khi server đang
+    # quá tải; lần cuối vẫn BUSY thì trả về nguyên phản hồi đó
+    for attempt in range(attempts):
+        reply = call()
+        if reply.get("status") != "BUSY" or attempt == attempts - 1:
+            return reply
+        delay = reply.get("retry_after", 1)
+        logger.info(f"Server busy, retrying in {delay} s ({attempt + 1}/{attempts - 1})")
+        time.sleep(delay)
+
+
+class TransferClient:
+    # Một kết nối tới server, không phụ thuộc GUI. Các hàm upload/download nhận
+    # callback progress(done, total) để giao diện (hoặc script) tự cập nhật.
+    def __init__(self, host, port, buffer_size=DEFAULT_BUFFER_SIZE, timeout=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+        self.reader = None
+        self.next_request_id = 0
+        # Buffer gửi/nhận body, cấp phát một lần và dùng lại
+        self.buffer_size = clamp_buffer_size(buffer_size)
+        self.buffer = None
+
+    # ---- Kết nối -------------------------------------------------------
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self.reader = FrameReader(self.sock)
+        return self
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            finally:
+                self.sock = None
+                self.reader = None
+
+    def is_connected(self):
+        return self.sock is not None
+
+    def __enter__(self):
+        if self.sock is None:
+            self.connect()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _view(self):
+        if self.buffer is None or len(self.buffer) != self.buffer_size:
+            self.buffer = bytearray(self.buffer_size)
+        return memoryview(self.buffer)
+
+    # ---- Frame ---------------------------------------------------------
+
+    def send_request(self, opcode, **fields):
+        # Mỗi yêu cầu có một request id riêng, cho phép gửi liên tiếp nhiều lệnh
+        # rồi mới đọc phản hồi theo đúng thứ tự
+        self.next_request_id = (self.next_request_id + 1) & 0xFFFFFFFF
+        request_id = self.next_request_id
+        self.sock.sendall(encode_message(opcode, request_id, **fields))
+        return request_id
+
+    def read_reply(self, request_id):
+        header, reply = self.reader.read_message()
+        if header is None:
+            raise ConnectionError("Server closed the connection.")
+        if header.opcode != OP_REPLY or header.request_id != request_id:
+            raise ProtocolError(f"Unexpected frame {header.opcode:#x} for request {header.request_id}, expected reply to {request_id}")
+        return reply
+
+    def _read_payload(self, length):
+        payload = bytearray(length)
+        view = memoryview(payload)
+        filled = 0
+        try:
+            while filled < length:
+                received = self.reader.readinto(view[filled:])
+                if not received:
+                    return None
+                filled += received
+        finally:
+            view.release()
+        return payload
+
+    def receive_body(self, f, progress=None, done=0, total=None, decoder=None, hasher=None):
+        # Đọc các frame DATA cho tới frame có FLAG_END bằng recv_into vào buffer
+        # dùng lại, ghi thẳng từ memoryview ra file. Frame nén (FLAG_COMPRESSED)
+        # được giải nén bằng decoder; hasher (nếu có) băm dữ liệu ngay khi nhận.
+        # Trả về (số byte thực, đủ body hay chưa)
+        view = self._view()
+        received_total = 0
+        try:
+            while True:
+                header = self.reader.read_header()
+                if header is None:
+                    return received_total, False
+                if header.opcode != OP_DATA:
+                    raise ProtocolError(f"Expected DATA frame, got opcode {header.opcode:#x}")
+                if header.flags & FLAG_COMPRESSED:
+                    if decoder is None or header.length > MAX_COMPRESSED_FRAME:
+                        raise ProtocolError("Unexpected compressed DATA frame")
+                    payload = self._read_payload(header.length)
+                    if payload is None:
+                        return received_total, False
+                    limit = MAX_COMPRESSED_FRAME if total is None else total - done - received_total
+                    try:
+                        data = decoder.decode(payload, limit)
+                    except (ValueError, OSError, EOFError) as e:
+                        raise ProtocolError(f"Invalid compressed frame: {e}")
+                    if f is not None:
+                        f.write(data)
+                    if hasher is not None:
+                        hasher.update(data)
+                    received_total += len(data)
+                    if progress is not None:
+                        progress(done + received_total, total)
+                    if header.flags & FLAG_END:
+                        return received_total, True
+                    continue
+                remaining = header.length
+                while remaining:
+                    received = self.reader.readinto(view[:min(len(view), remaining)])
+                    if not received:
+                        return received_total, False
+                    if f is not None:
+                        f.write(view[:received])
+                    if hasher is not None:
+                        hasher.update(view[:received])
+                    if decoder is not None:
+                        decoder.count_raw(received)
+                    received_total += received
+                    remaining -= received
+                    if progress is not None:
+                        progress(done + received_total, total)
+                if header.flags & FLAG_END:
+                    return received_total, True
+        finally:
+            view.release()
+
+    # ---- Thao tác ------------------------------------------------------
+
+    def list_page(self, prefix=None, pattern=None, sort="name", reverse=False, limit=None, cursor=None,
+                  digests=False):
+        # Một trang danh sách: trả về (các mục (tên, kích thước, mtime ns[, sha256]),
+        # cursor trang sau hoặc None nếu đã hết, tổng số file trên server)
+        fields = {"sort": sort, "reverse": reverse, "cursor": cursor}
+        if digests:
+            fields["digests"] = True
+        if prefix:
+            fields["prefix"] = prefix
+        if pattern:
+            fields["pattern"] = pattern
+        if limit is not None:
+            fields["limit"] = limit
+        request_id = self.send_request(OP_LIST, **fields)
+        reply = self.read_reply(request_id)
+        if reply.get("status") != "OK":
+            raise ProtocolError(reply.get("message", "Unexpected LIST response"))
+        body = io.BytesIO()
+        _, finished = self.receive_body(body)
+        if not finished:
+            raise ConnectionError("Server closed the connection.")
+        entries = decode_list_entries(body.getbuffer(), digests)
+        if len(entries) != reply.get("count"):
+            raise ProtocolError(f"LIST announced {reply.get('count')} entries but sent {len(entries)}")
+        return entries, reply.get("cursor"), reply.get("total")
+
+    def iter_files(self, **filters):
+        # Duyệt qua mọi trang, mỗi trang chỉ được yêu cầu khi trang trước đã dùng hết
+        cursor = None
+        while True:
+            entries, cursor, _ = self.list_page(cursor=cursor, **filters)
+            yield from entries
+            if cursor is None:
+                return
+
+    def list_files(self, **filters):
+        return [entry[0] for entry in self.iter_files(**filters)]
+
+    def delete(self, filename):
+        request_id = self.send_request(OP_DELETE, filename=filename)
+        return self.read_reply(request_id)
+
+    def upload(self, file_path, remote_name=None, resume=True, progress=None, compression=None):
+        # Với resume, server cho biết đã có bao nhiêu byte; client chỉ gửi phần còn
+        # thiếu rồi gửi COMMIT với SHA-256 của cả file để server kiểm tra trước khi lưu.
+        # compression ("zlib:6", "lzma:1"...) chỉ dùng khi server chấp nhận trong UPLOAD_READY
+        file_name = remote_name or os.path.basename(file_path)
+        st = os.stat(file_path)
+        file_size = st.st_size
+        fields = {"compression": compression} if resume and parse_compression(compression) else {}
+
+        request_id = self.send_request(OP_UPLOAD, filename=file_name, filesize=file_size,
+                                       mtime=st.st_mtime, resume=resume, **fields)
+        offset = 0
+        compressor = None
+        if resume:
+            reply = self.read_reply(request_id)
+            if reply.get("status") != "UPLOAD_READY":
+                return reply
+            offset = reply.get("offset", 0)
+            if not isinstance(offset, int) or not 0 <= offset <= file_size:
+                raise ProtocolError(f"Invalid resume offset from server: {offset}")
+            if offset:
+                logger.info(f"Resuming upload of '{file_name}' from byte {offset} of {file_size}")
+            if reply.get("compression"):
+                compressor = BlockCompressor(parse_compression(reply["compression"]))
+
+        hasher = hashlib.sha256()
+        view = self._view()
+        try:
+            with open(file_path, "rb") as f:
+                if offset:
+                    hash_file_prefix(file_path, offset, hasher)
+                    f.seek(offset)
+                if compressor is None:
+                    self.sock.sendall(pack_header(OP_DATA, request_id, file_size - offset, FLAG_END))
+                elif offset == file_size:
+                    self.sock.sendall(pack_header(OP_DATA, request_id, 0, FLAG_END))
+                sent = offset
+                while sent < file_size:
+                    n = f.readinto(view[:min(len(view), file_size - sent)])
+                    if not n:
+                        # Đã khai báo độ dài frame, không thể gửi thiếu: phải đóng kết nối
+                        self.close()
+                        raise IOError(f"File '{file_name}' shrank during upload")
+                    hasher.update(view[:n])
+                    sent += n
+                    if compressor is None:
+                        self.sock.sendall(view[:n])
+                    else:
+                        # Mỗi khối là một frame riêng, nén hoặc thô tuỳ kết quả lấy mẫu
+                        payload, compressed = compressor.encode(view[:n])
+                        flags = (FLAG_COMPRESSED if compressed else 0) | (FLAG_END if sent >= file_size else 0)
+                        self.sock.sendall(pack_header(OP_DATA, request_id, len(payload), flags))
+                        self.sock.sendall(payload)
+                    if progress is not None:
+                        progress(sent, file_size)
+        finally:
+            view.release()
+
+        if resume:
+            self.sock.sendall(encode_message(OP_COMMIT, request_id, sha256=hasher.hexdigest()))
+        reply = self.check_digest(self.read_reply(request_id), hasher.hexdigest(), file_name)
+        reply["resumed_from"] = offset
+        if compressor is not None:
+            logger.info(f"Upload of '{file_name}': {compressor.logical_bytes} bytes compressed to {compressor.wire_bytes} on the wire")
+        return reply
+
+    def upload_chunked(self, file_path, remote_name=None, progress=None):
+        # Upload khử trùng lặp: chia file thành chunk theo nội dung, gửi manifest,
+        # server trả bitmap các chunk còn thiếu và client chỉ gửi các chunk đó
+        file_name = remote_name or os.path.basename(file_path)
+        hasher = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            chunks = list(iter_chunks(f, hasher))
+        file_size = sum(length for _, length, _ in chunks)
+        manifest = encode_manifest(chunks)
+
+        request_id = self.send_request(OP_CHUNK_UPLOAD, filename=file_name, filesize=file_size,
+                                       chunks=len(chunks), sha256=hasher.hexdigest())
+        self.sock.sendall(pack_header(OP_DATA, request_id, len(manifest), FLAG_END))
+        self.sock.sendall(manifest)
+        reply = self.read_reply(request_id)
+        if reply.get("status") != "CHUNKS_NEEDED":
+            return reply
+        bitmap = io.BytesIO()
+        _, finished = self.receive_body(bitmap)
+        bitmap = bitmap.getvalue()
+        if not finished or len(bitmap) != (len(chunks) + 7) // 8:
+            self.close()
+            raise ProtocolError("Invalid chunk bitmap from server")
+        logger.info(f"Server needs {reply.get('needed')} of {len(chunks)} chunks ({reply.get('bytes')} of {file_size} bytes) for '{file_name}'")
+
+        # Chunk server đã có được tính là xong ngay cho thanh tiến trình
+        view = self._view()
+        done = 0
+        try:
+            with open(file_path, "rb") as f:
+                for i, (offset, length, _) in enumerate(chunks):
+                    if bitmap[i // 8] & (0x80 >> (i % 8)):
+                        self.sock.sendall(pack_header(OP_DATA, request_id, length))
+                        f.seek(offset)
+                        sent = 0
+                        while sent < length:
+                            n = f.readinto(view[:min(len(view), length - sent)])
+                            if not n:
+                                self.close()
+                                raise IOError(f"File '{file_name}' shrank during upload")
+                            self.sock.sendall(view[:n])
+                            sent += n
+                    done += length
+                    if progress is not None:
+                        progress(done, file_size)
+        finally:
+            view.release()
+        return self.check_digest(self.read_reply(request_id), hasher.hexdigest(), file_name)
+
+    def upload_delta(self, file_path, remote_name=None, progress=None):
+        # Upload delta kiểu rsync: server gửi chữ ký khối của bản đang lưu, client
+        # chỉ gửi các đoạn mới cùng tham chiếu tới khối cũ. Nếu server chưa có
+        # file này thì upload cả file như bình thường
+        file_name = remote_name or os.path.basename(file_path)
+        file_size = os.path.getsize(file_path)
+        request_id = self.send_request(OP_DELTA_UPLOAD, filename=file_name, filesize=file_size)
+        reply = self.read_reply(request_id)
+        if reply.get("status") == "FILE_NOT_FOUND":
+            logger.info(f"No stored copy of '{file_name}' on the server, uploading the whole file")
+            return self.upload(file_path, remote_name, progress=progress)
+        if reply.get("status") != "DELTA_READY":
+            return reply
+        block_size = reply["block_size"]
+        signatures = io.BytesIO()
+        _, finished = self.receive_body(signatures)
+        if not finished:
+            raise ConnectionError("Server closed the connection.")
+
+        hasher = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            ops = compute_delta(f, signatures.getvalue(), block_size, hasher)
+        literals = [(offset, length) for kind, offset, length in ops if kind == OP_LITERAL]
+        literal_bytes = sum(length for _, length in literals)
+        logger.info(f"Delta for '{file_name}': {len(ops)} instructions, {literal_bytes} of {file_size} bytes literal")
+        payload = encode_ops(ops)
+        self.sock.sendall(pack_header(OP_DATA, request_id, len(payload), FLAG_END) + payload)
+
+        # Khối đã có trên server được tính là xong ngay cho thanh tiến trình
+        view = self._view()
+        done = file_size - literal_bytes
+        try:
+            with open(file_path, "rb") as f:
+                for offset, length in literals:
+                    self.sock.sendall(pack_header(OP_DATA, request_id, length, FLAG_END))
+                    f.seek(offset)
+                    sent = 0
+                    while sent < length:
+                        n = f.readinto(view[:min(len(view), length - sent)])
+                        if not n:
+                            self.close()
+                            raise IOError(f"File '{file_name}' shrank during upload")
+                        self.sock.sendall(view[:n])
+                        sent += n
+                        if progress is not None:
+                            progress(done + sent, file_size)
+                    done += length
+        finally:
+            view.release()
+        self.sock.sendall(encode_message(OP_COMMIT, request_id, sha256=hasher.hexdigest()))
+        return self.check_digest(self.read_reply(request_id), hasher.hexdigest(), file_name)
+
+    def upload_batch(self, files, progress=None):
+        # Upload nhiều file trong một yêu cầu: các bản ghi (header + nội dung) nối
+        # tiếp nhau, file nhỏ được gom vào cùng một lần sendall; server chỉ trả lời
+        # một lần ở cuối với kết quả từng file. files: đường dẫn hoặc (đường dẫn, tên trên server)
+        files = [(entry, os.path.basename(entry)) if isinstance(entry, str) else entry for entry in files]
+        sizes = [os.path.getsize(path) for path, _ in files]
+        total = sum(sizes)
+        request_id = self.send_request(OP_BATCH_UPLOAD, count=len(files), total=total)
+
+        digests = []
+        pending = bytearray()
+        view = self._view()
+        done = 0
+        try:
+            for (path, name), size in zip(files, sizes):
+                header = encode_batch_header(name, size)
+                pending += pack_header(OP_DATA, request_id, len(header) + size) + header
+                hasher = hashlib.sha256()
+                with open(path, "rb") as f:
+                    sent = 0
+                    while sent < size:
+                        n = f.readinto(view[:min(len(view), size - sent)])
+                        if not n:
+                            # Đã khai báo độ dài bản ghi, không thể gửi thiếu: phải đóng kết nối
+                            self.close()
+                            raise IOError(f"File '{path}' shrank during upload")
+                        hasher.update(view[:n])
+                        sent += n
+                        if len(pending) + n < self.buffer_size:
+                            pending += view[:n]
+                        else:
+                            # Khối lớn đi thẳng từ buffer đọc, không chép thêm lần nữa
+                            self.sock.sendall(pending)
+                            pending.clear()
+                            self.sock.sendall(view[:n])
+                digests.append(hasher.hexdigest())
+                done += size
+                if progress is not None:
+                    progress(done, total)
+            pending += pack_header(OP_DATA, request_id, 0, FLAG_END)
+            self.sock.sendall(pending)
+        finally:
+            view.release()
+
+        reply = self.read_reply(request_id)
+        if reply.get("status") != "BATCH_DONE":
+            return reply
+        body = io.BytesIO()
+        _, finished = self.receive_body(body)
+        if not finished:
+            raise ConnectionError("Server closed the connection.")
+        results = decode_batch_results(body.getbuffer())
+        if len(results) != len(files):
+            raise ProtocolError(f"Batch reply has {len(results)} results for {len(files)} files")
+        # Mỗi file được đối chiếu SHA-256 với digest đã tính lúc đọc để gửi
+        for i, ((name, status, digest), expected) in enumerate(zip(results, digests)):
+            if status == "STORED" and digest != expected:
+                logger.error(f"Stored copy of '{name}' has sha256 {digest}, expected {expected}")
+                results[i] = (name, "CORRUPT", digest)
+                reply["stored"] -= 1
+                reply["failed"] += 1
+        reply["results"] = results
+        reply["sent"] = total
+        return reply
+
+    @staticmethod
+    def check_digest(reply, digest, file_name):
+        # So SHA-256 server trả về trong ack với digest client đã tính lúc đọc file
+        # để gửi (upload không resume thì server không nhận COMMIT nên không tự so được)
+        if reply.get("status") == "UPLOAD_SUCCESS" and reply.get("sha256") is not None:
+            reply["verified"] = reply["sha256"] == digest
+            if not reply["verified"]:
+                logger.error(f"Stored copy of '{file_name}' has sha256 {reply['sha256']}, expected {digest}")
+                reply["status"] = "UPLOAD_CORRUPT"
+        return reply
+
+    def download(self, filename, save_path, resume=True, progress=None, compression=None):
+        # Dữ liệu được ghi vào <save_path>.part; <save_path>.part.json lưu etag của
+        # phiên bản trên server để lần sau tải tiếp đúng bản đó.
+        # compression: codec đề nghị, server xác nhận (hoặc từ chối) trong FILE_FOUND
+        part_path = save_path + PARTIAL_SUFFIX
+        meta_path = save_path + PARTIAL_META_SUFFIX
+        offset, etag = 0, None
+        if resume and os.path.exists(part_path):
+            meta = self._read_partial_meta(meta_path)
+            if meta is not None and meta.get("filename") == filename:
+                offset, etag = os.path.getsize(part_path), meta.get("etag")
+
+        fields = {"compression": compression} if parse_compression(compression) else {}
+        request_id = self.send_request(OP_DOWNLOAD, filename=filename, offset=offset, if_range=etag, **fields)
+        reply = self.read_reply(request_id)
+        if reply.get("status") != "FILE_FOUND":
+            return reply
+        decoder = BlockDecoder(parse_compression(reply["compression"])) if reply.get("compression") else None
+
+        filesize = reply.get("filesize")
+        offset = reply.get("offset", 0)
+        if not isinstance(filesize, int) or not isinstance(offset, int) or not 0 <= offset <= filesize:
+            # Không biết body dài bao nhiêu, không thể đồng bộ lại luồng frame
+            self.close()
+            raise ProtocolError(f"Invalid FILE_FOUND reply: {reply}")
+        if offset:
+            logger.info(f"Resuming download of '{filename}' from byte {offset} of {filesize}")
+
+        # Server gửi kèm SHA-256 của cả file: băm ngay khi nhận (phần đã có từ lần
+        # trước được băm trước), không phải đọc lại file sau khi tải xong
+        expected_digest = reply.get("sha256")
+        hasher = hashlib.sha256() if expected_digest else None
+        with open(meta_path, "w", encoding="utf-8") as mf:
+            json.dump({"filename": filename, "etag": reply.get("etag"), "filesize": filesize}, mf)
+        with open(part_path, "r+b" if offset else "wb") as f:
+            f.truncate(offset)
+            if hasher is not None and offset:
+                hash_file_prefix(part_path, offset, hasher)
+            f.seek(offset)
+            received, finished = self.receive_body(f, progress, offset, filesize, decoder, hasher)
+
+        total_bytes = offset + received
+        result = {"status": "DOWNLOAD_INCOMPLETE", "filesize": filesize, "received": total_bytes,
+                  "resumed_from": offset, "sha256": expected_digest, "verified": False,
+                  "transferred": decoder.wire_bytes if decoder is not None else received}
+        if finished and total_bytes == filesize:
+            if hasher is not None and hasher.hexdigest() != expected_digest:
+                # Bản tải về (hoặc phần cũ trong .part) bị hỏng: bỏ để lần sau tải lại từ đầu
+                logger.error(f"Download of '{filename}' has sha256 {hasher.hexdigest()}, expected {expected_digest}")
+                os.remove(part_path)
+                os.remove(meta_path)
+                result["status"] = "DOWNLOAD_CORRUPT"
+                return result
+            os.replace(part_path, save_path)
+            os.remove(meta_path)
+            result["status"] = "DOWNLOAD_SUCCESS"
+            result["verified"] = hasher is not None
+        return result
+
+    def _read_partial_meta(self, meta_path):
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+
+class ConnectionPool:
+    # Nhóm kết nối tới cùng một server cho các thao tác chạy song song: mỗi thao
+    # tác mượn một TransferClient riêng nên các frame không bị trộn trên cùng
+    # socket. Kết nối được mở khi cần (tối đa `size`), kiểm tra còn sống trước
+    # khi cho mượn lại, và bị bỏ nếu thao tác dùng nó kết thúc bằng lỗi.
+    def __init__(self, host, port, size=DEFAULT_POOL_SIZE, timeout=None, max_idle=DEFAULT_POOL_MAX_IDLE):
+        if not isinstance(size, int) or size < 1:
+            raise ValueError("size must be a positive integer")
+        self.host = host
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.idle = []  # [(TransferClient, thời điểm trả lại)], dùng lại kết nối mới nhất trước
+        self.opened = 0  # Số kết nối đang mở, kể cả đang cho mượn
+        self.closed = False
+        self.cond = threading.Condition()
+
+    @staticmethod
+    def _healthy(client):
+        # Giữa hai thao tác server không gửi gì: socket đọc được nghĩa là server
+        # đã đóng kết nối (hoặc còn sót dữ liệu của thao tác trước)
+        if not client.is_connected() or client.reader._buffered():
+            return False
+        try:
+            readable, _, _ = select.select([client.sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def acquire(self, timeout=None):
+        # Trả về một TransferClient đã kết nối; chờ tối đa `timeout` giây nếu cả
+        # `size` kết nối đều đang được mượn
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while True:
+                if self.closed:
+                    raise ConnectionError("Connection pool is closed.")
+                while self.idle:
+                    client, returned = self.idle.pop()
+                    if time.monotonic() - returned <= self.max_idle and self._healthy(client):
+                        return client
+                    client.close()
+                    self.opened -= 1
+                if self.opened < self.size:
+                    self.opened += 1
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError(f"No free connection to {self.host}:{self.port} after {timeout} s")
+                self.cond.wait(remaining)
+        # Mở kết nối ngoài khoá để các thread khác không phải chờ theo
+        try:
+            return TransferClient(self.host, self.port, timeout=self.timeout).connect()
+        except BaseException:
+            with self.cond:
+                self.opened -= 1
+                self.cond.notify()
+            raise
+
+    def release(self, client, discard=False):
+        with self.cond:
+            if discard or self.closed or not client.is_connected():
+                client.close()
+                self.opened -= 1
+            else:
+                self.idle.append((client, time.monotonic()))
+            self.cond.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        # with pool.connection() as client: ... — lỗi giữa chừng để lại luồng frame
+        # ở trạng thái không rõ nên kết nối đó bị đóng thay vì trả lại
+        client = self.acquire(timeout)
+        try:
+            yield client
+        except BaseException:
+            self.release(client, discard=True)
+            raise
+        self.release(client)
+
+    def close(self):
+        # Đóng các kết nối rảnh; kết nối đang cho mượn bị đóng khi được trả lại
+        with self.cond:
+            self.closed = True
+            for client, _ in self.idle:
+                client.close()
+                self.opened -= 1
+            self.idle = []
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return {"size": self.size, "open": self.opened, "idle": len(self.idle), "in_use": self.opened - len(self.idle)}
+
+
+class QueuedFrameReader:
+    # Cùng giao diện đọc với FrameReader nhưng lấy frame (header, payload) từ hàng
+    # đợi do thread đọc của MuxClient điền; None trong hàng đợi là kết nối đã đóng.
+    # Cứ đọc xong nửa cửa sổ frame DATA thì grant(số frame) trả credit cho server
+    def __init__(self, grant=None, window=None):
+        self.frames = queue.Queue(MUX_QUEUE_FRAMES)
+        self.payload = b""
+        self.position = 0
+        self.grant = grant
+        self.grant_batch = max(window // 2, 1) if window else None
+        self.consumed = 0
+        self.ended = False
+
+    def reset(self):
+        # Bắt đầu một yêu cầu mới trên cùng channel
+        self.consumed = 0
+        self.ended = False
+
+    def _buffered(self):
+        return len(self.payload) - self.position
+
+    def feed(self, item):
+        # Gọi từ thread đọc của MuxClient, không bao giờ chặn: hàng đợi đầy nghĩa
+        # là server không theo credit, nên chỉ yêu cầu này bị huỷ thay vì cả kết nối
+        # phải chờ nó. Trả về False nếu đã huỷ
+        try:
+            self.frames.put_nowait(item)
+            return True
+        except queue.Full:
+            self.fail(ConnectionError("Server sent more frames than the flow-control window allows"))
+            return False
+
+    def fail(self, error):
+        # Bỏ các frame chưa đọc rồi đặt lỗi vào hàng đợi (chỉ thread đọc ghi vào hàng đợi)
+        while True:
+            try:
+                self.frames.get_nowait()
+            except queue.Empty:
+                break
+        self.frames.put_nowait(error)
+
+    def read_header(self):
+        item = self.frames.get()
+        if item is None or isinstance(item, Exception):
+            self.frames.put(item)  # Các lần đọc sau cũng thấy kết nối đã đóng / lỗi
+            if item is not None:
+                raise item
+            return None
+        header, self.payload = item
+        self.position = 0
+        if header.opcode == OP_DATA:
+            if header.flags & FLAG_END:
+                self.ended = True
+            elif self.grant is not None:
+                self.consumed += 1
+                if self.consumed >= self.grant_batch:
+                    self.grant(self.consumed)
+                    self.consumed = 0
+        return header
+
+    def readinto(self, view):
+        n = min(len(view), self._buffered())
+        view[:n] = self.payload[self.position:self.position + n]
+        self.position += n
+        return n
+
+    def read_message(self):
+        header = self.read_header()
+        if header is None:
+            return None, None
+        if header.opcode == OP_DATA:
+            raise ProtocolError("Unexpected DATA frame, expected a reply")
+        return header, decode_message(self.payload)
+
+
+class MuxChannel(TransferClient):
+    # Một "kết nối ảo" trên MuxClient: dùng lại nguyên các thao tác LIST, DOWNLOAD,
+    # DELETE của TransferClient, chỉ đổi đường gửi yêu cầu và nguồn đọc frame.
+    # Mỗi thread dùng một channel riêng; nhiều channel chạy song song trên cùng socket
+    def __init__(self, mux):
+        super().__init__(mux.host, mux.port)
+        self.mux = mux
+        self.reader = QueuedFrameReader(self._grant if mux.window else None, mux.window)
+        self.request_id = None
+
+    def connect(self):
+        return self
+
+    def close(self):
+        if self.request_id is not None:
+            # Bỏ dở giữa body (lỗi ghi file, callback lỗi...): báo server dừng gửi
+            self.mux.unregister(self.request_id, cancel=not self.reader.ended)
+            self.request_id = None
+
+    def _grant(self, frames):
+        self.mux.send(pack_header(OP_WINDOW, self.request_id, MUX_CREDIT.size) + MUX_CREDIT.pack(frames))
+
+    def is_connected(self):
+        return not self.mux.closed
+
+    def send_request(self, opcode, **fields):
+        if opcode not in (OP_LIST, OP_DOWNLOAD, OP_DELETE):
+            raise ProtocolError("Only LIST, DOWNLOAD and DELETE can run on a multiplexed connection")
+        self.close()
+        self.reader.reset()
+        self.request_id = self.mux.register(self.reader)
+        self.mux.send(encode_message(opcode, self.request_id, **fields))
+        return self.request_id
+
+
+class MuxClient:
+    # Một kết nối chạy nhiều yêu cầu cùng lúc (OP_MUX): một thread đọc tách frame
+    # theo request id vào hàng đợi của từng MuxChannel; yêu cầu được gửi dưới khoá
+    # nên luôn là frame nguyên vẹn. Dùng cho LIST/DOWNLOAD/DELETE, upload vẫn đi
+    # qua kết nối thường (ConnectionPool).
+    def __init__(self, host, port, timeout=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+        self.closed = True
+        self.frame_size = None
+        self.max_streams = None
+        self.window = None
+        self.next_request_id = 0
+        self.streams = {}
+        self.slots = None
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.reader_thread = None
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        reader = FrameReader(self.sock)
+        try:
+            self.sock.sendall(encode_message(OP_MUX, 0))
+            header, reply = reader.read_message()
+            if header is None or header.opcode != OP_REPLY or reply.get("status") != "MUX_READY":
+                raise ProtocolError(f"Server refused multiplexing: {reply}")
+        except BaseException:
+            self.sock.close()
+            self.sock = None
+            raise
+        self.frame_size = reply.get("frame_size")
+        self.max_streams = reply.get("max_streams")
+        self.window = reply.get("window")
+        # Số yêu cầu cùng lúc không vượt quá giới hạn của server
+        self.slots = threading.Semaphore(self.max_streams or 1)
+        self.closed = False
+        self.reader_thread = threading.Thread(target=self._read_frames, args=(reader,), daemon=True)
+        self.reader_thread.start()
+        return self
+
+    def close(self):
+        # Đánh dấu trước khi đóng socket để thread đọc không báo lỗi kết nối
+        with self.lock:
+            self.closed = True
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+            self.sock = None
+        if self.reader_thread is not None and self.reader_thread is not threading.current_thread():
+            self.reader_thread.join()
+
+    def __enter__(self):
+        if self.sock is None:
+            self.connect()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def register(self, reader):
+        with self.lock:
+            if self.closed:
+                raise ConnectionError("Multiplexed connection is closed.")
+            # Id 0 đã dùng cho OP_MUX; bỏ qua id còn đang được một yêu cầu khác dùng
+            while True:
+                self.next_request_id = (self.next_request_id + 1) & 0xFFFFFFFF
+                if self.next_request_id and self.next_request_id not in self.streams:
+                    break
+            self.streams[self.next_request_id] = reader
+            return self.next_request_id
+
+    def unregister(self, request_id, cancel=False):
+        with self.lock:
+            stream = self.streams.pop(request_id, None)
+        # Yêu cầu bị bỏ giữa chừng: dọn hàng đợi; các frame đến sau của id này bị bỏ qua
+        while stream is not None:
+            try:
+                stream.frames.get_nowait()
+            except queue.Empty:
+                break
+        if cancel and stream is not None:
+            self.cancel(request_id)
+
+    def cancel(self, request_id):
+        # Server dừng yêu cầu (và giải phóng slot transfer); id đã xong thì server bỏ qua
+        try:
+            self.send(pack_header(OP_CANCEL, request_id, 0))
+        except (ConnectionError, OSError):
+            pass
+
+    def send(self, data):
+        with self.send_lock:
+            if self.sock is None:
+                raise ConnectionError("Multiplexed connection is closed.")
+            self.sock.sendall(data)
+
+    def _read_frames(self, reader):
+        try:
+            while True:
+                header = reader.read_header()
+                if header is None:
+                    break
+                if header.length > MAX_COMPRESSED_FRAME:
+                    raise ProtocolError(f"Frame of {header.length} bytes is too large")
+                payload = bytearray(header.length)
+                view = memoryview(payload)
+                filled = 0
+                while filled < header.length:
+                    received = reader.readinto(view[filled:])
+                    if not received:
+                        raise ConnectionError("Connection closed in the middle of a frame")
+                    filled += received
+                view.release()
+                with self.lock:
+                    stream = self.streams.get(header.request_id)
+                if stream is not None and not stream.feed((header, payload)):
+                    with self.lock:
+                        if self.streams.get(header.request_id) is stream:
+                            del self.streams[header.request_id]
+                    self.cancel(header.request_id)
+                    logger.warning(f"Cancelled multiplexed request {header.request_id}: server sent past its window")
+        except (OSError, ProtocolError) as e:
+            if not self.closed:
+                logger.error(f"Multiplexed connection to {self.host}:{self.port} failed: {e}")
+        finally:
+            with self.lock:
+                self.closed = True
+                streams = list(self.streams.values())
+            for stream in streams:
+                stream.feed(None)
+
+    @contextmanager
+    def channel(self):
+        # with mux.channel() as client: client.download(...) — chờ nếu server đã
+        # đủ max_streams yêu cầu đang chạy trên kết nối này
+        self.slots.acquire()
+        client = MuxChannel(self)
+        try:
+            yield client
+        finally:
+            client.close()
+            self.slots.release()
+
+    def list_page(self, **filters):
+        with self.channel() as client:
+            return client.list_page(**filters)
+
+    def list_files(self, **filters):
+        with self.channel() as client:
+            return client.list_files(**filters)
+
+    def download(self, filename, save_path, **options):
+        with self.channel() as client:
+            return client.download(filename, save_path, **options)
+
+    def delete(self, filename):
+        with self.channel() as client:
+            return client.delete(filename)